@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+""" Helpers to merge and transfer the per identifier aggregates built by AggByItemFilterStage """
+
+import pyarrow as pa
+
+import hll
+
+IDENTIFIER_COLUMN = 'identifier'
+COUNTRY_COLUMN = 'country'
+TOTAL_COLUMN = 'is_total'
+SKETCH_COLUMN = hll.SKETCH_KEY
+
+
+def merge_agg_dicts(target, other):
+    """
+    Merge the partial aggregate dict other into target, summing the counters and taking the
+    union of the visitor sketches. Nested dicts (stats by country) are merged recursively. Returns target.
+    """
+    for key, value in other.items():
+        current = target.get(key)
+
+        if current is None:
+            target[key] = value
+        elif isinstance(value, dict):
+            merge_agg_dicts(current, value)
+        elif key == hll.SKETCH_KEY:
+            target[key] = hll.merge(current, value)
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            target[key] = current + value
+
+    return target
+
+
+def merge_latest(values, positions, other, other_positions):
+    """
+    Merge the partial map other into values keeping, for every key, the value at the latest row
+    position. The positions map every key to the row position of its value, without them the
+    values of other win. Returns (values, positions).
+    """
+    if values is None:
+        return other, other_positions
+
+    if positions is None or other_positions is None:
+        values.update(other)
+        return values, None
+
+    for key, value in other.items():
+        position = other_positions[key]
+        if key not in positions or position > positions[key]:
+            values[key] = value
+            positions[key] = position
+
+    return values, positions
+
+
+def agg_dict_to_table(agg_dict, actions, stats_by_country_label):
+    """
+    Flatten an aggregate dict into an arrow table with one row for the totals of
+    every identifier and one row for every (identifier, country) pair
+    """
+    identifiers, countries, totals, sketches = [], [], [], []
+    counters = dict((action, []) for action in actions)
+
+    def _append(identifier, country, is_total, stats):
+        identifiers.append(identifier)
+        countries.append(country)
+        totals.append(is_total)
+        sketches.append(stats.get(hll.SKETCH_KEY))
+        for action in actions:
+            counters[action].append(int(stats.get(action, 0)))
+
+    for identifier, entry in agg_dict.items():
+        _append(identifier, None, True, entry)
+
+        for country, country_entry in entry.get(stats_by_country_label, {}).items():
+            _append(identifier, _country_key(country), False, country_entry)
+
+    columns = {
+        IDENTIFIER_COLUMN: pa.array(identifiers, type=pa.string()),
+        COUNTRY_COLUMN: pa.array(countries, type=pa.string()),
+        TOTAL_COLUMN: pa.array(totals, type=pa.bool_()),
+    }
+    for action in actions:
+        columns[action] = pa.array(counters[action], type=pa.int64())
+    columns[SKETCH_COLUMN] = pa.array(sketches, type=pa.binary())
+
+    return pa.table(columns)
+
+
+def agg_table_to_dict(table, actions, stats_by_country_label):
+    """
+    Rebuild the aggregate dict from the table produced by agg_dict_to_table
+    """
+    agg_dict = {}
+    columns = table.to_pydict()
+    sketches = columns.get(SKETCH_COLUMN)
+
+    for row in range(table.num_rows):
+        identifier = columns[IDENTIFIER_COLUMN][row]
+        entry = agg_dict.get(identifier)
+        if entry is None:
+            entry = dict((action, 0) for action in actions)
+            entry[stats_by_country_label] = {}
+            agg_dict[identifier] = entry
+
+        if columns[TOTAL_COLUMN][row]:
+            stats = entry
+        else:
+            stats = entry[stats_by_country_label].setdefault(
+                columns[COUNTRY_COLUMN][row], dict((action, 0) for action in actions))
+
+        for action in actions:
+            stats[action] += columns[action][row]
+
+        if sketches is not None and sketches[row] is not None:
+            stats[hll.SKETCH_KEY] = hll.merge(stats.get(hll.SKETCH_KEY), sketches[row])
+
+    return agg_dict
+
+
+def add_sketches(agg_dict, identifiers, countries, visits, stats_by_country_label):
+    """
+    Add the sketches of the distinct visits of every identifier and (identifier, country) of the rows
+    given by the identifiers, countries and visits columns to the entries of the aggregate dict,
+    merged with the sketches the entries already have
+    """
+    import pandas as pd
+
+    identifier_codes, identifier_values = pd.factorize(identifiers)
+    country_codes, country_values = pd.factorize(pd.Series(countries).map(_country_key), use_na_sentinel=False)
+    country_index = dict((None if pd.isna(country) else country, code) for code, country in enumerate(country_values))
+    visits = pd.Series(visits).to_numpy()
+
+    by_identifier = hll.group_sketches(identifier_codes, visits)
+    by_country = hll.group_sketches(identifier_codes * len(country_values) + country_codes, visits)
+
+    for code, identifier in enumerate(identifier_values):
+        entry = agg_dict.get(identifier)
+        if entry is None:
+            continue
+        entry[hll.SKETCH_KEY] = hll.merge(entry.get(hll.SKETCH_KEY), by_identifier[code])
+
+        for country, country_entry in entry.get(stats_by_country_label, {}).items():
+            country_code = country_index.get(_country_key(country))
+            if country_code is not None:
+                country_entry[hll.SKETCH_KEY] = hll.merge(country_entry.get(hll.SKETCH_KEY), by_country.get(code * len(country_values) + country_code))
+
+    return agg_dict
+
+
+def _country_key(country):
+    # countries missing in the visits come as None or NaN, both are stored as null
+    if country is None or country != country:
+        return None
+    return str(country)
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the COUNTER double-click filter (DoubleClickFilterStage).
+
+Synthetic visits repeat the same action on the same item with a share of the repeats inside the
+window, the stage runs over increasing event counts and the throughput and dropped events are printed.
+
+    python benchmarks/doubleclick.py -c config.ini --sizes 1000000 10000000
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from configcontext import ConfigurationContext
+from processorpipeline import UsageStatsData
+
+
+def build_events(ctx, events, seed=42):
+    rng = np.random.default_rng(seed)
+
+    visits = max(1, events // 8)
+    identifiers = np.array(['oai:repo:%d' % i for i in range(max(1, events // 20))], dtype=object)
+
+    # clicks of a visit on a few items within minutes of each other, a third of them within the default window
+    visit = rng.integers(1, visits + 1, events)
+    start = pd.Timestamp('2024-01-01') + pd.to_timedelta(visit * 600, unit='s')
+    offsets = np.where(rng.random(events) < 0.33, rng.integers(0, 30, events), rng.integers(0, 600, events))
+
+    return pd.DataFrame({
+        ctx.getLabel('ID_VISIT'): visit,
+        'server_time': start + pd.to_timedelta(offsets, unit='s'),
+        ctx.getLabel('OAI_IDENTIFIER'): identifiers[(visit * 7 + rng.integers(0, 3, events)) % len(identifiers)],
+        ctx.getLabel('ACTION_TYPE'): rng.choice(ctx.getActionsId()[:3], events),
+    })
+
+
+def main(args):
+    from stages import DoubleClickFilterStage
+
+    ctx = ConfigurationContext(args)
+    stage = DoubleClickFilterStage(ctx)
+
+    for size in args['sizes']:
+        data = UsageStatsData()
+        data.events_df = build_events(ctx, size)
+
+        start = time.perf_counter()
+        data = stage.run(data)
+        elapsed = time.perf_counter() - start
+
+        print("events: %12s  time: %7.2fs  events/s: %14s  kept: %5.1f%%" % (
+            "{:,}".format(size), elapsed, "{:,.0f}".format(size / elapsed), 100.0 * len(data.events_df) / size))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Double-click filter benchmark")
+    parser.add_argument("-c", "--config_file_path", default='config.ini', help="config file", required=False)
+    parser.add_argument("--sizes", default=[100000, 1000000, 10000000], type=int, nargs='+', help="numbers of synthetic events")
+    return vars(parser.parse_args())
+
+
+if __name__ == "__main__":
+    main(parse_args())
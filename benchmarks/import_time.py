@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Cold start benchmark of the entry points.
+
+Every target is imported in a fresh interpreter with -X importtime, the best of --repeat runs is
+kept and the heaviest top level imports are listed. The "pipeline" targets also resolve the stage
+classes of the pipeline like UsageStatsProcessorPipeline does, which is what a runner subprocess
+pays before processing. The modules imported by the interpreter startup are not counted. A target
+that imports one of its deferred modules (imported by the code that uses them) is a regression.
+
+    python benchmarks/import_time.py --save_baseline benchmarks/import_baseline.json
+    python benchmarks/import_time.py --baseline benchmarks/import_baseline.json
+"""
+
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+ELASTIC_STAGES = ["stages.S3ParquetInputStage", "stages.RobotsFilterStage", "stages.KnownRobotsFilterStage", "stages.AssetsFilterStage", "stages.DoubleClickFilterStage",
+                  "stages.MetricsFilterStage", "stages.AggByItemFilterStage", "stages.IdentifierFilterStage",
+                  "stages.ElasticOutputStage"]
+
+## target name -> statement run by the fresh interpreter
+TARGETS = {
+    'processorpipeline': "import processorpipeline",
+    'stages': "import stages",
+    's3parquet2elastic': "import s3parquet2elastic",
+    's3stats': "import s3stats",
+    's3parquetQueryByIdentifier': "import s3parquetQueryByIdentifier",
+    'matomo2parquet': "import matomo2parquet",
+    'runner': "import runner",
+    'import2matomo': "import import2matomo",
+    'elastic pipeline stages': "from processorpipeline import get_class\n"
+                               + "".join("get_class(%r)\n" % stage for stage in ELASTIC_STAGES),
+}
+
+## target name -> heavy modules its import must not load
+DEFERRED = {
+    'processorpipeline': ['psutil', 'pandas', 'numpy', 'pyarrow', 'duckdb'],
+    'stages': ['psutil', 'pandas', 'numpy', 'pyarrow', 'awswrangler', 'xxhash'],
+}
+
+## import time: self [us] | cumulative | imported package
+IMPORTTIME_RE = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)\s*$")
+
+
+def measure(statement, startup=()):
+    """ (total seconds, {top level module: cumulative seconds}, every module imported) of statement in a fresh interpreter """
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', statement], cwd=ROOT_DIR,
+                             capture_output=True, text=True)
+    if process.returncode != 0:
+        raise RuntimeError(process.stderr.strip().splitlines()[-1] if process.stderr.strip() else 'exit %d' % process.returncode)
+
+    top = {}
+    modules = set()
+    for line in process.stderr.splitlines():
+        match = IMPORTTIME_RE.match(line)
+        if match is not None:
+            modules.add(match.group(4))
+        # one space of indent is an import made by the statement itself
+        if match is not None and len(match.group(3)) == 1 and match.group(4) not in startup:
+            top[match.group(4)] = top.get(match.group(4), 0) + int(match.group(2)) / 1e6
+
+    return sum(top.values()), top, modules
+
+
+def eager_imports(name, modules):
+    """ Deferred modules of the target imported by it """
+    return [module for module in DEFERRED.get(name, []) if module in modules]
+
+
+def run(targets, repeat, top_n):
+    """ Best import time of every target, and the targets that import a deferred module """
+    startup = set(measure('pass')[1])
+    results = {}
+    eager = {}
+    for name in targets:
+        try:
+            runs = [measure(TARGETS[name], startup) for _ in range(repeat)]
+        except RuntimeError as e:
+            print("%-28s failed: %s" % (name, e))
+            continue
+
+        total, top, modules = min(runs, key=lambda run: run[0])
+        results[name] = total
+        heaviest = sorted(top.items(), key=lambda item: -item[1])[:top_n]
+        print("%-28s %8.3fs   %s" % (name, total, ", ".join("%s %.3fs" % item for item in heaviest)))
+
+        if eager_imports(name, modules):
+            eager[name] = eager_imports(name, modules)
+            print("%-28s imports the deferred modules %s" % ('', ", ".join(eager[name])))
+
+    return results, eager
+
+
+def compare(results, baseline, tolerance):
+    """ Print the change of every target against the baseline, True when none is slower than tolerance """
+    ok = True
+    print("\n%-28s %10s %10s %8s" % ('target', 'baseline', 'now', 'ratio'))
+    for name, total in results.items():
+        if name not in baseline:
+            continue
+        ratio = total / baseline[name] if baseline[name] else 1.0
+        slower = ratio > 1 + tolerance
+        ok = ok and not slower
+        print("%-28s %9.3fs %9.3fs %7.2fx%s" % (name, baseline[name], total, ratio, '  SLOWER' if slower else ''))
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Entry point import time benchmark")
+    parser.add_argument("--targets", nargs='+', default=list(TARGETS), choices=list(TARGETS))
+    parser.add_argument("--repeat", default=5, type=int, help="fresh interpreters per target, the best is kept")
+    parser.add_argument("--top", default=5, type=int, help="heaviest top level imports listed")
+    parser.add_argument("--save_baseline", default=None, help="write the results to this json file")
+    parser.add_argument("--baseline", default=None, help="compare with this json file, exit 1 on a regression")
+    parser.add_argument("--tolerance", default=0.25, type=float, help="allowed slowdown against the baseline")
+    args = parser.parse_args()
+
+    results, eager = run(args.targets, args.repeat, args.top)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as file:
+            json.dump(results, file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            if not compare(results, json.load(file), args.tolerance):
+                sys.exit(1)
+
+    if eager:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
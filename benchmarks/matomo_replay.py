@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the import2matomo.py replay against a local stub of the Matomo bulk tracking endpoint.
+
+The stub runs in its own process and answers every bulk request after latency + per_line * lines
+seconds, like a tracker that spends time per request. A synthetic events file is replayed with
+the synchronous sender, with the async sender at every concurrency and with the sharded replay
+at every number of workers (the file split in --files gz files), the lines/s are printed.
+
+    python benchmarks/matomo_replay.py --lines 200000 --concurrency 1 4 16 --gzip --adaptive
+    python benchmarks/matomo_replay.py --lines 1000000 --concurrency 16 --workers 2 4 8 --files 16 --skip_sync
+"""
+
+import argparse
+import asyncio
+import contextlib
+import gzip
+import io
+import multiprocessing
+import os
+import socket
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import import2matomo
+
+
+def serve_stub(sock, latency, per_line):
+    from aiohttp import web
+
+    async def track(request):
+        lines = (await request.json())['requests']
+        await asyncio.sleep(latency + per_line * len(lines))
+        return web.json_response({'status': 'success', 'tracked': len(lines), 'invalid': 0})
+
+    app = web.Application(client_max_size=256 * 1024 * 1024)
+    app.router.add_post('/matomo.php', track)
+    web.run_app(app, sock=sock, print=None, access_log=None)
+
+
+def write_events(path, lines):
+    with gzip.open(path, 'wt', compresslevel=1) as file:
+        for i in range(lines):
+            file.write("?idsite=%d&rec=1&apiv=1&_id=%016x&cip=10.0.%d.%d&url=https%%3A%%2F%%2Frepositorio.example.org%%2Fitem%%2F%d"
+                       "&action_name=item%%20%d&cdt=2024-06-%02d%%20%02d%%3A%02d%%3A00\n"
+                       % (i % 7 + 1, i, i // 256 % 256, i % 256, i % 50000, i % 50000, i % 28 + 1, i % 24, i % 60))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="import2matomo replay benchmark")
+    parser.add_argument("--lines", default=100000, type=int)
+    parser.add_argument("--batch_size", default=100, type=int)
+    parser.add_argument("--concurrency", default=[1, 4, 16], type=int, nargs='+')
+    parser.add_argument("--latency", default=0.02, type=float, help="stub seconds per request")
+    parser.add_argument("--per_line", default=0.0001, type=float, help="stub seconds per line of a request")
+    parser.add_argument("--gzip", action='store_true')
+    parser.add_argument("--adaptive", action='store_true')
+    parser.add_argument("--target_latency", default=0.5, type=float)
+    parser.add_argument("--workers", default=[], type=int, nargs='*', help="processes of the sharded replay")
+    parser.add_argument("--files", default=8, type=int, help="gz files of the sharded replay")
+    parser.add_argument("--rate", default=None, type=float, help="lines/s limit of the sharded replay")
+    parser.add_argument("--skip_sync", action='store_true', help="do not run the synchronous sender")
+    args = parser.parse_args()
+
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    url = 'http://127.0.0.1:%d/matomo.php' % sock.getsockname()[1]
+    stub = multiprocessing.Process(target=serve_stub, args=(sock, args.latency, args.per_line), daemon=True)
+    stub.start()
+    time.sleep(1.0)
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        events = os.path.join(tmp, 'events.log.gz')
+        write_events(events, args.lines)
+
+        if not args.skip_sync:
+            started = time.perf_counter()
+            # the synchronous sender prints every batch
+            with contextlib.redirect_stdout(io.StringIO()):
+                import2matomo.send_events_to_matomo(events, url, args.batch_size)
+            results.append(('sync', time.perf_counter() - started))
+
+        for concurrency in args.concurrency:
+            totals = asyncio.run(import2matomo.replay_events_async(
+                events, url, args.batch_size, concurrency, args.gzip, args.adaptive, args.target_latency,
+                checkpoint_path=os.path.join(tmp, 'checkpoint_%d' % concurrency)))
+            assert totals['complete'] and totals['tracked'] == args.lines
+            results.append(('async x%d' % concurrency, totals['seconds']))
+
+        if args.workers:
+            files = [os.path.join(tmp, 'events_%03d.log.gz' % number) for number in range(args.files)]
+            for number, path in enumerate(files):
+                write_events(path, args.lines // args.files + (number < args.lines % args.files))
+
+        for workers in args.workers:
+            totals = import2matomo.replay_events_sharded(
+                files, url, workers, args.rate, os.path.join(tmp, 'checkpoints_%d' % workers), batch_size=args.batch_size,
+                concurrency=args.concurrency[-1], compress=args.gzip, adaptive=args.adaptive, target_latency=args.target_latency)
+            assert totals['complete'] and totals['tracked'] == args.lines
+            results.append(('sharded x%d' % workers, totals['seconds']))
+
+    stub.terminate()
+
+    print("%-12s %10s %12s %9s" % ('mode', 'seconds', 'lines/s', 'speedup'))
+    for mode, seconds in results:
+        print("%-12s %10.2f %12.0f %8.1fx" % (mode, seconds, args.lines / seconds, results[0][1] / seconds))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Per stage benchmark suite of the s3parquet2elastic pipeline over synthetic local data.
+
+Every size runs in a fresh process: a synthetic site/month is written as parquet to local
+files (or with --storage s3 to the in-process fake s3), read back by the input stage and processed by the full filter chain. The documents are
+built like ElasticOutputStage does but not indexed. Throughput, cpu time and peak memory
+of every stage come from the pipeline stage metrics.
+
+    python benchmarks/run_benchmarks.py -c config.ini --sizes 10k 100k 1M 10M --save_baseline benchmarks/baseline.json
+    python benchmarks/run_benchmarks.py -c config.ini --sizes 10k 100k 1M --baseline benchmarks/baseline.json
+"""
+
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARKS_DIR))
+sys.path.insert(0, BENCHMARKS_DIR)
+
+import storage
+from synthetic import WorkloadSpec, synthetic_source, write_workload
+
+FILTERS = ["stages.RobotsFilterStage",
+           "stages.KnownRobotsFilterStage",
+           "stages.AssetsFilterStage",
+           "stages.DoubleClickFilterStage",
+           "stages.MetricsFilterStage",
+           "stages.AggByItemFilterStage",
+           "stages.IdentifierFilterStage"]
+
+FAKE_S3_BUCKET = 'usage-stats-benchmark'
+
+## workload read by the benchmark input stage
+_workload = {}
+
+
+def _stages():
+    # imported on demand so the orchestrating process stays light
+    from processorpipeline import UsageStatsData
+    from stages import ElasticOutputStage, S3ParquetInputStage
+
+    class SyntheticInputStage(S3ParquetInputStage):
+        """ The input stage reading the synthetic datasets, the source comes from the spec instead of the db """
+
+        def __init__(self, configContext):
+            super().__init__(configContext)
+            self.visits_path = _workload['visits_path']
+            self.events_path = _workload['events_path']
+
+        def _load_source(self, data: UsageStatsData):
+            data.source = _workload['source']
+            return data.source
+
+    class DocumentsOutputStage(ElasticOutputStage):
+
+        # nothing is indexed, every benchmark run processes the data
+        PERSISTS_RESULT = False
+
+        def run(self, data: UsageStatsData) -> UsageStatsData:
+            data.documents = self.build_documents(data)
+            return data
+
+    return SyntheticInputStage, DocumentsOutputStage
+
+
+def parse_size(value):
+    """ 10k, 2.5M, 50M or plain numbers """
+    multipliers = {'k': 10 ** 3, 'm': 10 ** 6}
+    value = value.strip().lower()
+    if value[-1] in multipliers:
+        return int(float(value[:-1]) * multipliers[value[-1]])
+    return int(value)
+
+
+def run_single(args):
+    """ Run the pipeline for one size and return the result dict """
+    spec = WorkloadSpec(events=args['single'], seed=args['seed'], bot_ratio=args['bot_ratio'],
+                        identifiers=args['identifiers'], asset_ratio=args['asset_ratio'])
+
+    if args['storage'] == 's3':
+        # the s3 code path (awswrangler) against the in-process fake
+        context = storage.fake_s3([FAKE_S3_BUCKET])
+        output = 's3://%s/usage-stats' % FAKE_S3_BUCKET
+    else:
+        context = contextlib.nullcontext()
+        output = tempfile.mkdtemp(prefix='usage_stats_bench_')
+
+    with context:
+        return _run_pipeline(args, spec, output)
+
+
+def _run_pipeline(args, spec, output):
+    from configcontext import ConfigurationContext
+    from processorpipeline import UsageStatsProcessorPipeline
+
+    start = time.perf_counter()
+    if args['storage'] == 's3':
+        # the fake s3 lives in this process
+        visits_path, events_path = write_workload(spec, output)
+    else:
+        # generated by a forked process, the peak memory of the generation is not the one of the pipeline
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('fork')) as executor:
+            visits_path, events_path = executor.submit(write_workload, spec, output).result()
+    generation_seconds = time.perf_counter() - start
+
+    _workload.update({'source': synthetic_source(spec), 'visits_path': visits_path, 'events_path': events_path})
+
+    module = sys.modules[__name__]
+    module.SyntheticInputStage, module.DocumentsOutputStage = _stages()
+
+    ctx = ConfigurationContext({'config_file_path': args['config_file_path'], 'site': spec.site, 'year': spec.year,
+                                'month': spec.month, 'day': None, 'type': spec.source_type})
+
+    pipeline = UsageStatsProcessorPipeline(ctx, "%s.SyntheticInputStage" % __name__, FILTERS,
+                                           "%s.DocumentsOutputStage" % __name__, workers=args['workers'], engine=args['engine'])
+    data = pipeline.run()
+
+    stages = {}
+    for record in pipeline.getStageMetrics():
+        # the input stage has no rows in, its throughput is measured on the rows it reads
+        rows_in = record['rows_in'].get('events_df') or record['rows_out'].get('events_df', 0)
+        stages[record['stage']] = {
+            'wall_seconds': record['wall_seconds'],
+            'cpu_seconds': record['cpu_seconds'],
+            'rows_in': record['rows_in'],
+            'rows_out': record['rows_out'],
+            'events_per_second': rows_in / record['wall_seconds'] if rows_in and record['wall_seconds'] > 0 else None,
+            'peak_rss_bytes': record['peak_rss_bytes'],
+            'peak_rss_delta_bytes': record['peak_rss_delta_bytes'],
+        }
+
+    return {
+        'events': spec.events,
+        'generation_seconds': generation_seconds,
+        'total_seconds': sum(stage['wall_seconds'] for stage in stages.values()),
+        'events_per_second': spec.events / max(sum(stage['wall_seconds'] for stage in stages.values()), 1e-9),
+        'peak_rss_bytes': max(stage['peak_rss_bytes'] for stage in stages.values()),
+        'documents': len(data.documents) if data is not None and data.documents is not None else 0,
+        'stages': stages,
+    }
+
+
+def run_size(args, size):
+    """ Run one size in a fresh interpreter, peak memory must not leak between sizes """
+    command = [sys.executable, os.path.abspath(__file__), '--single', str(size),
+               '-c', args['config_file_path'], '--seed', str(args['seed']), '--bot_ratio', str(args['bot_ratio']),
+               '--asset_ratio', str(args['asset_ratio']), '--workers', str(args['workers']), '--storage', args['storage'], '--engine', args['engine']]
+    if args['identifiers'] is not None:
+        command += ['--identifiers', str(args['identifiers'])]
+
+    result = subprocess.run(command, capture_output=True, text=True)
+    if result.returncode != 0:
+        print(result.stderr)
+        raise Exception("Benchmark failed for size %d" % size)
+
+    # the result is the last line, stages may print before it
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def print_report(results):
+    stage_names = list(results[0]['stages'].keys())
+    row = '%%-%ds' % max([34] + [len(stage) + 2 for stage in stage_names])
+
+    print("\n" + row % "events/s by stage" + "".join("%14s" % ("{:,}".format(result['events'])) for result in results))
+    for stage in stage_names:
+        values = [result['stages'].get(stage, {}).get('events_per_second') for result in results]
+        print(row % stage + "".join("%14s" % ("{:,.0f}".format(value) if value else "-") for value in values))
+
+    print(row % "total events/s" + "".join("%14s" % "{:,.0f}".format(result['events_per_second']) for result in results))
+    print(row % "total seconds" + "".join("%14.2f" % result['total_seconds'] for result in results))
+    print(row % "peak rss MB" + "".join("%14.1f" % (result['peak_rss_bytes'] / 1024 / 1024) for result in results))
+
+
+def compare(results, baseline, tolerance):
+    """ Print the throughput ratio against the baseline, return the regressions """
+    regressions = []
+    baseline_by_size = dict((result['events'], result) for result in baseline['results'])
+
+    for result in results:
+        reference = baseline_by_size.get(result['events'])
+        if reference is None:
+            continue
+        for stage, stats in result['stages'].items():
+            before = reference['stages'].get(stage, {}).get('wall_seconds')
+            # sub 50ms stages are too noisy to compare
+            if not before or max(before, stats['wall_seconds']) < 0.05:
+                continue
+            ratio = stats['wall_seconds'] / before
+            flag = ''
+            if ratio > 1 + tolerance:
+                flag = '  REGRESSION'
+                regressions.append((result['events'], stage, ratio))
+            print("%12s %-34s %6.2fx%s" % ("{:,}".format(result['events']), stage, ratio, flag))
+
+    return regressions
+
+
+def plot(results, path):
+    try:
+        import matplotlib
+    except ImportError:
+        print("matplotlib is not installed, the scaling curves are not plotted")
+        return
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    sizes = [result['events'] for result in results]
+    figure, axis = plt.subplots(figsize=(10, 6))
+    for stage in results[0]['stages'].keys():
+        values = [result['stages'].get(stage, {}).get('events_per_second') for result in results]
+        if any(values):
+            axis.plot(sizes, values, marker='o', label=stage)
+    axis.set_xscale('log')
+    axis.set_xlabel('events')
+    axis.set_ylabel('events/s')
+    axis.legend()
+    figure.savefig(path)
+
+
+def main(args):
+    if args['single'] is not None:
+        print(json.dumps(run_single(args)))
+        return
+
+    results = []
+    for size in args['sizes']:
+        print("Running %s events..." % "{:,}".format(size))
+        results.append(run_size(args, size))
+
+    print_report(results)
+
+    if args['plot'] is not None:
+        plot(results, args['plot'])
+
+    if args['save_baseline'] is not None:
+        with open(args['save_baseline'], 'w') as file:
+            json.dump({'created': time.strftime('%Y-%m-%d %H:%M:%S'), 'results': results}, file, indent=2)
+        print("Baseline written to %s" % args['save_baseline'])
+
+    if args['baseline'] is not None:
+        with open(args['baseline']) as file:
+            baseline = json.load(file)
+        print("\nWall time against %s" % args['baseline'])
+        if compare(results, baseline, args['tolerance']):
+            sys.exit(1)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Usage stats pipeline benchmark suite")
+    parser.add_argument("-c", "--config_file_path", default='config.ini', help="config file")
+    parser.add_argument("--sizes", default=[10000, 100000, 1000000], type=parse_size, nargs='+', help="events per run, e.g. 10k 1M 50M")
+    parser.add_argument("--seed", default=42, type=int, help="random seed")
+    parser.add_argument("--bot_ratio", default=0.1, type=float, help="share of robot visits")
+    parser.add_argument("--identifiers", default=None, type=int, help="distinct identifiers")
+    parser.add_argument("--asset_ratio", default=0.05, type=float, help="share of events on asset urls")
+    parser.add_argument("-w", "--workers", default=1, type=int, help="workers for the sharded stages")
+    parser.add_argument("--engine", default='pandas', choices=['pandas', 'duckdb'], help="engine for the filter/aggregation stages")
+    parser.add_argument("--storage", default='file', choices=['file', 's3'], help="local files or the in-process fake s3 (needs moto)")
+    parser.add_argument("--save_baseline", default=None, help="write the results as baseline file")
+    parser.add_argument("--baseline", default=None, help="compare against a baseline file, exit 1 on regressions")
+    parser.add_argument("--tolerance", default=0.2, type=float, help="allowed wall time growth before flagging a regression")
+    parser.add_argument("--plot", default=None, help="write the scaling curves to a png file")
+    parser.add_argument("--single", default=None, type=int, help=argparse.SUPPRESS)
+    return vars(parser.parse_args())
+
+
+if __name__ == "__main__":
+    main(parse_args())
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the sharded execution of the filter/aggregation stages.
+
+Runs Robots -> Assets -> Metrics -> AggByItem over synthetic visits/events with an
+increasing number of worker processes and prints the speedup over the single process path.
+
+    python benchmarks/sharded_pipeline.py -c config.ini --events 2000000 --workers 1 2 4 8
+"""
+
+import argparse
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from configcontext import ConfigurationContext
+from processorpipeline import AbstractUsageStatsPipelineStage, UsageStatsData, UsageStatsProcessorPipeline
+
+FILTERS = ["stages.RobotsFilterStage",
+           "stages.AssetsFilterStage",
+           "stages.MetricsFilterStage",
+           "stages.AggByItemFilterStage"]
+
+## synthetic frames served by the input stage
+_frames = {}
+
+
+class SyntheticInputStage(AbstractUsageStatsPipelineStage):
+
+    def run(self, data: UsageStatsData) -> UsageStatsData:
+        data.source = SimpleNamespace(type='L', country_iso='AR')
+        data.events_df = _frames['events'].copy()
+        data.visits_df = _frames['visits'].copy()
+        return data
+
+
+class NullOutputStage(AbstractUsageStatsPipelineStage):
+
+    def run(self, data: UsageStatsData) -> UsageStatsData:
+        return data
+
+
+def build_frames(ctx, events, seed=42):
+    rng = np.random.default_rng(seed)
+
+    visits = max(1, events // 4)
+    idvisit = np.arange(1, visits + 1)
+    first_action = pd.Timestamp('2024-01-01') + pd.to_timedelta(rng.integers(0, 30 * 86400, visits), unit='s')
+
+    visits_df = pd.DataFrame({
+        ctx.getLabel('ID_VISIT'): idvisit,
+        'visit_first_action_time': first_action,
+        'visit_last_action_time': first_action + pd.to_timedelta(rng.integers(0, 600, visits), unit='s'),
+        'visit_total_actions': rng.integers(1, 40, visits),
+        ctx.getLabel('COUNTRY'): rng.choice(['AR', 'BR', 'CL', 'MX', 'PE'], visits),
+    })
+
+    identifiers = np.array(['oai:repo:%d' % i for i in range(max(1, events // 10))], dtype=object)
+    events_df = pd.DataFrame({
+        ctx.getLabel('ID_VISIT'): rng.choice(idvisit, events),
+        'server_time': pd.Timestamp('2024-01-01') + pd.to_timedelta(rng.integers(0, 30 * 86400, events), unit='s'),
+        ctx.getLabel('OAI_IDENTIFIER'): identifiers[rng.integers(0, len(identifiers), events)],
+        ctx.getLabel('ACTION_TYPE'): rng.choice(ctx.getActionsId()[:3], events),
+        'action_url': np.where(rng.random(events) < 0.05, 'http://repo/thumb.pdf.jpg', 'http://repo/item'),
+        ctx.getLabel('COUNTRY'): 'AR',
+    })
+
+    return events_df, visits_df
+
+
+def main(args):
+    ctx = ConfigurationContext(args)
+    _frames['events'], _frames['visits'] = build_frames(ctx, args['events'])
+
+    print("events: %d visits: %d" % (len(_frames['events']), len(_frames['visits'])))
+
+    baseline = None
+    for workers in args['workers']:
+        pipeline = UsageStatsProcessorPipeline(ctx, "__main__.SyntheticInputStage", FILTERS,
+                                               "__main__.NullOutputStage", workers=workers)
+        start = time.perf_counter()
+        data = pipeline.run()
+        elapsed = time.perf_counter() - start
+
+        baseline = baseline or elapsed
+        print("workers: %2d  time: %8.2fs  speedup: %5.2fx  identifiers: %d" % (workers, elapsed, baseline / elapsed, len(data.agg_dict)))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Sharded pipeline benchmark")
+    parser.add_argument("-c", "--config_file_path", default='config.ini', help="config file", required=False)
+    parser.add_argument("--events", default=1000000, type=int, help="number of synthetic events")
+    parser.add_argument("--workers", default=[1, 2, 4, 8], type=int, nargs='+', help="worker counts to compare")
+    return vars(parser.parse_args())
+
+
+if __name__ == "__main__":
+    main(parse_args())
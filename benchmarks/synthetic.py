@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Deterministic generator of Matomo-like visits/events data.
+
+The frames have the raw columns written by matomo2parquet.py, so they can be written as a
+hive partitioned dataset (idsite/year/month) to a file:// or s3:// uri and read back by the
+input stage.
+
+    python benchmarks/synthetic.py --events 1000000 --output file:///tmp/usage-stats --bot_ratio 0.1
+"""
+
+import argparse
+import os
+import sys
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import storage
+
+ACTION_VIEW = 1
+ACTION_OUTLINK = 2
+ACTION_DOWNLOAD = 3
+
+DEFAULT_COUNTRIES = {'AR': 0.3, 'BR': 0.25, 'MX': 0.15, 'CL': 0.1, 'CO': 0.1, 'PE': 0.05, 'ES': 0.05}
+
+PARTITION_COLUMNS = ['idsite', 'year', 'month']
+
+## user agents of the visits, the crawlers also come from their published ip range
+BROWSER_USER_AGENTS = ['Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/%d.0 Safari/537.36',
+                       'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.%d Safari/605.1.15',
+                       'Mozilla/5.0 (X11; Linux x86_64; rv:%d.0) Gecko/20100101 Firefox/%d.0']
+CRAWLER_USER_AGENTS = ['Mozilla/5.0 (compatible; Googlebot/2.1; +http://www.google.com/bot.html)',
+                       'Mozilla/5.0 (compatible; bingbot/2.0; +http://www.bing.com/bingbot.htm)',
+                       'python-requests/2.31.0']
+CRAWLER_NETWORK = (66 << 24) | (249 << 16) | (64 << 8)
+
+
+class WorkloadSpec:
+    """ Shape of a synthetic site/month """
+
+    def __init__(self, events=100000, site=1, year=2024, month=1, seed=42, bot_ratio=0.1,
+                 identifiers=None, countries=None, asset_ratio=0.05, source_type='L', crawler_ratio=0.02):
+        self.events = int(events)
+        self.site = site
+        self.year = year
+        self.month = month
+        self.seed = seed
+        # share of the visits made by robots (many fast actions, removed by ROBOTS_FILTER)
+        self.bot_ratio = bot_ratio
+        # number of distinct identifiers, by default one every 10 events
+        self.identifiers = int(identifiers) if identifiers else max(1, self.events // 10)
+        self.countries = countries or DEFAULT_COUNTRIES
+        # share of events on asset urls (thumbnails, removed by ASSETS_FILTER)
+        self.asset_ratio = asset_ratio
+        self.source_type = source_type
+        # share of the visits with a crawler user agent and ip but human pacing (removed by KNOWN_ROBOTS_FILTER)
+        self.crawler_ratio = crawler_ratio
+
+
+def parse_countries(value):
+    """ Parse a country mix like AR:0.5,BR:0.3,CL:0.2 """
+    countries = {}
+    for item in value.split(','):
+        country, weight = item.split(':')
+        countries[country.strip()] = float(weight)
+    return countries
+
+
+def synthetic_source(spec: WorkloadSpec, country_iso='AR'):
+    """ Stand-in for the source row of the usage stats database """
+    return SimpleNamespace(type=spec.source_type, country_iso=country_iso,
+                           identifier_map_type=0, identifier_map_regex=None, identifier_map_replace=None,
+                           identifier_map_filename=None, identifier_prefix=None)
+
+
+def generate(spec: WorkloadSpec):
+    """ Return (visits_df, events_df) for the spec, identical for identical specs """
+    rng = np.random.default_rng(spec.seed)
+
+    # actions per visit: humans browse a few items, robots crawl many items fast
+    mean_actions = (1 - spec.bot_ratio) * 3 + spec.bot_ratio * 120
+    visits = max(1, int(spec.events / mean_actions * 1.2) + 10)
+
+    while True:
+        is_bot = rng.random(visits) < spec.bot_ratio
+        actions = np.where(is_bot, rng.integers(20, 220, visits), rng.geometric(0.4, visits).clip(1, 10))
+        if actions.sum() >= spec.events:
+            break
+        visits *= 2
+
+    # keep the visits needed to reach the number of events, the last one is truncated
+    cumulative = np.cumsum(actions)
+    visits = int(np.searchsorted(cumulative, spec.events) + 1)
+    actions = actions[:visits].copy()
+    is_bot = is_bot[:visits]
+    actions[-1] -= cumulative[visits - 1] - spec.events
+
+    idvisit = np.arange(1, visits + 1, dtype=np.int64) + spec.site * 10 ** 9
+
+    month_start = pd.Timestamp(year=spec.year, month=spec.month, day=1)
+    month_seconds = month_start.days_in_month * 86400
+
+    seconds_per_action = np.where(is_bot, rng.uniform(0.2, 1.5, visits), rng.uniform(5, 120, visits))
+    duration = (seconds_per_action * actions).astype(np.int64)
+    first_action = month_start + pd.to_timedelta(rng.integers(0, month_seconds - 3600, visits), unit='s')
+
+    country_names = np.array(list(spec.countries.keys()), dtype=object)
+    country_weights = np.array(list(spec.countries.values()), dtype=float)
+    country_weights = country_weights / country_weights.sum()
+
+    visits_df = pd.DataFrame({
+        'idvisit': idvisit,
+        'visit_first_action_time': first_action,
+        'visit_last_action_time': first_action + pd.to_timedelta(duration, unit='s'),
+        'visit_total_actions': actions.astype(np.int64),
+        'location_country': country_names[rng.choice(len(country_names), visits, p=country_weights)],
+    })
+
+    # user agents and packed ips (location_ip), from their own generator so the other columns do not change
+    agents_rng = np.random.default_rng([spec.seed, 1])
+    is_crawler = agents_rng.random(visits) < spec.crawler_ratio
+    versions = agents_rng.integers(100, 130, visits)
+    browsers = agents_rng.integers(0, len(BROWSER_USER_AGENTS), visits)
+    crawlers = agents_rng.integers(0, len(CRAWLER_USER_AGENTS), visits)
+    ips = np.where(is_crawler, CRAWLER_NETWORK + agents_rng.integers(0, 1 << 13, visits),
+                   agents_rng.integers(1 << 24, 223 << 24, visits))
+    visits_df['user_agent'] = [CRAWLER_USER_AGENTS[crawler] if crawler_visit else BROWSER_USER_AGENTS[browser].replace('%d', str(version))
+                               for crawler_visit, crawler, browser, version in zip(is_crawler, crawlers, browsers, versions)]
+    visits_df['location_ip'] = [int(ip).to_bytes(4, 'big') for ip in ips]
+
+    events = int(actions.sum())
+    event_visit = np.repeat(np.arange(visits), actions)
+    offsets = (rng.random(events) * np.repeat(duration, actions)).astype(np.int64)
+
+    # identifier popularity follows a zipf like distribution
+    ranks = rng.zipf(1.3, events) % spec.identifiers
+    identifiers = np.array(['oai:repository.example.org:%d' % i for i in range(spec.identifiers)], dtype=object)
+    event_identifiers = identifiers[ranks]
+
+    action_type = rng.choice([ACTION_VIEW, ACTION_DOWNLOAD, ACTION_OUTLINK], events, p=[0.7, 0.25, 0.05])
+
+    item_urls = np.char.add('https://repository.example.org/items/', ranks.astype(str)).astype(object)
+    asset_urls = np.char.add('https://repository.example.org/bitstream/', ranks.astype(str)).astype(object) + '/thumb_1.pdf.jpg'
+    is_asset = rng.random(events) < spec.asset_ratio
+
+    events_df = pd.DataFrame({
+        'idlink_va': np.arange(1, events + 1, dtype=np.int64),
+        'idvisit': idvisit[event_visit],
+        'server_time': first_action[event_visit] + pd.to_timedelta(offsets, unit='s'),
+        'custom_var_v1': event_identifiers,
+        'custom_var_v6': event_identifiers,
+        'custom_var_v2': np.char.add(country_names[rng.choice(len(country_names), events, p=country_weights)].astype(str), '_record').astype(object),
+        'action_type': action_type.astype(np.int64),
+        'action_url': np.where(is_asset, asset_urls, item_urls),
+        'action_url_prefix': np.int64(2),
+    })
+
+    return visits_df, events_df
+
+
+def write_dataset(df, path, spec: WorkloadSpec, day=None):
+    """ Write a frame as a hive partitioned parquet dataset like matomo2parquet.py does """
+    df = df.copy()
+    df['idsite'] = spec.site
+    df['year'] = spec.year
+    df['month'] = spec.month
+
+    partition_cols = list(PARTITION_COLUMNS)
+    if day is not None:
+        df['day'] = day
+        partition_cols.append('day')
+
+    storage.write_parquet(df, path, partition_cols, mode=storage.MODE_OVERWRITE_PARTITIONS)
+
+
+def write_workload(spec: WorkloadSpec, output):
+    """ Generate and write the visits and events datasets under the output uri, return their uris """
+    visits_df, events_df = generate(spec)
+
+    if '://' not in output:
+        output = 'file://' + os.path.abspath(output)
+    visits_path = output.rstrip('/') + '/visits'
+    events_path = output.rstrip('/') + '/events'
+
+    write_dataset(visits_df, visits_path, spec)
+    write_dataset(events_df, events_path, spec)
+
+    return visits_path, events_path
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Synthetic Matomo visits/events generator")
+    parser.add_argument("--output", required=True, help="file:// or s3:// uri (or local directory) for the visits/ and events/ datasets")
+    parser.add_argument("--events", default=100000, type=int, help="number of events")
+    parser.add_argument("-s", "--site", default=1, type=int, help="site id")
+    parser.add_argument("-y", "--year", default=2024, type=int, help="year")
+    parser.add_argument("-m", "--month", default=1, type=int, help="month")
+    parser.add_argument("--seed", default=42, type=int, help="random seed")
+    parser.add_argument("--bot_ratio", default=0.1, type=float, help="share of robot visits")
+    parser.add_argument("--identifiers", default=None, type=int, help="distinct identifiers")
+    parser.add_argument("--countries", default=None, type=parse_countries, help="country mix, e.g. AR:0.5,BR:0.5")
+    parser.add_argument("--asset_ratio", default=0.05, type=float, help="share of events on asset urls")
+    parser.add_argument("--crawler_ratio", default=0.02, type=float, help="share of human paced visits of known crawlers")
+    return vars(parser.parse_args())
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    output = args.pop('output')
+    spec = WorkloadSpec(**args)
+    visits_path, events_path = write_workload(spec, output)
+    print("Visits: %s\nEvents: %s" % (visits_path, events_path))
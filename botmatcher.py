@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Matchers of the known robot user agents and ip ranges of KnownRobotsFilterStage.
+
+The user agent patterns are case insensitive substrings compiled once into an Aho-Corasick
+automaton, a user agent is scanned once whatever the number of patterns. The ip ranges (CIDR,
+first-last or single addresses, IPv4 and IPv6) are merged into sorted disjoint intervals searched
+by bisection. User agents and ips repeat heavily across visits, so both matchers decide every
+distinct value once and keep the decision for the next frames of the process.
+"""
+
+import bisect
+import ipaddress
+from abc import abstractmethod, ABC
+
+import numpy as np
+
+
+def read_list(path):
+    """ Non empty lines of a list file, lines starting with # are comments """
+    with open(path, encoding='utf-8') as file:
+        return [line.strip() for line in file if line.strip() != '' and not line.strip().startswith('#')]
+
+
+class MemoizedMatcher(ABC):
+    """ Vectorized matching of a column whose values repeat, every distinct value is decided once """
+
+    def __init__(self):
+        self.memo = {}
+
+    @abstractmethod
+    def matches(self, value):
+        pass
+
+    def matches_many(self, values):
+        """ Decisions of the values not decided yet """
+        return [bool(self.matches(value)) for value in values]
+
+    def match_values(self, values):
+        """ Boolean array, True for the values that match """
+        import pandas as pd
+
+        codes, uniques = pd.factorize(pd.Series(values, dtype=object), use_na_sentinel=True)
+        uniques = uniques.tolist()
+
+        memo = self.memo
+        known = [memo.get(value) for value in uniques]
+        new = [position for position, decision in enumerate(known) if decision is None]
+        if new:
+            for position, decision in zip(new, self.matches_many([uniques[position] for position in new])):
+                known[position] = memo[uniques[position]] = decision
+
+        decisions = np.zeros(len(uniques) + 1, dtype=bool)
+        decisions[:len(uniques)] = known
+
+        # the missing values (code -1) take the last slot, never a robot
+        return decisions[codes]
+
+
+class UserAgentMatcher(MemoizedMatcher):
+    """ Aho-Corasick automaton of case insensitive substrings """
+
+    def __init__(self, patterns):
+        super().__init__()
+
+        # the trie: transitions and whether a pattern ends at (or, by the fail links, inside) every state
+        self._goto = [{}]
+        self._accept = [False]
+        for pattern in patterns:
+            state = 0
+            for char in pattern.lower():
+                next_state = self._goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self._goto)
+                    self._goto[state][char] = next_state
+                    self._goto.append({})
+                    self._accept.append(False)
+                state = next_state
+            self._accept[state] = True
+
+        # the fail links, breadth first
+        self._fail = [0] * len(self._goto)
+        queue = list(self._goto[0].values())
+        for state in queue:
+            for char, next_state in self._goto[state].items():
+                fail = self._fail[state]
+                while fail != 0 and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(char, 0)
+                self._accept[next_state] = self._accept[next_state] or self._accept[self._fail[next_state]]
+                queue.append(next_state)
+
+        # the transitions of the automaton as a dfa, completed lazily with the fail links
+        self._delta = [dict(transitions) for transitions in self._goto]
+
+    def _transition(self, state, char):
+        target = state
+        while target != 0 and char not in self._goto[target]:
+            target = self._fail[target]
+        self._delta[state][char] = self._goto[target].get(char, 0)
+        return self._delta[state][char]
+
+    def matches(self, value):
+        if not isinstance(value, str):
+            value = value.decode('utf-8', 'replace') if isinstance(value, bytes) else str(value)
+
+        delta, accept = self._delta, self._accept
+        state = 0
+        for char in value.lower():
+            next_state = delta[state].get(char)
+            state = next_state if next_state is not None else self._transition(state, char)
+            if accept[state]:
+                return True
+        return False
+
+
+def parse_ip(value):
+    """ (version, integer) of an address given as text or as the packed bytes matomo stores, None if invalid """
+    try:
+        if isinstance(value, (bytes, bytearray)):
+            address = ipaddress.ip_address(bytes(value))
+        else:
+            address = ipaddress.ip_address(str(value).strip())
+    except ValueError:
+        return None
+    return address.version, int(address)
+
+
+def parse_range(text):
+    """ (version, first, last) of a CIDR network, a first-last range or a single address """
+    if '-' in text:
+        first, last = (ipaddress.ip_address(part.strip()) for part in text.split('-', 1))
+        if first.version != last.version or first > last:
+            raise ValueError("Invalid ip range %s" % text)
+        return first.version, int(first), int(last)
+
+    network = ipaddress.ip_network(text.strip(), strict=False)
+    return network.version, int(network.network_address), int(network.broadcast_address)
+
+
+class IPRangeMatcher(MemoizedMatcher):
+    """ Interval index of ip ranges: sorted disjoint intervals per ip version, searched by bisection """
+
+    def __init__(self, ranges):
+        super().__init__()
+
+        intervals = {4: [], 6: []}
+        for text in ranges:
+            version, first, last = parse_range(text)
+            intervals[version].append((first, last))
+
+        # overlapping and adjacent ranges are merged, so at most one interval can hold an address
+        self._starts, self._ends = {}, {}
+        for version, pairs in intervals.items():
+            starts, ends = [], []
+            for first, last in sorted(pairs):
+                if ends and first <= ends[-1] + 1:
+                    ends[-1] = max(ends[-1], last)
+                else:
+                    starts.append(first)
+                    ends.append(last)
+            self._starts[version], self._ends[version] = starts, ends
+
+    def matches_many(self, values):
+        # the packed IPv4 addresses are searched at once
+        packed = [position for position, value in enumerate(values) if isinstance(value, bytes) and len(value) == 4]
+        if len(packed) < len(values):
+            decisions = super().matches_many(values)
+        else:
+            decisions = [False] * len(values)
+
+        if packed:
+            numbers = np.frombuffer(b''.join(values[position] for position in packed), dtype='>u4').astype(np.int64)
+            starts, ends = np.array(self._starts[4], dtype=np.int64), np.array(self._ends[4], dtype=np.int64)
+            interval = np.searchsorted(starts, numbers, side='right') - 1
+            inside = (interval >= 0) & (numbers <= ends[np.maximum(interval, 0)]) if len(starts) > 0 else np.zeros(len(numbers), dtype=bool)
+            for position, decision in zip(packed, inside.tolist()):
+                decisions[position] = decision
+        return decisions
+
+    def matches(self, value):
+        address = parse_ip(value)
+        if address is None:
+            return False
+        version, number = address
+        position = bisect.bisect_right(self._starts[version], number) - 1
+        return position >= 0 and number <= self._ends[version][position]
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Stage boundary checkpoints of the pipeline data as local Arrow IPC files.
+
+After the chosen stages the data object is written to <dir>/site_<s>_<y>_<m>_<d>/<config hash>/<n>_<Stage>/:
+every frame as an Arrow IPC (feather) file, the aggregate dict as the table of aggutils and the
+remaining values (source, countries by identifier, ...) pickled. A failed run restarts with --resume
+from the last checkpoint of the same config, and --replay_from runs a captured checkpoint through
+the stages after it (offline, e.g. under --profile).
+"""
+
+import logging
+import os
+import pickle
+import shutil
+import tempfile
+
+from runcache import PERIOD_ARGS, RunCache, fingerprint
+
+logger = logging.getLogger()
+
+PROCESSING = 'PROCESSING'
+CHECKPOINT_DIR = 'CHECKPOINT_DIR'
+CHECKPOINT_STAGES = 'CHECKPOINT_STAGES'
+
+## directory used when stages are chosen but PROCESSING.CHECKPOINT_DIR is empty
+DEFAULT_DIR_NAME = 'usage_stats_checkpoints'
+
+FRAME_SUFFIX = '.arrow'
+AGG_FILE = 'agg_dict.arrow'
+## values that are neither frames nor the aggregate, plus the name of the stage
+STATE_FILE = 'state.pickle'
+
+
+def _stage_list(value):
+    if value is None:
+        return []
+    if isinstance(value, str):
+        value = value.split(',')
+    return [name.strip() for name in value if name.strip() != '']
+
+
+def save_data(path, data, stage, agg_layout):
+    """ Write the data object to the checkpoint directory path, replaced atomically """
+    import pandas as pd
+    import pyarrow as pa
+    from pyarrow import feather
+    from aggutils import agg_dict_to_table
+
+    parent = os.path.dirname(path)
+    os.makedirs(parent, exist_ok=True)
+    tmp_path = tempfile.mkdtemp(dir=parent, suffix='.tmp')
+
+    state = {'stage': stage, 'values': {}}
+    for name, value in data.items():
+        if isinstance(value, pd.DataFrame):
+            feather.write_feather(pa.Table.from_pandas(value, preserve_index=False), os.path.join(tmp_path, name + FRAME_SUFFIX))
+        elif name == 'agg_dict':
+            feather.write_feather(agg_dict_to_table(value, *agg_layout), os.path.join(tmp_path, AGG_FILE))
+        else:
+            state['values'][name] = value
+
+    with open(os.path.join(tmp_path, STATE_FILE), 'wb') as file:
+        pickle.dump(state, file)
+
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp_path, path)
+
+
+def load_data(path, agg_layout):
+    """ Read a checkpoint directory back, returns (stage name, data object) """
+    from pyarrow import feather
+    from aggutils import agg_table_to_dict
+    from processorpipeline import UsageStatsData
+
+    with open(os.path.join(path, STATE_FILE), 'rb') as file:
+        state = pickle.load(file)
+
+    data = UsageStatsData()
+    for name, value in state['values'].items():
+        setattr(data, name, value)
+
+    for file_name in sorted(os.listdir(path)):
+        if file_name == AGG_FILE:
+            data.agg_dict = agg_table_to_dict(feather.read_table(os.path.join(path, file_name)), *agg_layout)
+        elif file_name.endswith(FRAME_SUFFIX):
+            setattr(data, file_name[:-len(FRAME_SUFFIX)], feather.read_table(os.path.join(path, file_name)).to_pandas())
+
+    return state['stage'], data
+
+
+class StageCheckpoints:
+    """
+    Checkpoints of one site/period run of a stage chain (the input stage followed by the filters).
+    Positions are indexes in the chain, the checkpoint at a position holds the data after that stage.
+    """
+
+    def __init__(self, directory, chain, selected, agg_layout):
+        self.directory = directory
+        self.chain = list(chain)
+        self.selected = set(selected)
+        self.agg_layout = agg_layout
+
+        unknown = self.selected - set(self.chain)
+        if unknown:
+            raise Exception("Unknown checkpoint stages %s, the pipeline stages are %s" % (', '.join(sorted(unknown)), ', '.join(self.chain)))
+
+    def from_context(configContext, chain):
+        """
+        Checkpoints of the run of the context, None when no stage is chosen (--checkpoint_after or
+        PROCESSING.CHECKPOINT_STAGES) and the run does not resume
+        """
+        args = configContext.getArgs()
+        selected = _stage_list(args.get('checkpoint_after'))
+        if not selected and configContext.hasConfig(PROCESSING, CHECKPOINT_STAGES):
+            selected = _stage_list(configContext.getConfig(PROCESSING, CHECKPOINT_STAGES))
+
+        if not selected and not args.get('resume', False):
+            return None
+
+        directory = ''
+        if configContext.hasConfig(PROCESSING, CHECKPOINT_DIR):
+            directory = configContext.getConfig(PROCESSING, CHECKPOINT_DIR).strip()
+        if directory == '':
+            directory = os.path.join(tempfile.gettempdir(), DEFAULT_DIR_NAME)
+
+        # a checkpoint is only valid for the same config and stage chain
+        config_hash = fingerprint({'stages': list(chain), 'config': RunCache.config_components(configContext)})[:16]
+        period = 'site_%s_%s_%s_%s' % tuple(args.get(arg) for arg in PERIOD_ARGS)
+
+        agg_layout = (configContext.getActions(), configContext.getLabel('STATS_BY_COUNTRY'))
+        return StageCheckpoints(os.path.join(directory, period, config_hash), chain, selected, agg_layout)
+
+    def path(self, position):
+        return os.path.join(self.directory, '%02d_%s' % (position, self.chain[position]))
+
+    def wants(self, first, last):
+        """ True if a chosen stage is in the positions first..last, which run as one block """
+        return any(name in self.selected for name in self.chain[first:last + 1])
+
+    def save(self, position, data):
+        path = self.path(position)
+        save_data(path, data, self.chain[position], self.agg_layout)
+        logger.info('Checkpoint after %s written to %s' % (self.chain[position], path))
+
+    def latest(self):
+        """ (position, data) of the last checkpoint of the chain, None when there is none """
+        for position in reversed(range(len(self.chain))):
+            if os.path.exists(os.path.join(self.path(position), STATE_FILE)):
+                _, data = load_data(self.path(position), self.agg_layout)
+                logger.info('Resuming after %s from %s' % (self.chain[position], self.path(position)))
+                return position, data
+        return None
+
+    def clear(self):
+        """ Remove the checkpoints of the run, called when the output stage succeeded """
+        shutil.rmtree(self.directory, ignore_errors=True)
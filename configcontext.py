@@ -5,7 +5,7 @@ import logging
 logger = logging.getLogger()
 
 import configparser
-from lareferenciastatsdb import UsageStatsDatabaseHelper
+from metadatacache import MetadataCache
 
 GENERAL = 'GENERAL'
 LABELS = 'LABELS'
@@ -43,7 +43,8 @@ class ConfigurationContext:
          logger.error("No GENERAL section in configuration file")
          raise Exception("No GENERAL section in configuration file")
       
-      self.dbhelper = UsageStatsDatabaseHelper(self._config)
+      # memoized metadata lookups, the database helper is created on the first miss
+      self.dbhelper = MetadataCache.shared(self._config)
       
    
 
@@ -61,6 +62,18 @@ class ConfigurationContext:
          raise Exception("Option %s not found" % option)
 
       return self._config[section][option]
+
+   def hasConfig(self, section, option):
+      return section in self._config.sections() and option in self._config[section]
+
+   def hasSection(self, section):
+      return section in self._config.sections()
+
+   def getSection(self, section):
+      if section not in self._config.sections():
+         raise Exception("Section %s not found" % section)
+
+      return dict(self._config[section])
    
    def getArg(self, name):
 
@@ -69,6 +82,9 @@ class ConfigurationContext:
       else:
          return self._commandLineArgs[name]
    
+   def getArgs(self):
+      return dict(self._commandLineArgs)
+   
    def getActions(self):
       return self.actions
    
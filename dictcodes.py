@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Dictionary encoding of the identifier and country columns of the pipeline frames.
+
+The input stage turns the strings into pandas categoricals once: int32 codes plus one dictionary
+per kind of value, shared by every column holding it (the country of the events and of the visits).
+The filters group, join and count on the codes and the strings of a dictionary are only read for
+the distinct values that reach the aggregate.
+"""
+
+import numpy as np
+import pandas as pd
+
+
+def encode(frames, column):
+    """
+    Encode the column of every frame (the ones that have it) with a shared dictionary, in place.
+    The columns are factorized and their codes remapped to the shared dictionary, the strings of
+    the rows are never materialized as python objects.
+    """
+    frames = [frame for frame in frames if frame is not None and column in frame.columns]
+    if len(frames) == 0:
+        return
+
+    encoded = [codes(frame[column]) for frame in frames]
+    dtype = pd.CategoricalDtype(pd.unique(np.concatenate([values for _, values in encoded])))
+
+    for frame, (frame_codes, values) in zip(frames, encoded):
+        # the code of every value of the frame in the shared dictionary, the missing values (-1) take the last slot
+        remap = np.append(dtype.categories.get_indexer(values), -1).astype(np.int32)
+        frame[column] = pd.Categorical.from_codes(remap[frame_codes], dtype=dtype)
+
+
+def codes(column):
+    """
+    (integer codes, dictionary values) of a column, -1 for the missing values. The codes of a
+    categorical are taken as they are, any other column is factorized.
+    """
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        return column.cat.codes.to_numpy(), column.cat.categories.to_numpy()
+    codes, values = pd.factorize(column)
+    return codes, np.asarray(values)
+
+
+def decode(values, code):
+    """ Value of a code of a dictionary, None for the missing value """
+    return values[code] if code >= 0 else None
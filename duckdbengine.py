@@ -0,0 +1,326 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+DuckDB execution engine for the filter/aggregate chain.
+
+The leading Robots -> KnownRobots -> Assets -> DoubleClick -> Metrics -> AggByItem stages are
+compiled into one SQL query run by an embedded, multi-threaded DuckDB directly over the parquet
+partitions of the input stage. The distinct user agents/ips of the visits are classified in
+Python by the matchers of KnownRobotsFilterStage and joined as tables. The aggregate is fetched in arrow batches and rebuilt as the agg_dict the rest of the
+pipeline (IdentifierFilterStage, ElasticOutputStage, ...) consumes.
+"""
+
+import io
+import logging
+import tokenize
+
+import pyarrow as pa
+
+import storage
+from aggutils import COUNTRY_COLUMN, IDENTIFIER_COLUMN, TOTAL_COLUMN, add_sketches, agg_table_to_dict, merge_agg_dicts
+from lareferenciastatsdb import SOURCE_TYPE_REGIONAL
+
+logger = logging.getLogger()
+
+DUCKDB = 'DUCKDB'
+THREADS = 'THREADS'
+MEMORY_LIMIT = 'MEMORY_LIMIT'
+
+## table of the robot values of the n-th KnownRobotsFilterStage column
+KNOWN_ROBOTS_TABLE = 'known_robots_%d'
+
+## rows per arrow batch fetched from the aggregate query
+FETCH_BATCH_ROWS = 100000
+
+## pandas query operators and their sql equivalent
+QUERY_OPERATORS = {
+    'and': 'AND', 'or': 'OR', 'not': 'NOT', '&': 'AND', '|': 'OR', '~': 'NOT',
+    '==': '=', '!=': '<>', '<': '<', '<=': '<=', '>': '>', '>=': '>=',
+    '(': '(', ')': ')', '+': '+', '-': '-', '*': '*', '/': '/',
+}
+
+
+def quote(name):
+    return '"%s"' % name.replace('"', '""')
+
+
+def literal(value):
+    if value is None:
+        return 'NULL'
+    return "'%s'" % str(value).replace("'", "''")
+
+
+def pandas_query_to_sql(expression):
+    """
+    Translate a DataFrame.query expression (ROBOTS_FILTER QUERY_STR) into a sql condition.
+    Only column names, numbers, strings, comparisons and boolean/arithmetic operators are supported.
+    """
+    sql = []
+    try:
+        tokens = list(tokenize.generate_tokens(io.StringIO(expression.strip()).readline))
+    except tokenize.TokenError as e:
+        raise Exception("Invalid query expression %s: %s" % (expression, e))
+
+    for token in tokens:
+        if token.type in (tokenize.NEWLINE, tokenize.NL, tokenize.ENDMARKER):
+            continue
+        if token.type == tokenize.NAME and token.string.lower() in QUERY_OPERATORS:
+            sql.append(QUERY_OPERATORS[token.string.lower()])
+        elif token.type == tokenize.NAME and token.string in ('True', 'False'):
+            sql.append(token.string.upper())
+        elif token.type == tokenize.NAME:
+            sql.append(quote(token.string))
+        elif token.type == tokenize.NUMBER:
+            sql.append(token.string)
+        elif token.type == tokenize.STRING:
+            sql.append(literal(eval(token.string)))
+        elif token.type == tokenize.OP and token.string in QUERY_OPERATORS:
+            sql.append(QUERY_OPERATORS[token.string])
+        else:
+            raise Exception("Unsupported token %s in query expression %s" % (token.string, expression))
+
+    return ' '.join(sql)
+
+
+class DuckDBEngine:
+    """
+    Runs the compilable leading filters of a pipeline as a single DuckDB query.
+    The input stage must be an S3ParquetInputStage (it provides the dataset paths and the source).
+    """
+
+    def __init__(self, configContext, input_stage, filters):
+        from stages import AggByItemFilterStage, AssetsFilterStage, DoubleClickFilterStage, KnownRobotsFilterStage, MetricsFilterStage, RobotsFilterStage, S3ParquetInputStage
+
+        if not isinstance(input_stage, S3ParquetInputStage):
+            raise Exception("The duckdb engine needs an S3ParquetInputStage input, got %s" % type(input_stage).__name__)
+
+        ## the compilable stages, in the order the query applies them
+        order = [RobotsFilterStage, KnownRobotsFilterStage, AssetsFilterStage, DoubleClickFilterStage, MetricsFilterStage, AggByItemFilterStage]
+
+        # the longest leading run of filters in that order, up to the aggregation
+        self.stages = []
+        for filter in filters:
+            if type(filter) not in order or (len(self.stages) > 0 and order.index(type(filter)) <= order.index(type(self.stages[-1]))):
+                break
+            self.stages.append(filter)
+            if type(filter) is AggByItemFilterStage:
+                break
+
+        if len(self.stages) == 0 or type(self.stages[-1]) is not AggByItemFilterStage \
+                or not any(type(stage) is MetricsFilterStage for stage in self.stages):
+            raise Exception("The duckdb engine compiles [Robots] -> [KnownRobots] -> [Assets] -> [DoubleClick] -> Metrics -> AggByItem, got %s"
+                            % ', '.join(type(filter).__name__ for filter in filters))
+
+        self._configContext = configContext
+        self.input_stage = input_stage
+        self.robots = next((stage for stage in self.stages if type(stage) is RobotsFilterStage), None)
+        self.known_robots = next((stage for stage in self.stages if type(stage) is KnownRobotsFilterStage and stage.enabled), None)
+        self.assets = next((stage for stage in self.stages if type(stage) is AssetsFilterStage), None)
+        self.double_click = next((stage for stage in self.stages if type(stage) is DoubleClickFilterStage), None)
+
+        self.actions = configContext.getActions()
+        self.actions_id = configContext.getActionsId()
+
+        self.COUNTRY_LABEL = configContext.getLabel('COUNTRY')
+        self.STATS_BY_COUNTRY_LABEL = configContext.getLabel('STATS_BY_COUNTRY')
+        self.OAI_IDENTIFIER_LABEL = configContext.getLabel('OAI_IDENTIFIER')
+        self.ACTION_TYPE_LABEL = configContext.getLabel('ACTION_TYPE')
+        self.ID_VISIT_LABEL = configContext.getLabel('ID_VISIT')
+
+        def _option(option):
+            value = configContext.getConfig(DUCKDB, option).strip() if configContext.hasConfig(DUCKDB, option) else ''
+            return value if value != '' else None
+
+        # missing options keep the duckdb defaults (all the cores, 80% of the memory)
+        self.threads = int(_option(THREADS)) if _option(THREADS) is not None else None
+        self.memory_limit = _option(MEMORY_LIMIT)
+
+    def _dataset(self, path, columns):
+        ## read_parquet over the partitions of the run, partition values compared as strings
+        scheme, location = storage.split_uri(path)
+        glob = '%s://%s/**/*.parquet' % (scheme, location.rstrip('/')) if scheme == storage.SCHEME_S3 else location.rstrip('/') + '/**/*.parquet'
+
+        conditions = []
+        for partition in ('site', 'year', 'month', 'day'):
+            value = self._configContext.getArg(partition)
+            if value is not None:
+                conditions.append('%s = %s' % (quote('idsite' if partition == 'site' else partition), literal(value)))
+
+        return "(SELECT %s FROM read_parquet(%s, hive_partitioning = true, hive_types_autocast = false, filename = true, file_row_number = true) WHERE %s)" % (
+            ', '.join(columns), literal(glob), ' AND '.join(conditions) if conditions else 'TRUE')
+
+    def compile(self, source):
+        """ Return the (aggregate, country by identifier, visits by identifier and country) queries for the source """
+        from stages import S3ParquetInputStage
+
+        identifier_var = S3ParquetInputStage._identifier_custom_var(source.type)
+        record_info = quote(S3ParquetInputStage.RECORD_INFO_CUSTOM_VAR)
+
+        # the country of the event, like S3ParquetInputStage._prepare_events
+        if source.type == SOURCE_TYPE_REGIONAL:
+            event_country = 'CASE WHEN length(%s) > 2 THEN left(%s, 2) ELSE NULL END' % (record_info, record_info)
+        else:
+            event_country = literal(source.country_iso)
+
+        idvisit = quote(self.ID_VISIT_LABEL)
+        identifier = quote(self.OAI_IDENTIFIER_LABEL)
+        country = quote(self.COUNTRY_LABEL)
+
+        visits = self._dataset(self.input_stage.visits_path, [
+            'idvisit AS %s' % idvisit, 'visit_last_action_time', 'visit_first_action_time', 'visit_total_actions',
+            'location_country AS %s' % country] + [quote(column) for column in self._known_robots_columns()])
+
+        # RobotsFilterStage: total/avg action time and the visits query (nan compares as false, like pandas)
+        robots_condition = pandas_query_to_sql(self.robots.QUERY) if self.robots is not None else 'TRUE'
+
+        # KnownRobotsFilterStage: the robot user agents/ips are registered as tables by run
+        for position, column in enumerate(self._known_robots_columns()):
+            robots_condition = '(%s) AND (%s IS NULL OR %s NOT IN (SELECT value FROM %s))' % (
+                robots_condition, quote(column), quote(column), KNOWN_ROBOTS_TABLE % position)
+        visits_sql = """
+            visits_timed AS (
+                SELECT *, epoch(visit_last_action_time) - epoch(visit_first_action_time) AS total_time FROM %s
+            ),
+            visits AS (
+                SELECT * FROM (
+                    SELECT *, CASE WHEN isnan(total_time / visit_total_actions) THEN NULL ELSE total_time / visit_total_actions END AS avg_action_time
+                    FROM visits_timed
+                ) WHERE %s
+            )""" % (visits, robots_condition)
+
+        events = self._dataset(self.input_stage.events_path, [
+            'idvisit AS %s' % idvisit, '%s AS %s' % (quote(identifier_var), identifier), 'action_type AS %s' % quote(self.ACTION_TYPE_LABEL),
+            'action_url', 'server_time', '%s AS event_country' % event_country, 'filename', 'file_row_number'])
+
+        # AssetsFilterStage: re.match over the lowercased last 9 chars of the url
+        assets_condition = 'TRUE'
+        if self.assets is not None:
+            assets_condition = "NOT regexp_matches(lower(right(coalesce(CAST(action_url AS VARCHAR), 'None'), 9)), %s)" % literal('^(?:%s)' % self.assets.REGEX)
+
+        events_sql = """
+            events AS (
+                SELECT * FROM %s WHERE %s IN (SELECT %s FROM visits) AND %s
+            )""" % (events, idvisit, idvisit, assets_condition)
+
+        # DoubleClickFilterStage: drop the events followed by the same action on the item of the visit within the window
+        if self.double_click is not None:
+            action_type = quote(self.ACTION_TYPE_LABEL)
+            repeated = 'next_time IS NOT NULL AND epoch_ns(next_time) - epoch_ns(server_time) <= %d' % int(self.double_click.window_seconds * 1e9)
+            if len(self.double_click.action_types) > 0:
+                repeated += ' AND %s IN (%s)' % (action_type, ', '.join(str(action) for action in self.double_click.action_types))
+            events_sql = """
+            events_clicked AS (
+                SELECT * FROM %s WHERE %s IN (SELECT %s FROM visits) AND %s
+            ),
+            events AS (
+                SELECT * EXCLUDE (next_time) FROM (
+                    SELECT *, lead(server_time) OVER (PARTITION BY %s, %s, %s ORDER BY server_time, filename, file_row_number) AS next_time
+                    FROM events_clicked
+                ) WHERE NOT (%s)
+            )""" % (events, idvisit, idvisit, assets_condition, idvisit, identifier, action_type, repeated)
+
+        # MetricsFilterStage: one flag per action type, max per (visit, identifier), joined with the visit
+        flags = ['max(CAST(%s = %d AS INTEGER)) AS %s' % (quote(self.ACTION_TYPE_LABEL), action_id, quote(action))
+                 for action, action_id in zip(self.actions, self.actions_id) if action_id > 0]
+        flagged = [action for action, action_id in zip(self.actions, self.actions_id) if action_id > 0]
+
+        derived = []
+        for action in self.actions:
+            if action in flagged:
+                continue
+            if action == 'conversions':
+                derived.append('CAST(views = 1 AND (downloads = 1 OR outlinks = 1) AS INTEGER) AS conversions')
+            else:
+                derived.append('0 AS %s' % quote(action))
+
+        items_sql = """
+            by_visit AS (
+                SELECT %s, %s, %s FROM events WHERE %s IS NOT NULL GROUP BY %s, %s
+            ),
+            items AS (
+                SELECT by_visit.*, %s visits.%s AS %s FROM by_visit JOIN visits USING (%s)
+            )""" % (idvisit, identifier, ', '.join(flags), identifier, idvisit, identifier,
+                    ''.join('%s, ' % expression for expression in derived), country, quote(COUNTRY_COLUMN), idvisit)
+
+        # AggByItemFilterStage: rows with the action > 0 by identifier and by (identifier, country)
+        counters = ', '.join('sum(CAST(%s > 0 AS BIGINT)) AS %s' % (quote(action), quote(action)) for action in self.actions)
+        aggregate = """
+            WITH %s, %s, %s
+            SELECT %s AS %s, %s, grouping(%s) = 1 AS %s, %s
+            FROM items GROUP BY GROUPING SETS ((%s, %s), (%s))
+        """ % (visits_sql, events_sql, items_sql, identifier, quote(IDENTIFIER_COLUMN), quote(COUNTRY_COLUMN), quote(COUNTRY_COLUMN),
+               quote(TOTAL_COLUMN), counters, identifier, quote(COUNTRY_COLUMN), identifier)
+
+        # MetricsFilterStage country_by_identifier_dict: the last non empty event country of every identifier
+        countries = """
+            WITH %s, %s
+            SELECT %s AS key, last(event_country ORDER BY filename, file_row_number) AS value
+            FROM events WHERE event_country IS NOT NULL AND event_country <> '' GROUP BY %s
+        """ % (visits_sql, events_sql, identifier, identifier)
+
+        # the (visit, identifier, country) rows of AggByItemFilterStage, for the unique visitor sketches
+        visitors = """
+            WITH %s, %s, %s
+            SELECT %s AS %s, %s, %s FROM items
+        """ % (visits_sql, events_sql, items_sql, identifier, quote(IDENTIFIER_COLUMN), quote(COUNTRY_COLUMN), idvisit)
+
+        return aggregate, countries, visitors
+
+    def _known_robots_columns(self):
+        return self.known_robots.visits_columns() if self.known_robots is not None else []
+
+    def _register_known_robots(self, connection):
+        ## the distinct user agents/ips of the visits are classified by the matchers of the stage
+        for position, (column, matcher) in enumerate(self.known_robots._matchers() if self.known_robots is not None else []):
+            result = connection.execute('SELECT DISTINCT %s AS value FROM %s' % (quote(column), self._dataset(self.input_stage.visits_path, [quote(column)])))
+            values = result.to_arrow_table() if hasattr(result, 'to_arrow_table') else result.fetch_arrow_table()
+            robots = values.filter(pa.array(matcher.match_values(values.column('value').to_numpy(zero_copy_only=False))))
+            connection.register(KNOWN_ROBOTS_TABLE % position, robots)
+            logger.info('DuckDB known robots: %d of %d distinct %s' % (len(robots), len(values), column))
+
+    def _connect(self):
+        import duckdb
+
+        connection = duckdb.connect()
+        if self.threads is not None:
+            connection.execute('SET threads = %d' % self.threads)
+        if self.memory_limit is not None:
+            connection.execute('SET memory_limit = %s' % literal(self.memory_limit))
+
+        if storage.SCHEME_S3 in (storage.split_uri(self.input_stage.visits_path)[0], storage.split_uri(self.input_stage.events_path)[0]):
+            connection.execute('INSTALL httpfs')
+            connection.execute('LOAD httpfs')
+            connection.execute('CREATE OR REPLACE SECRET usage_stats_s3 (TYPE s3, PROVIDER credential_chain)')
+
+        return connection
+
+    def run(self, data):
+        source = self.input_stage._load_source(data)
+        aggregate, countries, visitors = self.compile(source)
+
+        connection = self._connect()
+        try:
+            self._register_known_robots(connection)
+
+            data.country_by_identifier_dict = dict(connection.execute(countries).fetchall())
+
+            # the aggregate is streamed in arrow batches and merged into the agg dict
+            data.agg_dict = {}
+            result = connection.execute(aggregate)
+            # to_arrow_reader replaces fetch_record_batch in duckdb >= 1.4
+            reader = result.to_arrow_reader(FETCH_BATCH_ROWS) if hasattr(result, 'to_arrow_reader') else result.fetch_record_batch(FETCH_BATCH_ROWS)
+            for batch in reader:
+                partial = agg_table_to_dict(pa.Table.from_batches([batch]), self.actions, self.STATS_BY_COUNTRY_LABEL)
+                merge_agg_dicts(data.agg_dict, partial)
+
+            # the sketches of every batch of rows are merged into the entries
+            result = connection.execute(visitors)
+            reader = result.to_arrow_reader(FETCH_BATCH_ROWS) if hasattr(result, 'to_arrow_reader') else result.fetch_record_batch(FETCH_BATCH_ROWS)
+            for batch in reader:
+                add_sketches(data.agg_dict, batch.column(0).to_pandas(), batch.column(1).to_pandas(), batch.column(2).to_numpy(),
+                             self.STATS_BY_COUNTRY_LABEL)
+        finally:
+            connection.close()
+
+        logger.info('DuckDB aggregated %d identifiers' % len(data.agg_dict))
+        return data
@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Persistent, memory-mapped index of the identifier map files (old,new csv lines) used by
+IdentifierFilterStage with IDENTIFIER_MAP_FROM_FILE.
+
+The csv is compiled once into an arrow IPC file holding the keys sorted by a 64 bit hash.
+Later runs memory-map the file (zero copy, one copy in the page cache shared by every worker
+process) and resolve all the identifiers of an aggregate with one vectorized searchsorted.
+The index is rebuilt when the size/mtime of the csv changes and its sha256 differs.
+
+IdentifierMemo keeps, in the same layout, the normalized identifiers of a source across runs.
+"""
+
+import glob
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+HASH_COLUMN = 'hash'
+KEY_COLUMN = 'key'
+VALUE_COLUMN = 'value'
+
+## bump when the layout of the index file changes
+INDEX_VERSION = 1
+
+DEFAULT_CACHE_DIR = os.path.join(tempfile.gettempdir(), 'usage_stats_identifier_maps')
+
+## indexes already mapped by this process, by index path
+_loaded = {}
+
+
+def hash_identifiers(identifiers):
+    """ Stable (across processes) 64 bit hashes of a sequence of strings """
+    return pd.util.hash_array(np.asarray(identifiers, dtype=object), categorize=False)
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def parse_map_file(path):
+    """ Read the csv map like IdentifierFilterStage always did, the last line of a key wins """
+    mapping = {}
+    with open(path, 'r') as file:
+        for line in file:
+            key, value = line.split(',')
+            mapping[key.strip()] = value.strip()
+    return mapping
+
+
+def index_table(keys, values):
+    """ Arrow table of the index layout, the rows sorted by the hash of the key """
+    keys = np.asarray(keys, dtype=object)
+    values = np.asarray(values, dtype=object)
+    hashes = hash_identifiers(keys)
+    order = np.argsort(hashes, kind='stable')
+
+    return pa.table({
+        HASH_COLUMN: pa.array(hashes[order], type=pa.uint64()),
+        KEY_COLUMN: pa.array(keys[order], type=pa.string()),
+        VALUE_COLUMN: pa.array(values[order], type=pa.string()),
+    })
+
+
+def write_index(table, index_path):
+    """ Write an index table atomically """
+    tmp_path = '%s.%d.tmp' % (index_path, os.getpid())
+    # uncompressed and in one batch, so the columns can be mapped as they are
+    with pa.OSFile(tmp_path, 'wb') as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table, max_chunksize=max(1, table.num_rows))
+    os.replace(tmp_path, index_path)
+
+
+class IdentifierMapIndex:
+    """ A memory-mapped identifier map, see the module docstring """
+
+    def __init__(self, index_path):
+        self.index_path = index_path
+        with pa.memory_map(index_path, 'r') as source:
+            table = pa.ipc.open_file(source).read_all()
+        self.table = table
+
+        # the hash column is a zero copy view over the mapped file
+        self._hashes = table.column(HASH_COLUMN).combine_chunks().to_numpy()
+        self._keys = table.column(KEY_COLUMN).combine_chunks()
+        self._values = table.column(VALUE_COLUMN).combine_chunks()
+
+    def __len__(self):
+        return len(self._hashes)
+
+    def lookup(self, identifiers):
+        """ Mapped value of every identifier, None for the identifiers missing in the map """
+        identifiers = list(identifiers)
+        result = [None] * len(identifiers)
+        if len(identifiers) == 0 or len(self._hashes) == 0:
+            return result
+
+        # sorted needles walk the mapped hashes in order, several times faster than random probes
+        hashes = hash_identifiers(identifiers)
+        order = np.argsort(hashes)
+        left = np.empty(len(hashes), dtype=np.int64)
+        right = np.empty(len(hashes), dtype=np.int64)
+        left[order] = np.searchsorted(self._hashes, hashes[order], side='left')
+        right[order] = np.searchsorted(self._hashes, hashes[order], side='right')
+
+        # one candidate per hash (the usual case): compare the keys and take the values in bulk
+        single = np.nonzero(right - left == 1)[0]
+        if len(single) > 0:
+            positions = pa.array(left[single])
+            keys = self._keys.take(positions).to_numpy(zero_copy_only=False)
+            values = self._values.take(positions).to_pylist()
+            wanted = np.asarray(identifiers, dtype=object)[single]
+            for i, key, value, identifier in zip(single, keys, values, wanted):
+                if key == identifier:
+                    result[i] = value
+
+        # hash collisions in the map, compare every candidate
+        for i in np.nonzero(right - left > 1)[0]:
+            for position in range(left[i], right[i]):
+                if self._keys[position].as_py() == identifiers[i]:
+                    result[i] = self._values[position].as_py()
+                    break
+
+        return result
+
+    def build(map_path, index_path, sha256=None, mapping=None):
+        """ Compile the csv map into the index file, written atomically. mapping skips parsing the csv when the caller has it """
+        if mapping is None:
+            mapping = parse_map_file(map_path)
+
+        table = index_table(list(mapping.keys()), list(mapping.values()))
+        write_index(table, index_path)
+
+        stat = os.stat(map_path)
+        IdentifierMapIndex._write_meta(index_path, {
+            'version': INDEX_VERSION, 'map_path': os.path.abspath(map_path), 'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns, 'sha256': sha256 or file_sha256(map_path), 'entries': table.num_rows,
+        })
+
+    def _write_meta(index_path, meta):
+        tmp_path = '%s.meta.%d.tmp' % (index_path, os.getpid())
+        with open(tmp_path, 'w') as file:
+            json.dump(meta, file)
+        os.replace(tmp_path, index_path + '.meta')
+
+    def _read_meta(index_path):
+        try:
+            with open(index_path + '.meta') as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    def index_path(map_path, cache_dir):
+        # one index per csv path, the cache can be shared by several maps
+        name = hashlib.sha1(os.path.abspath(map_path).encode('utf-8')).hexdigest()
+        return os.path.join(cache_dir, '%s_%s.arrow' % (os.path.basename(map_path), name[:16]))
+
+    def load(map_path, cache_dir=None):
+        """ Return the index of the csv map, building or rebuilding it when the csv changed """
+        cache_dir = cache_dir or DEFAULT_CACHE_DIR
+        os.makedirs(cache_dir, exist_ok=True)
+
+        index_path = IdentifierMapIndex.index_path(map_path, cache_dir)
+        stat = os.stat(map_path)
+        meta = IdentifierMapIndex._read_meta(index_path)
+
+        fresh = meta is not None and meta.get('version') == INDEX_VERSION and os.path.exists(index_path)
+
+        if fresh and (meta['size'], meta['mtime_ns']) != (stat.st_size, stat.st_mtime_ns):
+            # touched or copied again: the index stays valid if the content did not change
+            sha256 = file_sha256(map_path)
+            fresh = sha256 == meta['sha256']
+            if fresh:
+                meta.update({'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns})
+                IdentifierMapIndex._write_meta(index_path, meta)
+        else:
+            sha256 = None
+
+        # reuse the index mapped by this process unless another process rebuilt the file
+        loaded = _loaded.get(index_path)
+        if fresh and loaded is not None and loaded[0] == meta['sha256']:
+            return loaded[1]
+
+        if not fresh:
+            print("Building identifier map index %s" % index_path)
+            IdentifierMapIndex.build(map_path, index_path, sha256)
+            meta = IdentifierMapIndex._read_meta(index_path)
+
+        index = IdentifierMapIndex(index_path)
+        _loaded[index_path] = (meta['sha256'], index)
+        return index
+
+
+class IdentifierMemo:
+    """
+    Persistent old -> new identifier memo of a source, in the same memory-mapped layout as the maps.
+    The file name carries a signature of the rewrite rules, a change of the rules starts a new memo.
+    """
+
+    def __init__(self, cache_dir, name, signature):
+        self.cache_dir = cache_dir or DEFAULT_CACHE_DIR
+        self.name = name
+        self.path = os.path.join(self.cache_dir, 'memo_%s_%s.arrow' % (name, signature[:16]))
+        self._pending_keys = []
+        self._pending_values = []
+
+        try:
+            self._index = IdentifierMapIndex(self.path) if os.path.exists(self.path) else None
+        except (OSError, pa.ArrowInvalid):
+            # a broken memo is only a cache, start over
+            self._index = None
+
+    def __len__(self):
+        return len(self._index) if self._index is not None else 0
+
+    def lookup(self, identifiers):
+        if self._index is None:
+            return [None] * len(identifiers)
+        return self._index.lookup(identifiers)
+
+    def add(self, identifiers, new_identifiers):
+        self._pending_keys.extend(identifiers)
+        self._pending_values.extend(new_identifiers)
+
+    def save(self):
+        """ Merge the new entries into the memo file, the sort runs in arrow without python objects """
+        if len(self._pending_keys) == 0:
+            return
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        table = index_table(self._pending_keys, self._pending_values)
+        if self._index is not None:
+            table = pa.concat_tables([self._index.table, table])
+            table = table.take(pc.sort_indices(table, sort_keys=[(HASH_COLUMN, 'ascending')]))
+
+        write_index(table, self.path)
+
+        # memos of older rules of the same source are not used anymore
+        for path in glob.glob(os.path.join(self.cache_dir, 'memo_%s_*.arrow' % self.name)):
+            if path != self.path:
+                os.remove(path)
+
+        self._index = IdentifierMapIndex(self.path)
+        self._pending_keys, self._pending_values = [], []
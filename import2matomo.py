@@ -1,22 +1,38 @@
 import argparse
+import asyncio
 import gzip
 import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import FIRST_EXCEPTION, ProcessPoolExecutor, wait
+
 import requests
 import json
 
-logging.basicConfig(level=logging.DEBUG,
-                    format='%(asctime)s - %(levelname)s - %(message)s',
-                    handlers=[
-                        logging.FileHandler("matomo_events.log"),
-                        logging.StreamHandler()
-                    ])
+## seconds between two checkpoint writes / progress lines of the async replay
+CHECKPOINT_INTERVAL = 5.0
+PROGRESS_INTERVAL = 10.0
+
 
 def parse_arguments():
     parser = argparse.ArgumentParser(description='Send events to Matomo from a text file.')
-    parser.add_argument('file_path', type=str, help='Path to the file containing events')
+    parser.add_argument('file_path', type=str, nargs='+', help='Path to the files containing events')
     parser.add_argument('matomo_url', type=str, help='Matomo server URL')
     parser.add_argument('--batch_size', type=int, default=100, help='Number of events to send in each batch')
     parser.add_argument('--debug', action='store_true', help='Enable debug mode')
+    parser.add_argument('--async', dest='use_async', action='store_true', help='Send the batches concurrently with an asyncio http client')
+    parser.add_argument('--concurrency', type=int, default=8, help='Batches in flight at the same time (--async)')
+    parser.add_argument('--gzip', action='store_true', help='Send gzip compressed request bodies (--async)')
+    parser.add_argument('--adaptive', action='store_true', help='Adapt the batch size to the observed latency (--async)')
+    parser.add_argument('--target_latency', type=float, default=1.0, help='Batch latency in seconds the adaptive batch size aims for')
+    parser.add_argument('--max_batch_size', type=int, default=5000, help='Upper bound of the adaptive batch size')
+    parser.add_argument('--max_retries', type=int, default=3, help='Retries of a failed batch before stopping the replay (--async)')
+    parser.add_argument('--checkpoint', type=str, default=None, help='File keeping the acknowledged offsets, an interrupted replay resumes from it (--async)')
+    parser.add_argument('--workers', type=int, default=1, help='Replay processes, several files or more than one worker use the sharded async replay')
+    parser.add_argument('--shards', type=int, default=None, help='Shards the files are split in (default 4 per worker)')
+    parser.add_argument('--rate', type=float, default=None, help='Lines per second shared by all the replay processes')
+    parser.add_argument('--checkpoint_dir', type=str, default=None, help='Directory keeping the shards and their checkpoints (sharded replay)')
     return parser.parse_args()
 
 
@@ -85,13 +101,416 @@ def send_events_to_matomo(file_path, base_url, batch_size):
 
     logging.info(f"Finished processing all events. Total lines: {request_count}, Total tracked: {total_tracked}, Total invalid: {total_invalid}")
 
+def open_events(file_path, offset=0):
+    """ Binary file object of an events file at offset, offsets of .gz files are in the decompressed stream """
+    file = gzip.open(file_path, 'rb') if file_path.endswith('.gz') else open(file_path, 'rb')
+    if offset:
+        file.seek(offset)
+    return file
+
+
+class ReplayCheckpoint:
+    """
+    Acknowledged lines of a replay. offset is the watermark: every line before it was accepted by
+    Matomo. Batches acknowledged out of order are kept as [start, end) ranges above the watermark,
+    a resumed replay skips them so every line is sent exactly once.
+    """
+
+    def __init__(self, path, file_path, start=0, interval=CHECKPOINT_INTERVAL):
+        self.path = path
+        self.file_path = os.path.abspath(file_path)
+        self.interval = interval
+        self.offset = start
+        self.done = {}
+        self.lines = 0
+        self.tracked = 0
+        self.invalid = 0
+        self._saved = time.monotonic()
+
+        if path is not None and os.path.exists(path):
+            with open(path) as file:
+                state = json.load(file)
+            if state['file'] != self.file_path:
+                raise ValueError("Checkpoint %s belongs to %s" % (path, state['file']))
+            self.offset = state['offset']
+            self.done = {start: end for start, end in state['done']}
+            self.lines = state['lines']
+            self.tracked = state['tracked']
+            self.invalid = state['invalid']
+
+    def ack(self, start, end, lines, tracked, invalid):
+        self.done[start] = end
+        self.lines += lines
+        self.tracked += tracked
+        self.invalid += invalid
+
+        while self.offset in self.done:
+            self.offset = self.done.pop(self.offset)
+
+        if time.monotonic() - self._saved >= self.interval:
+            self.save()
+
+    def save(self):
+        self._saved = time.monotonic()
+        if self.path is None:
+            return
+
+        state = {'file': self.file_path, 'offset': self.offset, 'done': sorted(self.done.items()),
+                 'lines': self.lines, 'tracked': self.tracked, 'invalid': self.invalid}
+        with open(self.path + '.tmp', 'w') as file:
+            json.dump(state, file)
+        os.replace(self.path + '.tmp', self.path)
+
+
+class BatchSizer:
+    """
+    Batch size of the replay. When adaptive it grows by step while the batches are acknowledged
+    within target_latency and is halved when they are slower or fail (AIMD).
+    """
+
+    def __init__(self, size, adaptive=False, target_latency=1.0, min_size=10, max_size=5000):
+        self.adaptive = adaptive
+        self.target_latency = target_latency
+        self.min_size = min(min_size, size)
+        self.max_size = max(max_size, size)
+        self.step = max(1, size // 4)
+        self.size = size
+
+    def update(self, latency, ok=True):
+        if not self.adaptive:
+            return
+        if ok and latency <= self.target_latency:
+            self.size = min(self.max_size, self.size + self.step)
+        else:
+            self.size = max(self.min_size, self.size // 2)
+
+
+def read_batches(file, offset, skip, sizer, end=None):
+    """
+    (start, end, lines) of the events from offset to end (the lines starting before it), the
+    acknowledged ranges in skip are not read again
+    """
+    start = position = offset
+    lines = []
+
+    while end is None or position < end:
+        if position in skip:
+            if lines:
+                yield start, position, lines
+                lines = []
+            while position in skip:
+                position = skip[position]
+            file.seek(position)
+            start = position
+            continue
+
+        line = file.readline()
+        if not line:
+            break
+        position += len(line)
+
+        line = line.strip()
+        if line:
+            lines.append(line.decode('utf-8'))
+            if len(lines) >= sizer.size:
+                yield start, position, lines
+                start, lines = position, []
+        elif not lines:
+            start = position
+
+    if lines:
+        yield start, position, lines
+
+
+class ReplayError(Exception):
+    pass
+
+
+async def post_batch(session, base_url, lines, compress):
+    """ Send one bulk request, returns the Matomo response """
+    body = json.dumps({'requests': lines}).encode('utf-8')
+    headers = {'Content-Type': 'application/json'}
+    if compress:
+        body = gzip.compress(body, compresslevel=1)
+        headers['Content-Encoding'] = 'gzip'
+
+    async with session.post(base_url, data=body, headers=headers) as response:
+        if response.status != 200:
+            raise ReplayError("Status code: %d" % response.status)
+        return await response.json(content_type=None)
+
+
+async def replay_events_async(file_path, base_url, batch_size=100, concurrency=8, compress=False, adaptive=False,
+                              target_latency=1.0, max_batch_size=5000, max_retries=3, checkpoint_path=None, timeout=300,
+                              start=0, end=None, limiter=None, on_ack=None):
+    """
+    Replay the events file with concurrency batches in flight over a pooled connection. Reading and
+    encoding overlap the requests, a batch that still fails after max_retries stops the replay and
+    the checkpoint keeps what was acknowledged. Returns the totals of the replay.
+
+    start/end limit the replay to the lines starting in that byte range, limiter.acquire(lines) is
+    awaited before every request and on_ack(lines, tracked, invalid) called for every acknowledged batch.
+    """
+    import aiohttp
+
+    checkpoint = ReplayCheckpoint(checkpoint_path, file_path, start)
+    sizer = BatchSizer(batch_size, adaptive, target_latency, max_size=max_batch_size)
+    # resumed ranges, checkpoint.done shrinks while the watermark advances
+    skip = dict(checkpoint.done)
+    queue = asyncio.Queue(maxsize=concurrency)
+    failed = []
+    started = time.perf_counter()
+    progress = {'lines': checkpoint.lines, 'time': started}
+
+    if checkpoint.lines:
+        logging.info(f"Resuming {file_path} from offset {checkpoint.offset} ({checkpoint.lines} lines already sent)")
+
+    async def produce():
+        with open_events(file_path, checkpoint.offset) as file:
+            for batch in read_batches(file, checkpoint.offset, skip, sizer, end):
+                if failed:
+                    break
+                await queue.put(batch)
+        for _ in range(concurrency):
+            await queue.put(None)
+
+    async def send(session):
+        while True:
+            batch = await queue.get()
+            if batch is None:
+                return
+            if failed:
+                continue
+
+            batch_start, batch_end, lines = batch
+            for attempt in range(max_retries + 1):
+                if limiter is not None:
+                    await limiter.acquire(len(lines))
+                sent = time.perf_counter()
+                try:
+                    response = await post_batch(session, base_url, lines, compress)
+                except (aiohttp.ClientError, asyncio.TimeoutError, ReplayError) as e:
+                    sizer.update(time.perf_counter() - sent, ok=False)
+                    logging.error(f"Failed to send batch [{batch_start}, {batch_end}) attempt {attempt + 1}: {e!r}")
+                    if attempt < max_retries:
+                        await asyncio.sleep(0.5 * 2 ** attempt)
+                    continue
+
+                sizer.update(time.perf_counter() - sent)
+                tracked, invalid = response.get('tracked', 0), response.get('invalid', 0)
+                checkpoint.ack(batch_start, batch_end, len(lines), tracked, invalid)
+                if on_ack is not None:
+                    on_ack(len(lines), tracked, invalid)
+                _progress()
+                break
+            else:
+                failed.append((batch_start, batch_end))
+
+    def _progress():
+        now = time.perf_counter()
+        if now - progress['time'] >= PROGRESS_INTERVAL:
+            print(f"Processed {checkpoint.lines} requests so far ({(checkpoint.lines - progress['lines']) / (now - progress['time']):.0f}/s, "
+                  f"batch size {sizer.size}, offset {checkpoint.offset}).")
+            progress.update(lines=checkpoint.lines, time=now)
+
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=timeout)) as session:
+        await asyncio.gather(produce(), *[send(session) for _ in range(concurrency)])
+
+    checkpoint.save()
+
+    if failed:
+        logging.error(f"Replay stopped after {max_retries + 1} failed attempts of batch {failed[0]}, "
+                      f"resume it with the checkpoint (acknowledged up to offset {checkpoint.offset}).")
+
+    seconds = time.perf_counter() - started
+    logging.info(f"Finished processing events in {seconds:.1f}s. Total lines: {checkpoint.lines}, "
+                 f"Total tracked: {checkpoint.tracked}, Total invalid: {checkpoint.invalid}")
+
+    return {'lines': checkpoint.lines, 'tracked': checkpoint.tracked, 'invalid': checkpoint.invalid,
+            'offset': checkpoint.offset, 'complete': not failed, 'seconds': seconds}
+
+
+def shard_events(file_paths, shards):
+    """
+    (file_path, start, end) shards of the events files of about the same size. Plain files are
+    split in line aligned byte ranges, a .gz file can only be read from its beginning and is one
+    shard without end.
+    """
+    sizes = {file_path: os.path.getsize(file_path) for file_path in file_paths}
+    target = max(1, sum(sizes.values()) // max(1, shards))
+
+    result = []
+    for file_path in file_paths:
+        size = sizes[file_path]
+        pieces = 1 if file_path.endswith('.gz') else max(1, round(size / target))
+
+        bounds = [0]
+        with open(file_path, 'rb') as file:
+            for piece in range(1, pieces):
+                # the line after the one holding the byte before the cut
+                file.seek(max(size * piece // pieces - 1, bounds[-1]))
+                file.readline()
+                if bounds[-1] < file.tell() < size:
+                    bounds.append(file.tell())
+        bounds.append(size)
+
+        if file_path.endswith('.gz'):
+            # offsets of .gz files are in the decompressed stream, the shard ends with the file
+            bounds[-1] = None
+        result.extend((file_path, start, end) for start, end in zip(bounds[:-1], bounds[1:]))
+
+    return result
+
+
+class SharedRateLimiter:
+    """
+    Lines per second shared by the replay processes: every batch reserves the next free slot of a
+    schedule kept in shared memory and waits for it.
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self._next = multiprocessing.Value('d', 0.0)
+
+    async def acquire(self, lines):
+        # the monotonic clock is system wide, the same in every process
+        with self._next.get_lock():
+            now = time.monotonic()
+            slot = max(now, self._next.value)
+            self._next.value = slot + lines / self.rate
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+
+class ReplayCounters:
+    """ lines, tracked and invalid of all the replay processes """
+
+    def __init__(self):
+        self._values = multiprocessing.Array('q', 3)
+
+    def add(self, lines, tracked, invalid):
+        with self._values.get_lock():
+            self._values[0] += lines
+            self._values[1] += tracked
+            self._values[2] += invalid
+
+    def values(self):
+        with self._values.get_lock():
+            return tuple(self._values)
+
+
+## state of every replay worker, set once by the pool initializer
+_worker_options = None
+_worker_limiter = None
+_worker_counters = None
+
+
+def _init_worker(options, limiter, counters):
+    global _worker_options, _worker_limiter, _worker_counters
+    _worker_options = options
+    _worker_limiter = limiter
+    _worker_counters = counters
+
+
+def _replay_shard(shard):
+    file_path, start, end, checkpoint_path = shard
+    return asyncio.run(replay_events_async(file_path, start=start, end=end, checkpoint_path=checkpoint_path,
+                                           limiter=_worker_limiter, on_ack=_worker_counters.add, **_worker_options))
+
+
+def shard_plan(file_paths, shards, checkpoint_dir):
+    """
+    Shards with their checkpoint files. The plan is kept in checkpoint_dir, a resumed replay reuses
+    it so the shards match their checkpoints whatever the number of workers.
+    """
+    plan_path = os.path.join(checkpoint_dir, 'shards.json') if checkpoint_dir is not None else None
+    if plan_path is not None and os.path.exists(plan_path):
+        with open(plan_path) as file:
+            plan = json.load(file)
+        if sorted({shard[0] for shard in plan}) != sorted(os.path.abspath(file_path) for file_path in file_paths):
+            raise ValueError("The checkpoints in %s belong to other files" % checkpoint_dir)
+        return [tuple(shard) for shard in plan]
+
+    plan = []
+    for number, (file_path, start, end) in enumerate(shard_events(file_paths, shards)):
+        checkpoint_path = None
+        if checkpoint_dir is not None:
+            checkpoint_path = os.path.join(checkpoint_dir, '%04d_%s.checkpoint' % (number, os.path.basename(file_path)))
+        plan.append((os.path.abspath(file_path), start, end, checkpoint_path))
+
+    if plan_path is not None:
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        with open(plan_path, 'w') as file:
+            json.dump(plan, file)
+
+    return plan
+
+
+def replay_events_sharded(file_paths, base_url, workers, rate=None, checkpoint_dir=None, shards=None, **options):
+    """
+    Replay the events files from workers processes, each with its own event loop and connection pool
+    (options are the replay_events_async arguments). The shards share the rate limit (lines/s) and
+    the counters, every shard resumes from its own checkpoint. Returns the totals of the replay.
+    """
+    plan = shard_plan(file_paths, shards or workers * 4, checkpoint_dir)
+    limiter = SharedRateLimiter(rate) if rate else None
+    counters = ReplayCounters()
+    started = time.perf_counter()
+    results = []
+
+    # fork keeps the shared values inherited by the workers
+    context = multiprocessing.get_context('fork')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                             initializer=_init_worker, initargs=(dict(options, base_url=base_url), limiter, counters)) as executor:
+        pending = {executor.submit(_replay_shard, shard) for shard in plan}
+        while pending:
+            done, pending = wait(pending, timeout=PROGRESS_INTERVAL, return_when=FIRST_EXCEPTION)
+            results.extend(future.result() for future in done)
+            lines, tracked, invalid = counters.values()
+            print(f"Replayed {lines} requests in this run, {len(results)}/{len(plan)} shards finished "
+                  f"({lines / (time.perf_counter() - started):.0f}/s, tracked={tracked}, invalid={invalid}).")
+
+    seconds = time.perf_counter() - started
+    complete = all(result['complete'] for result in results)
+    totals = {'lines': sum(result['lines'] for result in results),
+              'tracked': sum(result['tracked'] for result in results),
+              'invalid': sum(result['invalid'] for result in results),
+              'complete': complete, 'seconds': seconds}
+
+    if not complete:
+        logging.error("Some shards stopped after failed batches, run the replay again with the same --checkpoint_dir to resume them.")
+    logging.info(f"Finished processing {len(plan)} shards in {seconds:.1f}s. Total lines: {totals['lines']}, "
+                 f"Total tracked: {totals['tracked']}, Total invalid: {totals['invalid']}")
+
+    return totals
+
+
 if __name__ == "__main__":
-    
+
+    logging.basicConfig(level=logging.DEBUG,
+                        format='%(asctime)s - %(levelname)s - %(message)s',
+                        handlers=[
+                            logging.FileHandler("matomo_events.log"),
+                            logging.StreamHandler()
+                        ])
+
     args = parse_arguments()
 
     if args.debug:
         logging.getLogger().setLevel(logging.DEBUG)
     else:
         logging.getLogger().setLevel(logging.INFO)
-    
-    send_events_to_matomo(args.file_path, args.matomo_url, args.batch_size)
\ No newline at end of file
+
+    if args.workers > 1 or len(args.file_path) > 1:
+        replay_events_sharded(args.file_path, args.matomo_url, args.workers, args.rate, args.checkpoint_dir, args.shards,
+                              batch_size=args.batch_size, concurrency=args.concurrency, compress=args.gzip,
+                              adaptive=args.adaptive, target_latency=args.target_latency,
+                              max_batch_size=args.max_batch_size, max_retries=args.max_retries)
+    elif args.use_async:
+        limiter = SharedRateLimiter(args.rate) if args.rate else None
+        asyncio.run(replay_events_async(args.file_path[0], args.matomo_url, args.batch_size, args.concurrency, args.gzip,
+                                        args.adaptive, args.target_latency, args.max_batch_size, args.max_retries,
+                                        args.checkpoint, limiter=limiter))
+    else:
+        send_events_to_matomo(args.file_path[0], args.matomo_url, args.batch_size)
@@ -9,13 +9,14 @@ import tracemalloc
 
 import pymysql
 import pymysql.cursors
-import awswrangler as wr
 import pandas as pd
 
 import datetime
 
 from config import read_ini, resolve_chunk_size
+from profiling import StageProfiler, profile_section
 from s3logger import S3Logger 
+import storage
 
 # logger for s3
 s3logger = S3Logger('matomo2parquet');
@@ -166,19 +167,18 @@ def process_data_type(query, data_type, conn_params, s3_bucket, partition_cols,
                 chunk_df['month'] = chunk_df['server_time'].dt.month
                 chunk_df['year'] = chunk_df['server_time'].dt.year
             
-            # Write chunk to S3
+            # Write chunk to the dataset (s3:// or file://)
             if not dry_run:
                 # Use 'append' mode to add to existing dataset
                 # First chunk can use 'overwrite_partitions' if needed
                 write_mode = 'append'
                 
-                s3logger.loginfo(f"Writing {data_type} chunk {chunk_num} ({rows_in_chunk} rows) to S3...")
-                wr.s3.to_parquet(
-                    df=chunk_df,
-                    path='s3://' + s3_bucket,
-                    dataset=True,
-                    mode=write_mode,
-                    partition_cols=partition_cols
+                s3logger.loginfo(f"Writing {data_type} chunk {chunk_num} ({rows_in_chunk} rows) to {s3_bucket}...")
+                storage.write_parquet(
+                    chunk_df,
+                    s3_bucket,
+                    partition_cols,
+                    mode=write_mode
                 )
             else:
                 s3logger.loginfo(f"Dry run: would write {data_type} chunk {chunk_num} ({rows_in_chunk} rows)")
@@ -215,6 +215,9 @@ def main(args_dict):
 
     dry_run = args_dict.get('dry_run', False)
     debug_mode = args_dict.get('debug', False)
+
+    # cProfile/tracemalloc dumps of every extraction loop, only with --profile
+    profiler = StageProfiler.from_args(args_dict)
     
     # Start memory tracking if debug mode is enabled
     if debug_mode:
@@ -238,8 +241,9 @@ def main(args_dict):
         s3_events_bucket = config["S3_STATS"]["EVENTS_PATH"]
    
     
-        # logger bucket
-        s3logger.set_bucket(config["S3_LOGS"]["LOGS_PATH"])
+        # logger bucket, the logs of a dry run are not shipped
+        if not dry_run:
+            s3logger.set_bucket(config["S3_LOGS"]["LOGS_PATH"])
         s3logger.loginfo("Starting procesing on datetime: %s site: %s year: %s month: %s day: %s" % ( datetime.datetime.now(), site, year, month, day))
 
 
@@ -333,11 +337,17 @@ def main(args_dict):
     
     # Process visits first (streaming with SSCursor)
     s3logger.loginfo("Processing visits data with streaming...")
-    process_data_type(visit_query, "visits", conn_params, s3_visits_bucket, partition_cols, site, year, month, day, dry_run, debug_mode, chunk_size)
+    with profile_section(profiler, "visits"):
+        process_data_type(visit_query, "visits", conn_params, s3_visits_bucket, partition_cols, site, year, month, day, dry_run, debug_mode, chunk_size)
     
     # Process events separately after visits are processed and memory freed
     s3logger.loginfo("Processing events data with streaming...")
-    process_data_type(event_query, "events", conn_params, s3_events_bucket, partition_cols, site, year, month, day, dry_run, debug_mode, chunk_size)
+    with profile_section(profiler, "events"):
+        process_data_type(event_query, "events", conn_params, s3_events_bucket, partition_cols, site, year, month, day, dry_run, debug_mode, chunk_size)
+
+    # Rewrite the events of the period sorted by identifier, the identifier lookups read only its row groups
+    if not dry_run and config.getboolean("PROCESSING", "SORT_EVENTS", fallback=False):
+        sort_events(config, s3_events_bucket, site, year, month, day)
                        
     log_memory_usage("BEFORE_CLEANUP", debug_mode)
         
@@ -356,6 +366,23 @@ def main(args_dict):
     s3logger.loginfo("Ending procesing on datetime : %s site: %s year: %s month: %s day: %s" % ( datetime.datetime.now(), site, year, month, day))
 
 
+def sort_events(config, events_path, site, year, month, day):
+    """ Sort the events partition of the period by the identifier column of the source type """
+    from metadatacache import MetadataCache
+    from stages import S3ParquetInputStage
+
+    source = MetadataCache.shared(config).get_source_by_site_id(site)
+    if source is None:
+        s3logger.logwarning(f"Site {site} not found in the usage stats db, events not sorted")
+        return
+
+    column = S3ParquetInputStage._identifier_custom_var(source.type)
+    partitions = S3ParquetInputStage._partition_prefix(site, year, month, day)
+
+    s3logger.loginfo(f"Sorting events of site: {site} year: {year} month: {month} day: {day} by {column}...")
+    storage.sort_partitions(events_path, partitions, column)
+
+
 def parse_args():
 
     parser = argparse.ArgumentParser(description="Usage Statistics Matomo mysql to S3 persistence", usage="python3 matomo2s3.py -s <site> -y <year> --from_month <month> --to_month <month> --from_day <day> --to_day <day>")
@@ -412,6 +439,8 @@ def parse_args():
     
     parser.add_argument("--dry_run", action='store_true', help="dont write to s3")
 
+    parser.add_argument("--profile", default=None, type=str, help="directory for cProfile/tracemalloc dumps of the extraction loops", required=False)
+
     args = parser.parse_args()
 
     return args 
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Process wide cache of the usage stats metadata (sources, index names, site ids) in front of
+UsageStatsDatabaseHelper.
+
+Lookups are memoized by key and expire after a TTL. runner.py prefetches the sources of every site
+it is going to process and saves them to a local snapshot file; the processes it launches (and
+the pipeline workers) load the snapshot instead of querying the database, so a task pays no
+metadata round trip. The helper, and its database connection, are only created on a miss.
+"""
+
+import logging
+import os
+import pickle
+import tempfile
+import time
+from types import SimpleNamespace
+
+logger = logging.getLogger()
+
+## seconds a cached value is valid, also for the values loaded from the snapshot
+DEFAULT_TTL = 3600.0
+
+SECTION = 'PROCESSING'
+SNAPSHOT_OPTION = 'METADATA_SNAPSHOT'
+TTL_OPTION = 'METADATA_TTL'
+
+## process wide instance, see MetadataCache.shared
+_shared = None
+
+
+def _option(config, option):
+    """ Value of a PROCESSING option, None when missing or empty """
+    if config is None or not config.has_option(SECTION, option):
+        return None
+    return config.get(SECTION, option).strip() or None
+
+
+def detach(source):
+    """ Plain copy of the loaded attributes of a source row, safe to keep after the session and to pickle """
+    if source is None:
+        return None
+
+    names = [name for name in vars(source) if not name.startswith('_')]
+    # columns of a mapped row, read through getattr so an expired row is loaded
+    columns = getattr(getattr(source, '__table__', None), 'columns', None)
+    if columns is not None:
+        names += [name for name in columns.keys() if name not in names]
+
+    return SimpleNamespace(**{name: getattr(source, name) for name in names})
+
+
+class MetadataCache:
+    """
+    Same lookups as UsageStatsDatabaseHelper (get_source_by_site_id, get_index_name,
+    get_all_site_ids) memoized for ttl seconds. Any other helper method is passed through.
+    """
+
+    def __init__(self, config=None, helper=None, snapshot_path=None, ttl=None):
+        self.config = config
+        self.snapshot_path = snapshot_path if snapshot_path is not None else _option(config, SNAPSHOT_OPTION)
+        self.ttl = float(ttl if ttl is not None else _option(config, TTL_OPTION) or DEFAULT_TTL)
+
+        self._helper = helper
+        # key -> (fetched at, value), the time is wall clock so the snapshot is valid across processes
+        self._values = {}
+        # values fetched since the snapshot was written
+        self._dirty = False
+
+        if self.snapshot_path is not None:
+            self.load_snapshot()
+
+    def shared(config):
+        """ The cache of this process, created on the first call """
+        global _shared
+        if _shared is None:
+            _shared = MetadataCache(config)
+        return _shared
+
+    @property
+    def helper(self):
+        if self._helper is None:
+            from lareferenciastatsdb import UsageStatsDatabaseHelper
+            self._helper = UsageStatsDatabaseHelper(self.config)
+        return self._helper
+
+    def __getattr__(self, name):
+        # only called for the names this class does not define
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.helper, name)
+
+    def _get(self, key, fetch):
+        cached = self._values.get(key)
+        if cached is not None and time.time() - cached[0] < self.ttl:
+            return cached[1]
+
+        value = fetch()
+        self._values[key] = (time.time(), value)
+        self._dirty = True
+        return value
+
+    def get_source_by_site_id(self, site_id):
+        return self._get(('source', int(site_id)), lambda: detach(self.helper.get_source_by_site_id(int(site_id))))
+
+    def get_index_name(self, prefix, site_id):
+        return self._get(('index_name', prefix, int(site_id)), lambda: self.helper.get_index_name(prefix, int(site_id)))
+
+    def get_all_site_ids(self):
+        return list(self._get(('site_ids',), lambda: list(self.helper.get_all_site_ids())))
+
+    def prefetch(self, site_ids=None, index_prefix=None):
+        """
+        Load the sources (and the index names of index_prefix) of site_ids, every site by default,
+        that are not cached or expired. Returns the sources by site id.
+        """
+        if site_ids is None:
+            site_ids = self.get_all_site_ids()
+
+        started = time.perf_counter()
+        sources = {int(site_id): self.get_source_by_site_id(site_id) for site_id in site_ids}
+        if index_prefix is not None:
+            for site_id in sources:
+                self.get_index_name(index_prefix, site_id)
+        logger.debug("Metadata of %d sites prefetched in %.2fs" % (len(sources), time.perf_counter() - started))
+        return sources
+
+    def load_snapshot(self):
+        """ Add the values of the snapshot file (ignored when missing or unreadable), expired values are fetched again """
+        try:
+            with open(self.snapshot_path, 'rb') as file:
+                values = pickle.load(file)
+        except FileNotFoundError:
+            return False
+        except Exception as e:
+            logger.warning("Ignoring metadata snapshot %s: %s" % (self.snapshot_path, e))
+            return False
+
+        for key, cached in values.items():
+            if key not in self._values or self._values[key][0] < cached[0]:
+                self._values[key] = cached
+        return True
+
+    def save_snapshot(self):
+        """ Write the cached values to the snapshot file (atomically) for the other processes, when something was fetched """
+        if self.snapshot_path is None or not self._dirty:
+            return
+
+        directory = os.path.dirname(os.path.abspath(self.snapshot_path))
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as file:
+            pickle.dump(self._values, file)
+        os.replace(tmp_path, self.snapshot_path)
+        self._dirty = False
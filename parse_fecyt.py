@@ -1,32 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Converts the FECYT identifiers SQL dump (INSERT INTO `table` VALUES (id, identifier, record), ...)
+into the identifier map consumed by IdentifierFilterStage (IDENTIFIER_MAP_FROM_FILE): one
+"oai:dnet:<identifier>,<record>" line per row. The dump is streamed (see sqldump.py), multi GB
+and .gz dumps are converted with constant memory.
+
+    python parse_fecyt.py drupatablal20240627.sql fecyt_map.csv
+    python parse_fecyt.py drupatablal20240627.sql.gz fecyt_map.csv --index_dir /var/cache/usage-stats
+"""
+
+import argparse
+import os
 import re
-import csv
-
-# Paso 1: Leer el archivo que contiene los inserts SQL
-with open('drupatablal20240627.sql', 'r') as file:
-    sql_content = file.read()
-
-# Paso 2: Extraer los campos y valores de cada insert
-# Suponiendo que los inserts tienen el formato: INSERT INTO `table_name` VALUES (value1, value2, ...), (value1, value2, ...);
-pattern = re.compile(r"INSERT INTO `\w+` VALUES \((.*?)\);", re.DOTALL)
-matches = pattern.findall(sql_content)
-
-# Paso 3: Escribir los campos y valores en un archivo CSV
-with open('output.csv', 'w', newline='') as csvfile:
-    csv_writer = csv.writer(csvfile)
-    
-    # Escribir los encabezados (campos)
-    # Suponiendo que los campos son id, identifier, record
-    fields = ['identifier', 'record']
-    csv_writer.writerow(fields)
-    
-    # Escribir los valores
-    for match in matches:
-        # Separar los diferentes grupos de valores
-        values_groups = match.split('),(')
-        for group in values_groups:
-            # Limpiar los valores y escribir en el CSV
-            values = group.replace('(', '').replace(')', '').split(',')
-            ## remove the first value
-            values = values[1:]
-            values[0] = 'oai:dnet:' + values[0].strip()[1:-1]
-            csv_writer.writerow([value.strip().strip("'") for value in values])
+
+from identifiermap import IdentifierMapIndex, file_sha256
+from sqldump import InsertRowReader, ThroughputReporter, open_dump
+
+## the map is split on the comma by IdentifierFilterStage, values with separators can not be written
+SEPARATORS_RE = re.compile(r'[,\n\r]')
+
+
+def convert(args):
+
+    # pairs kept only to compile the index, the csv is written as the dump is read
+    mapping = {} if args['index_dir'] is not None else None
+    skipped = 0
+
+    tmp_path = args['output'] + '.tmp'
+
+    with open_dump(args['input']) as dump, open(tmp_path, 'w', encoding='utf-8') as output:
+        reader = InsertRowReader(dump, table=args['table'])
+        reporter = ThroughputReporter(reader, args['report_interval'])
+
+        for table, values in reader:
+            reporter.tick()
+
+            if len(values) <= max(args['key_column'], args['value_column']):
+                skipped += 1
+                continue
+
+            key = values[args['key_column']]
+            value = values[args['value_column']]
+
+            if key is None or value is None or SEPARATORS_RE.search(key) or SEPARATORS_RE.search(value):
+                skipped += 1
+                continue
+
+            key = args['prefix'] + key.strip()
+            value = value.strip()
+
+            output.write('%s,%s\n' % (key, value))
+            if mapping is not None:
+                mapping[key] = value
+
+        reporter.report(final=True)
+
+    os.replace(tmp_path, args['output'])
+    print("Rows skipped (missing columns, NULL or separators inside the values): %d" % skipped)
+
+    if mapping is not None:
+        os.makedirs(args['index_dir'], exist_ok=True)
+        index_path = IdentifierMapIndex.index_path(args['output'], args['index_dir'])
+        IdentifierMapIndex.build(args['output'], index_path, file_sha256(args['output']), mapping)
+        print("Index written to %s (%d identifiers)" % (index_path, len(mapping)))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="FECYT SQL dump to identifier map converter")
+    parser.add_argument("input", help="sql dump, optionally gzip compressed (.gz)")
+    parser.add_argument("output", help="identifier map csv")
+    parser.add_argument("--table", default=None, help="only convert the rows inserted into this table")
+    parser.add_argument("--key_column", default=1, type=int, help="position of the identifier in the row")
+    parser.add_argument("--value_column", default=2, type=int, help="position of the record in the row")
+    parser.add_argument("--prefix", default='oai:dnet:', help="prefix added to the identifier")
+    parser.add_argument("--index_dir", default=None, help="also compile the map index in this directory (PROCESSING.IDENTIFIER_MAP_CACHE_DIR)")
+    parser.add_argument("--report_interval", default=10.0, type=float, help="seconds between throughput reports")
+    return vars(parser.parse_args())
+
+
+if __name__ == "__main__":
+    convert(parse_args())
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+""" Per stage timing, row count and memory instrumentation for the processor pipeline """
+
+import collections
+import json
+import logging
+import os
+import resource
+import time
+import datetime
+
+logger = logging.getLogger()
+
+METRICS = 'METRICS'
+JSONL_PATH = 'JSONL_PATH'
+PROMETHEUS_TEXTFILE = 'PROMETHEUS_TEXTFILE'
+
+LABEL_ARGS = ('site', 'year', 'month', 'day', 'type')
+
+PROMETHEUS_PREFIX = 'usage_stats_stage'
+
+
+def frame_rows(data):
+    """ Number of rows of every dataframe held by the data object """
+    if data is None:
+        return {}
+    return dict((name, len(value)) for name, value in data.items() if hasattr(value, 'shape') and hasattr(value, 'columns'))
+
+
+def peak_rss_bytes():
+    # ru_maxrss is reported in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class StageSample:
+    """ Counters taken before a stage runs, closed by StageMetricsRecorder.stop """
+
+    def __init__(self, stage, data, process):
+        self.stage = stage
+        self.rows_in = frame_rows(data)
+        self.rss = process.memory_info().rss
+        self.peak_rss = peak_rss_bytes()
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+
+
+class StreamClock:
+    """
+    Measures the time spent pulling items from a stage stream. The time is inclusive of the
+    upstream stages, the exclusive time of a stage is its time minus the one of its upstream.
+    """
+
+    def __init__(self, sample: StageSample):
+        self.sample = sample
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.rows = {}
+
+    def wrap(self, stream):
+        iterator = iter(stream)
+        while True:
+            wall, cpu = time.perf_counter(), time.process_time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.wall += time.perf_counter() - wall
+                self.cpu += time.process_time() - cpu
+
+            for name, rows in frame_rows(item).items():
+                self.rows[name] = self.rows.get(name, 0) + rows
+            yield item
+
+
+class StageMetricsRecorder:
+    """
+    Records wall time, cpu time, rows in/out per dataframe and rss/peak rss deltas for every stage.
+    Every record is emitted as a json line (to JSONL_PATH if configured, to the logger otherwise);
+    a prometheus textfile collector file is rewritten after the run if PROMETHEUS_TEXTFILE is set.
+    """
+
+    def __init__(self, labels=None, jsonl_path=None, prometheus_path=None):
+        self.labels = labels or {}
+        self.jsonl_path = jsonl_path
+        self.prometheus_path = prometheus_path
+        self.records = []
+        self._process_handle = None
+
+    @property
+    def _process(self):
+        # psutil is imported by the first sample, not by every import of the pipeline; a forked child samples itself
+        if self._process_handle is None or self._process_handle.pid != os.getpid():
+            import psutil
+            self._process_handle = psutil.Process(os.getpid())
+        return self._process_handle
+
+    def from_context(configContext):
+
+        labels = {}
+        for name in LABEL_ARGS:
+            try:
+                labels[name] = configContext.getArg(name)
+            except Exception:
+                pass
+
+        def _option(option):
+            if configContext.hasConfig(METRICS, option):
+                value = configContext.getConfig(METRICS, option).strip()
+                return value if value != '' else None
+            return None
+
+        return StageMetricsRecorder(labels, _option(JSONL_PATH), _option(PROMETHEUS_TEXTFILE))
+
+    def start(self, stage, data) -> StageSample:
+        return StageSample(stage, data, self._process)
+
+    def stop(self, sample: StageSample, data, wall=None, cpu=None, rows_out=None):
+        """ Close the sample, wall, cpu and rows out can be given when they were measured by the caller """
+        rss = self._process.memory_info().rss
+        peak_rss = peak_rss_bytes()
+
+        record = dict(self.labels)
+        record.update({
+            'timestamp': datetime.datetime.now().isoformat(),
+            'stage': sample.stage,
+            'wall_seconds': round(wall if wall is not None else time.perf_counter() - sample.wall, 6),
+            'cpu_seconds': round(cpu if cpu is not None else time.process_time() - sample.cpu, 6),
+            'rows_in': sample.rows_in,
+            'rows_out': rows_out if rows_out is not None else frame_rows(data),
+            'rss_bytes': rss,
+            'rss_delta_bytes': rss - sample.rss,
+            'peak_rss_bytes': peak_rss,
+            'peak_rss_delta_bytes': peak_rss - sample.peak_rss,
+        })
+
+        self.records.append(record)
+        self._emit(record)
+        return record
+
+    def stop_stream(self, clocks):
+        """ Close the clocks of a chain of stage streams, in upstream to downstream order """
+        previous = None
+        for clock in clocks:
+            clock.sample.rows_in = previous.rows if previous is not None else {}
+            self.stop(clock.sample, None,
+                      wall=clock.wall - (previous.wall if previous is not None else 0.0),
+                      cpu=clock.cpu - (previous.cpu if previous is not None else 0.0),
+                      rows_out=clock.rows)
+            previous = clock
+
+    def _emit(self, record):
+        line = json.dumps(record, default=str)
+
+        if self.jsonl_path is None:
+            logger.info(line)
+            return
+
+        with open(self.jsonl_path, 'a') as file:
+            file.write(line + '\n')
+
+    def write_prometheus(self):
+        """ Rewrite the textfile collector file with the records of this run """
+        if self.prometheus_path is None or len(self.records) == 0:
+            return
+
+        gauges = [
+            ('wall_seconds', 'Wall time spent in the stage'),
+            ('cpu_seconds', 'CPU time spent in the stage'),
+            ('rss_delta_bytes', 'RSS growth during the stage'),
+            ('peak_rss_bytes', 'Peak RSS of the process after the stage'),
+        ]
+
+        lines = []
+        for field, help in gauges:
+            name = '%s_%s' % (PROMETHEUS_PREFIX, field)
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s gauge' % name)
+            for record in self.records:
+                lines.append('%s{%s} %s' % (name, self._prometheus_labels(record), record[field]))
+
+        name = '%s_rows_out' % PROMETHEUS_PREFIX
+        lines.append('# HELP %s Rows of every dataframe after the stage' % name)
+        lines.append('# TYPE %s gauge' % name)
+        for record in self.records:
+            for frame, rows in record['rows_out'].items():
+                lines.append('%s{%s,frame="%s"} %d' % (name, self._prometheus_labels(record), frame, rows))
+
+        # the path can hold labels ({site}, {year}, ...) to keep one file per site/period
+        path = self.prometheus_path.format_map(collections.defaultdict(str, self.labels))
+
+        # write to a temporary file and rename, the collector must never read a partial file
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as file:
+            file.write('\n'.join(lines) + '\n')
+        os.replace(tmp_path, path)
+
+    def _prometheus_labels(self, record):
+        labels = [(name, record.get(name)) for name in LABEL_ARGS if record.get(name) is not None]
+        labels.append(('stage', record['stage']))
+        return ','.join('%s="%s"' % (name, str(value).replace('"', '\\"')) for name, value in labels)
@@ -3,45 +3,126 @@
 """ Pipeline classes  """
 
 from abc import abstractmethod, ABC
+from checkpoints import StageCheckpoints, load_data
 from configcontext import ConfigurationContext
-from typing import List
+from pipelinemetrics import StageMetricsRecorder, StreamClock
+from profiling import StageProfiler, profile_section
+from runcache import RunCache
+from typing import TYPE_CHECKING, Any, Dict, Iterable, Iterator, List, Optional
+import importlib
 import logging
 import traceback
 logger = logging.getLogger()
 
-## Function to get class from class path
+if TYPE_CHECKING:
+    import pandas as pd
+
+## Function to get class from class path (module.Class, package.module.Class or a class of this module)
 def get_class(class_path):
-    groups = class_path.split('.') 
+    module_path, _, class_name = class_path.rpartition('.')
 
-    if len(groups) == 1:
+    if not module_path:
         return globals()[class_path]
-    else: 
-        if len(groups) == 2:
-            module_path = ".".join(groups[:-1]) 
-            class_name = groups[-1]
 
-            module = __import__( module_path )
-            return getattr(module, class_name )
-        else:
-            raise Exception("Invalid class path {}".format(class_path) )
+    # a package like stages imports the module of the class on the getattr
+    module = importlib.import_module(module_path)
+    try:
+        return getattr(module, class_name)
+    except AttributeError:
+        raise Exception("Invalid class path {}".format(class_path))
 
 
 ## Class for data transfer between pipeline stages
 class UsageStatsData:
+    """
+    Per run container for the data passed between stages. The known payloads are typed slots,
+    any other attribute set by a stage is kept in an extra dict. Unset attributes read as None.
+    """
+
+    events_df: Optional['pd.DataFrame']
+    visits_df: Optional['pd.DataFrame']
+    agg_dict: Optional[Dict[str, dict]]
+    country_by_identifier_dict: Optional[Dict[str, str]]
+    country_by_identifier_positions: Optional[Dict[str, int]]
+    documents: Optional[List[dict]]
+    source: Any
+    input_errors: Optional[List[str]]
+
+    FIELDS = ('events_df', 'visits_df', 'agg_dict', 'country_by_identifier_dict', 'country_by_identifier_positions', 'documents', 'source', 'input_errors')
+
+    ## fields that can be released as soon as no later stage consumes them
+    FRAMES = ('events_df', 'visits_df')
 
-    _data_dict = {}
+    ## column of the frames split in shards or buckets, position of every row in the frame of the whole period
+    ROW_POSITION = 'row_position'
+
+    __slots__ = FIELDS + ('_extra',)
 
     def __init__(self):
-        None
+        for name in UsageStatsData.FIELDS:
+            object.__setattr__(self, name, None)
+        object.__setattr__(self, '_extra', {})
 
     def __getattr__(self, attribute):
-        return self._data_dict.get(attribute, None)
+        # only called for attributes that are not slots
+        if attribute.startswith('__'):
+            raise AttributeError(attribute)
+        return self._extra.get(attribute, None)
 
     def __setattr__(self, name, value):
-        self._data_dict[name] = value
+        if name in UsageStatsData.FIELDS:
+            object.__setattr__(self, name, value)
+        else:
+            self._extra[name] = value
 
     def __str__(self):
-        return self._data_dict.__str__()
+        return dict(self.items()).__str__()
+
+    def get(self, name):
+        return getattr(self, name)
+
+    def items(self):
+        return [(name, getattr(self, name)) for name in UsageStatsData.FIELDS if getattr(self, name) is not None] + list(self._extra.items())
+
+    def drop(self, names):
+        ## release the given fields
+        for name in names:
+            if name in UsageStatsData.FIELDS:
+                object.__setattr__(self, name, None)
+            else:
+                self._extra.pop(name, None)
+
+## Function to merge the partial data of a stream into a single data object
+def merge_data(parts: Iterable[UsageStatsData], configContext: ConfigurationContext, keep_frames=True) -> UsageStatsData:
+    from aggutils import merge_agg_dicts, merge_latest
+    import pandas as pd
+
+    merged = UsageStatsData()
+    frames = {}
+
+    for part in parts:
+        for name, value in part.items():
+            if isinstance(value, pd.DataFrame):
+                if keep_frames:
+                    frames.setdefault(name, []).append(value)
+            elif name == 'country_by_identifier_positions':
+                # merged together with the countries
+                continue
+            elif name == 'country_by_identifier_dict':
+                # the country of the latest event of the identifier, whatever part holds it
+                merged.country_by_identifier_dict, merged.country_by_identifier_positions = merge_latest(
+                    merged.country_by_identifier_dict, merged.country_by_identifier_positions, value, part.country_by_identifier_positions)
+            elif merged.get(name) is None:
+                setattr(merged, name, value)
+            elif name == 'agg_dict':
+                merge_agg_dicts(merged.get(name), value)
+            elif isinstance(value, dict):
+                merged.get(name).update(value)
+
+    for name, values in frames.items():
+        setattr(merged, name, pd.concat(values, ignore_index=True) if len(values) > 1 else values[0])
+
+    return merged
 
 ## Abstract class for pipeline stages
 class AbstractUsageStatsPipelineStage(ABC):
@@ -49,10 +130,46 @@ class AbstractUsageStatsPipelineStage(ABC):
     def __init__(self, configContext: ConfigurationContext):
         self._configContext = configContext
 
+    ## True if the stage can run independently over disjoint sets of visits (sharded execution)
+    VISIT_LOCAL = False
+
+    ## data fields read by the stage, None if unknown (nothing is released before the stage)
+    CONSUMES = None
+
+    ## True for output stages that persist their result, a run with unchanged inputs can be skipped (runcache.py)
+    PERSISTS_RESULT = False
+
     @abstractmethod
     def run(self, data: UsageStatsData) -> UsageStatsData:
         pass
 
+    def run_stream(self, stream: Iterable[UsageStatsData]) -> Iterator[UsageStatsData]:
+        """
+        Streaming protocol, the stage consumes and yields partial data objects (buckets of complete visits).
+        Visit local stages run over every bucket, any other stage is adapted by merging the stream
+        into a single data object and running the whole frame version once.
+        """
+        if self.VISIT_LOCAL:
+            for data in stream:
+                yield self.run(data)
+        else:
+            yield self.run(merge_data(stream, self.getCtx()))
+
+    def fingerprint(self):
+        """
+        Json serializable description of what the stage reads besides the config sections of
+        runcache.CONFIG_SECTIONS (input partitions, source settings, files), used to skip unchanged runs
+        """
+        return None
+
+    def visits_columns(self):
+        """ Columns of the visits dataset the stage reads besides the ones every run reads """
+        return []
+
+    def project_visits_columns(self, columns):
+        """ Input stages: read the columns of the visits dataset too """
+        raise Exception("The input stage %s can not read the visit columns %s" % (type(self).__name__, ', '.join(columns)))
+
     def getCtx(self):
         return self._configContext
 
@@ -62,23 +179,228 @@ class UsageStatsProcessorPipeline:
     _input_stage = None
     _filters_stage = []
     _output_stage = None
+    _workers = 1
+    _stream = False
+    _engine = None
 
-    def __init__(self, configContext:ConfigurationContext, input: str, filters: List[str], output: str):
+    def __init__(self, configContext:ConfigurationContext, input: str, filters: List[str], output: str, workers: int = 1, stream: bool = False, engine: str = 'pandas'):
 
+        self._configContext = configContext
         self._input_stage = get_class(input)(configContext)
         self._filters_stage = [ get_class(filter)(configContext) for filter in filters ]
         self._output_stage = get_class(output)(configContext)
 
-    def run(self):
-        data = self._input_stage.run(UsageStatsData())
+        # the visit columns only some filters read (e.g. user agent and ip) are projected when they are in the chain
+        visits_columns = [column for filter in self._filters_stage for column in filter.visits_columns()]
+        if visits_columns:
+            self._input_stage.project_visits_columns(visits_columns)
+        self._workers = max(1, int(workers or 1))
+        self._stream = stream
 
+        self._metrics = StageMetricsRecorder.from_context(configContext)
+
+        # cProfile/tracemalloc dumps per stage, only with --profile
+        self._profiler = StageProfiler.from_args(configContext.getArgs())
+
+        # Arrow IPC checkpoints after the chosen stages, only with --checkpoint_after/CHECKPOINT_STAGES or --resume
+        self._checkpoints = StageCheckpoints.from_context(configContext, self._chain_names())
+
+        # the duckdb engine replaces the input stage and the leading filter/aggregate stages
+        if engine == 'duckdb':
+            from duckdbengine import DuckDBEngine
+
+            if stream:
+                raise Exception("The duckdb engine can not run in stream mode")
+
+            self._engine = DuckDBEngine(configContext, self._input_stage, self._filters_stage)
+            if len(self._unused_frames(len(self._engine.stages))) != len(UsageStatsData.FRAMES):
+                raise Exception("The stages after the duckdb engine can not consume the event/visit frames")
+        elif engine != 'pandas':
+            raise Exception("Unknown engine %s" % engine)
+
+    def _chain_names(self):
+        ## the input stage followed by the filters, positions of the checkpoints
+        return [type(stage).__name__ for stage in [self._input_stage] + self._filters_stage]
+
+    def _visit_local_prefix(self):
+        ## number of leading filters that can run over shards of visits
+        count = 0
         for filter in self._filters_stage:
-            data = filter.run(data)            
+            if not filter.VISIT_LOCAL:
+                break
+            count += 1
+        return count
+
+    def _unused_frames(self, position):
+        ## frames that no stage after position consumes, position 0 is right after the input stage
+        consumed = set()
+        for stage in self._filters_stage[position:] + [self._output_stage]:
+            if stage.CONSUMES is None:
+                return []
+            consumed.update(stage.CONSUMES)
+        return [name for name in UsageStatsData.FRAMES if name not in consumed]
+
+    def _released(self, stream: Iterable[UsageStatsData], position) -> Iterator[UsageStatsData]:
+        unused = self._unused_frames(position)
+        for data in stream:
+            data.drop(unused)
+            yield data
+
+    def _run_sharded(self, data: UsageStatsData, filters) -> UsageStatsData:
+        import sharding
+
+        agg_layout = (self._configContext.getActions(), self._configContext.getLabel('STATS_BY_COUNTRY'))
+        shard_key = self._configContext.getLabel('ID_VISIT')
+
+        logger.info('Running %d filters over %d shards' % (len(filters), self._workers))
+        return sharding.run_sharded(data, filters, self._workers, shard_key, agg_layout, self._unused_frames(len(filters)))
+
+    def _run_stage(self, stage, data: UsageStatsData) -> UsageStatsData:
+        name = type(stage).__name__
+        sample = self._metrics.start(name, data)
+        with profile_section(self._profiler, name):
+            data = stage.run(data)
+        self._metrics.stop(sample, data)
+        return data
+
+    def _run_stream(self) -> UsageStatsData:
+        ## chain the stages as generators, the input stage yields buckets of complete visits
+        stream = [UsageStatsData()]
+        clocks = []
+
+        for position, stage in enumerate([self._input_stage] + self._filters_stage):
+            clock = StreamClock(self._metrics.start(type(stage).__name__, None))
+            stream = clock.wrap(self._released(stage.run_stream(stream), position))
+            clocks.append(clock)
+
+        # the stages of a stream interleave, the whole chain is profiled as one section
+        with profile_section(self._profiler, 'stream'):
+            data = merge_data(stream, self._configContext)
+        self._metrics.stop_stream(clocks)
+
+        self._checkpoint(0, len(self._filters_stage), data)
+
+        return data
+
+    def _run_engine(self) -> UsageStatsData:
+        name = 'DuckDBEngine(%s)' % '+'.join(type(filter).__name__ for filter in self._engine.stages)
+        data = UsageStatsData()
+
+        sample = self._metrics.start(name, data)
+        with profile_section(self._profiler, 'duckdb'):
+            data = self._engine.run(data)
+        self._metrics.stop(sample, data)
+
+        # the engine replaces the input stage and its filters
+        self._checkpoint(0, len(self._engine.stages), data)
+
+        return self._run_from(len(self._engine.stages), data)
+
+    def _run_frames(self) -> UsageStatsData:
+        data = self._run_stage(self._input_stage, UsageStatsData())
+        data.drop(self._unused_frames(0))
+        self._checkpoint(0, 0, data)
+
+        position = 0
+
+        # run the leading visit local filters in parallel over shards of visits
+        if self._workers > 1:
+            sharded = self._visit_local_prefix()
+            if sharded > 0:
+                name = '+'.join(type(filter).__name__ for filter in self._filters_stage[:sharded])
+                sample = self._metrics.start(name, data)
+                # only the parent side (sharding, transfer and merge) is profiled
+                with profile_section(self._profiler, 'sharded'):
+                    data = self._run_sharded(data, self._filters_stage[:sharded])
+                self._metrics.stop(sample, data)
+                position = sharded
+                self._checkpoint(1, position, data)
+
+        return self._run_from(position, data)
+
+    def _run_from(self, position, data: UsageStatsData) -> UsageStatsData:
+        ## run the filters after the stage at position of the chain (0 is the input stage)
+        for filter in self._filters_stage[position:]:
+            data = self._run_stage(filter, data)
+
+            # release the frames no later stage needs
+            position += 1
+            data.drop(self._unused_frames(position))
+            self._checkpoint(position, position, data)
+
+        return data
+
+    def _checkpoint(self, first, last, data: UsageStatsData):
+        ## write the data after the stages first..last of the chain, they run as one block (shards, stream, duckdb)
+        if self._checkpoints is not None and self._checkpoints.wants(first, last):
+            self._checkpoints.save(last, data)
+
+    def _restart_point(self):
+        ## (position, data) to continue from, a replayed checkpoint (--replay_from) or the last one of the run (--resume)
+        args = self._configContext.getArgs()
+
+        if args.get('replay_from'):
+            agg_layout = (self._configContext.getActions(), self._configContext.getLabel('STATS_BY_COUNTRY'))
+            stage, data = load_data(args['replay_from'], agg_layout)
+            if stage not in self._chain_names():
+                raise Exception("The checkpoint %s was taken after %s, which is not a stage of this pipeline" % (args['replay_from'], stage))
+            logger.info('Replaying %s through the stages after %s' % (args['replay_from'], stage))
+            return self._chain_names().index(stage), data
+
+        if args.get('resume', False) and self._checkpoints is not None:
+            return self._checkpoints.latest()
+
+        return None
+
+    def _fingerprint_components(self):
+        ## everything the results of the run depend on, see runcache.py
+        stages = [self._input_stage] + self._filters_stage + [self._output_stage]
+        components = {'stages': [type(stage).__name__ for stage in stages],
+                      'config': RunCache.config_components(self._configContext)}
+        for stage in stages:
+            components[type(stage).__name__] = stage.fingerprint()
+        return components
+
+    def run(self):
+        args = self._configContext.getArgs()
+
+        # an unchanged site/period is not processed again, unless forced. A replay is never recorded
+        run_cache = None
+        if self._output_stage.PERSISTS_RESULT and not args.get('replay_from'):
+            run_cache = RunCache.from_context(self._configContext, type(self._output_stage).__name__)
+        if run_cache is not None:
+            components = self._fingerprint_components()
+            if run_cache.is_current(components) and not args.get('force', False):
+                logger.info('Inputs unchanged since the last run, skipping (--force to run it again)')
+                return None
+
+        restart = self._restart_point()
+        if restart is not None:
+            data = self._run_from(*restart)
+        elif self._engine is not None:
+            data = self._run_engine()
+        else:
+            data = self._run_stream() if self._stream else self._run_frames()
 
         try:
-            return self._output_stage.run(data)
+            data = self._run_stage(self._output_stage, data)
+            # a run whose input could not be read (e.g. a transient s3 error) is done again by the next run
+            if run_cache is not None and data.input_errors:
+                logger.error('The inputs %s could not be read, the run is not recorded as done' % ', '.join(data.input_errors))
+            elif run_cache is not None:
+                run_cache.store(components)
+            # the checkpoints are only needed until the output succeeds
+            if self._checkpoints is not None and not args.get('keep_checkpoints', False) and not args.get('replay_from'):
+                self._checkpoints.clear()
+            return data
         except Exception as e: 
             logger.error( 'A fatal exception ocurred processing data !!!! {}'.format(e) )
             traceback.print_exc()
+        finally:
+            self._metrics.write_prometheus()
+
 
 
+    def getStageMetrics(self):
+        ## metric records of the stages run so far
+        return list(self._metrics.records)
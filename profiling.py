@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+""" Opt-in cProfile and tracemalloc dumps for pipeline stages and extraction loops """
+
+import contextlib
+import cProfile
+import os
+import pstats
+import re
+import tracemalloc
+
+
+def profile_label(args_dict):
+    """ Directory label for a run, e.g. site_48_2024_3_all """
+    def _value(name):
+        value = args_dict.get(name)
+        return 'all' if value is None else str(value)
+
+    return 'site_%s_%s_%s_%s' % (_value('site'), _value('year'), _value('month'), _value('day'))
+
+
+class StageProfiler:
+    """
+    Profiles named sections of a run. Every section writes to <output_dir>/<label>/:
+      - NN_<name>.prof: cProfile stats, readable with pstats or snakeviz
+      - NN_<name>.tracemalloc.txt: top allocations still alive at the end of the section
+    """
+
+    def __init__(self, output_dir, label, top=25):
+        self.output_dir = os.path.join(output_dir, label)
+        self.top = top
+        self._count = 0
+        os.makedirs(self.output_dir, exist_ok=True)
+
+    def from_args(args_dict):
+        """ Build a profiler from the --profile argument, None when profiling is disabled """
+        output_dir = args_dict.get('profile')
+        if output_dir is None:
+            return None
+        return StageProfiler(output_dir, profile_label(args_dict))
+
+    @contextlib.contextmanager
+    def profile(self, name):
+        self._count += 1
+        basename = os.path.join(self.output_dir, '%02d_%s' % (self._count, re.sub(r'[^\w.+-]', '_', name)))
+
+        # keep tracemalloc running if someone else (debug mode) started it
+        started = not tracemalloc.is_tracing()
+        if started:
+            tracemalloc.start()
+        else:
+            tracemalloc.reset_peak()
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            if started:
+                tracemalloc.stop()
+
+            profiler.dump_stats(basename + '.prof')
+            self._write_allocations(basename + '.tracemalloc.txt', name, snapshot, current, peak)
+
+            with open(basename + '.txt', 'w') as file:
+                pstats.Stats(profiler, stream=file).sort_stats('cumulative').print_stats(self.top)
+
+    def _write_allocations(self, path, name, snapshot, current, peak):
+        snapshot = snapshot.filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        ))
+
+        with open(path, 'w') as file:
+            file.write('%s current: %.2fMB peak: %.2fMB\n' % (name, current / 1024 / 1024, peak / 1024 / 1024))
+            for stat in snapshot.statistics('lineno')[:self.top]:
+                file.write('%s\n' % stat)
+
+
+def profile_section(profiler, name):
+    """ Context for a section, a no-op when profiler is None """
+    if profiler is None:
+        return contextlib.nullcontext()
+    return profiler.profile(name)
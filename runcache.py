@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+""" Input fingerprint cache of the pipeline runs, an unchanged site/period run is skipped """
+
+import datetime
+import hashlib
+import json
+import logging
+import os
+import tempfile
+
+logger = logging.getLogger()
+
+PROCESSING = 'PROCESSING'
+RUN_CACHE_DIR = 'RUN_CACHE_DIR'
+
+## config sections the results depend on (robots query, assets regex, actions, labels, output index)
+CONFIG_SECTIONS = ('GENERAL', 'LABELS', 'ROBOTS_FILTER', 'KNOWN_ROBOTS_FILTER', 'ASSETS_FILTER', 'DOUBLE_CLICK_FILTER', 'OUTPUT')
+
+PERIOD_ARGS = ('site', 'year', 'month', 'day')
+
+
+def fingerprint(components):
+    """ sha256 of the json of the components """
+    return hashlib.sha256(json.dumps(components, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+class RunCache:
+    """
+    Outcome of the last successful run of a pipeline (named by its output stage) for one
+    site/period, stored with the fingerprint of everything the run read: the input partitions,
+    the config sections and what every stage reports in fingerprint().
+    """
+
+    def __init__(self, directory, name, period):
+        self.directory = directory
+        self.path = os.path.join(directory, name, 'site_%s_%s_%s_%s.json' % tuple(period.get(arg) for arg in PERIOD_ARGS))
+
+    def from_context(configContext, name):
+        """ Cache of the pipeline run of the context, None when PROCESSING.RUN_CACHE_DIR is not set """
+        if not configContext.hasConfig(PROCESSING, RUN_CACHE_DIR):
+            return None
+        directory = configContext.getConfig(PROCESSING, RUN_CACHE_DIR).strip()
+        if directory == '':
+            return None
+        return RunCache(directory, name, configContext.getArgs())
+
+    def config_components(configContext):
+        return dict((section, configContext.getSection(section)) for section in CONFIG_SECTIONS if configContext.hasSection(section))
+
+    def load(self):
+        """ Stored record, None when the period never finished """
+        try:
+            with open(self.path) as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return None
+        except ValueError as e:
+            logger.warning("Ignoring run cache record %s: %s" % (self.path, e))
+            return None
+
+    def is_current(self, components):
+        """ True when the last run finished with the same fingerprint, otherwise logs what changed """
+        record = self.load()
+        if record is None:
+            return False
+        if record['fingerprint'] == fingerprint(components):
+            return True
+
+        stored = record.get('components', {})
+        changed = sorted(key for key in set(stored) | set(components) if fingerprint(stored.get(key)) != fingerprint(components.get(key)))
+        logger.info("Inputs changed since the run of %s: %s" % (record.get('finished'), ', '.join(changed)))
+        return False
+
+    def store(self, components):
+        """ Record a successful run, written atomically """
+        record = {'fingerprint': fingerprint(components),
+                  'finished': datetime.datetime.now().isoformat(timespec='seconds'),
+                  'components': components}
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path), suffix='.tmp')
+        with os.fdopen(fd, 'w') as file:
+            json.dump(record, file, sort_keys=True, default=str)
+        os.replace(tmp_path, self.path)
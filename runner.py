@@ -3,10 +3,8 @@ import os
 import sys
 import argparse
 from calendar import monthrange
-import requests
 import gc
 
-import pandas as pd
 import time
 
 import datetime
@@ -16,12 +14,12 @@ from config import read_ini
 import atexit
 from s3logger import S3Logger 
 
-from lareferenciastatsdb import UsageStatsDatabaseHelper
+from metadatacache import MetadataCache
 
 import subprocess
 
 
-def process_site(command, configfile,  site_id, year, month, day, type):
+def process_site(command, configfile,  site_id, year, month, day, type, profile=None):
     print("Processing %s site: %s year: %s month: %s day: %s" % (command, site_id, year, month, day))
 
      # Iniciar la lista de comandos con el comando en sí
@@ -41,6 +39,8 @@ def process_site(command, configfile,  site_id, year, month, day, type):
         cmd_list.append("--day=" + str(day))
     if type is not None:
         cmd_list.append("--type=" + str(type))
+    if profile is not None:
+        cmd_list.append("--profile=" + str(profile))
 
 
     # Ejecutar el comando
@@ -52,6 +52,16 @@ def process_site(command, configfile,  site_id, year, month, day, type):
     print(result.stdout)
     print(result.stderr)
 
+def has_events(volumes, site_id, year, month, day):
+    # without a volume report every period is processed
+    if volumes is None:
+        return True
+    import volumestats
+    if volumestats.period_events(volumes, site_id, year, month, day) > 0:
+        return True
+    print("Skipping site: %s year: %s month: %s day: %s, no events in the volume report" % (site_id, year, month, day))
+    return False
+
 def main(args_dict):
 
     # get arguments
@@ -81,12 +91,15 @@ def main(args_dict):
     
     dry_run = args_dict.get('dry_run', False)
 
+    # profile dumps directory passed to every process
+    profile = args_dict.get('profile', None)
+
     try: 
         # read config file
         config = read_ini(config_file_path)
 
-        # database helper
-        dbhelper = UsageStatsDatabaseHelper(config)
+        # database helper behind the process wide metadata cache
+        dbhelper = MetadataCache.shared(config)
         
         # logger bucket
         #s3logger.set_bucket(config["S3"]["LOGS_BUCKET"])
@@ -115,11 +128,28 @@ def main(args_dict):
 
     else:
         sites = [int(site)]
+
+    # volume report of s3stats.py: the largest sites run first and with --skip_empty the periods without events are not launched
+    volumes = None
+    if args_dict.get('volume_report', None) is not None:
+        import volumestats
+        rows = volumestats.read_report(args_dict['volume_report'])
+        by_site = volumestats.site_volumes(rows)
+        sites.sort(key=lambda site_id: -by_site.get(site_id, {}).get('events', 0))
+        if args_dict.get('skip_empty', False):
+            volumes = rows
+
+    # every source in one pass, the processes launched below read them from the snapshot
+    index_prefix = config.get('OUTPUT', 'INDEX_PREFIX', fallback=None)
+    dbhelper.prefetch(sites, index_prefix)
+    dbhelper.save_snapshot()
            
     # # loop over sites
     for site_id in sites:
 
-        source = dbhelper.get_source_by_site_id(site_id)
+        # refreshed (and the snapshot rewritten) only when the ttl expired during the batch
+        source = dbhelper.prefetch([site_id], index_prefix)[site_id]
+        dbhelper.save_snapshot()
 
 
          # if date is specified, get only that day
@@ -130,12 +160,14 @@ def main(args_dict):
             month = int(date[5:7])
             day = int(date[8:10])
 
-            process_site(command, config_file_path, site_id, year, month, day, source.type)
+            if has_events(volumes, site_id, year, month, day):
+                process_site(command, config_file_path, site_id, year, month, day, source.type, profile)
 
         else:
             # if from_month, to_month, from_day, to_day are None get all data for the year
             if from_month == 0 and to_month == 0:
-                process_site(command, config_file_path, site_id, year, None, None, source.type)
+                if has_events(volumes, site_id, year, None, None):
+                    process_site(command, config_file_path, site_id, year, None, None, source.type, profile)
 
             # if not specified date, get data for all days coverd by from_month and to_month
             else:
@@ -153,7 +185,8 @@ def main(args_dict):
 
                     ## if from_day is not specified, process all month
                     if from_day is None:
-                        process_site(command, config_file_path, site_id, year, month, None, source.type)
+                        if has_events(volumes, site_id, year, month, None):
+                            process_site(command, config_file_path, site_id, year, month, None, source.type, profile)
 
                     else: # process only from_day to to_day    
 
@@ -165,7 +198,8 @@ def main(args_dict):
 
                         # loop over days
                         for day in range(from_day,local_to_day+1):
-                            process_site(command, config_file_path, site_id, year, month, day, source.type)
+                            if has_events(volumes, site_id, year, month, day):
+                                process_site(command, config_file_path, site_id, year, month, day, source.type, profile)
 
              
 
@@ -256,6 +290,12 @@ def parse_args():
 
     parser.add_argument("--dry_run", default=False, type=bool, required=False, help="dont write to elastic")
 
+    parser.add_argument("--profile", default=None, type=str, required=False, help="directory for profile dumps, passed to every process")
+
+    parser.add_argument("--volume_report", default=None, type=str, required=False, help="csv/json volume report of s3stats.py, the sites with more events run first")
+
+    parser.add_argument("--skip_empty", default=False, action='store_true', help="with --volume_report, do not launch the periods without events")
+
     args = parser.parse_args()
 
     return args 
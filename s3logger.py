@@ -1,25 +1,105 @@
-from cmath import log
-import io
-import logging
-import boto3  
+import atexit
+import collections
 import datetime
+import gzip
+import logging
+import os
+import sys
+import threading
+import time
+
+## the oldest messages are dropped when the buffer grows over this size
+MAX_BUFFER_BYTES = 16 * 1024 * 1024
+
+## a segment is shipped when the buffer reaches this size or after this many seconds
+FLUSH_BYTES = 1024 * 1024
+FLUSH_INTERVAL = 300.0
+
+## attempts of a segment upload before giving up
+UPLOAD_ATTEMPTS = 3
+
+## seconds close (also called at exit) waits for the pending uploads, the segments not shipped by then are spooled
+CLOSE_TIMEOUT = 15.0
+
+## timeouts (seconds) and retries of the s3 client, the botocore defaults (60s, 4 retries) would hold every upload for minutes
+S3_CONNECT_TIMEOUT = 3
+S3_READ_TIMEOUT = 10
+S3_MAX_RETRIES = 2
+
+
+class _BufferHandler(logging.Handler):
+    """ Appends the formatted records to the logger buffer, never blocks on the upload """
+
+    def __init__(self, s3logger):
+        super().__init__()
+        self.s3logger = s3logger
+
+    def emit(self, record):
+        # records of the upload itself (boto3) would feed the buffer they are shipping
+        if threading.current_thread() is self.s3logger._thread:
+            return
+        try:
+            self.s3logger._append(self.format(record) + '\n')
+        except Exception:
+            self.handleError(record)
+
 
 class S3Logger:
-    def __init__(self, appname, loglevel=logging.INFO, bucket=None, local_mode = False):
+    """
+    Logger that ships the messages of the process to s3 as gzip compressed segments.
+
+    The messages are kept in a size bounded buffer and uploaded by a background thread when the
+    buffer reaches flush_bytes, every flush_interval seconds and on write(name), so logging never
+    waits for s3 (and the upload does not show up in the profiles of the caller). The s3 client is
+    created on the first upload, with short timeouts. close(), also called at exit, ships what is
+    left waiting at most close_timeout seconds; the segments that could not be shipped (by then or
+    after every attempt) are written to spool_dir, or to stderr without it.
+    """
+
+    def __init__(self, appname, loglevel=logging.INFO, bucket=None, local_mode=False, client=None,
+                 max_buffer_bytes=MAX_BUFFER_BYTES, flush_bytes=FLUSH_BYTES, flush_interval=FLUSH_INTERVAL,
+                 close_timeout=CLOSE_TIMEOUT, spool_dir=None):
         self.bucket = bucket
-        self.s3 = boto3.client('s3')
-        self.log_stringio = io.StringIO()
-        self.logger = logging.getLogger()
-        self.logger.addHandler(logging.StreamHandler(self.log_stringio))
-        self.logger.setLevel(loglevel) 
         self.appname = appname
         self.local_mode = local_mode
+        self.max_buffer_bytes = max_buffer_bytes
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval
+        self.close_timeout = close_timeout
+        self.spool_dir = spool_dir
+
+        self._client = client
+        self._buffer = collections.deque()
+        self._buffer_bytes = 0
+        self._dropped = 0
+        self._segments = collections.deque()
+        self._uploading = []
+        self._sequence = 0
+        self._closed = False
+        self._condition = threading.Condition()
+        self._thread = None
+
+        self.handler = _BufferHandler(self)
+        self.logger = logging.getLogger()
+        self.logger.addHandler(self.handler)
+        self.logger.setLevel(loglevel)
 
         logging.basicConfig(format="%(levelname)s: %(message)s", level=loglevel)
+        atexit.register(self.close)
 
+    @property
+    def s3(self):
+        if self._client is None:
+            import boto3
+            from botocore.config import Config
+            self._client = boto3.client('s3', config=Config(connect_timeout=S3_CONNECT_TIMEOUT, read_timeout=S3_READ_TIMEOUT,
+                                                            retries={'max_attempts': S3_MAX_RETRIES, 'mode': 'standard'}))
+        return self._client
 
     def set_bucket(self, bucket):
-        self.bucket = bucket  
+        with self._condition:
+            self.bucket = bucket
+            self._condition.notify()
 
     def set_log_level(self, loglevel):
         self.logger.setLevel(loglevel)
@@ -30,44 +110,177 @@ class S3Logger:
     def loginfo(self, message):
         if self.local_mode:
             print(message)
-                 
+
         self.logger.info(message)
 
     def logwarning(self, message):
-
         if self.local_mode:
             print(message)
-    
+
         self.logger.warning(message)
 
     def logerror(self, message):
         if self.local_mode:
             print(message)
-        
+
         self.logger.error(message)
 
     def logdebug(self, message):
         if self.local_mode:
             print(message)
-        
+
         self.logger.debug(message)
 
-    def write(self,name):
-        
-        if ( self.bucket is None ):
+    def _append(self, message):
+        with self._condition:
+            if self._closed:
+                return
+
+            self._buffer.append(message)
+            self._buffer_bytes += len(message)
+
+            # ring buffer: the oldest messages make room for the new ones
+            while self._buffer_bytes > self.max_buffer_bytes and len(self._buffer) > 1:
+                self._buffer_bytes -= len(self._buffer.popleft())
+                self._dropped += 1
+
+            self._start_thread()
+            if self._buffer_bytes >= self.flush_bytes:
+                self._condition.notify()
+
+    def _start_thread(self):
+        """ Start the background thread, again in a forked child where it does not exist, called holding the condition """
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='s3logger', daemon=True)
+            self._thread.start()
+
+    def _cut_segment(self, name):
+        """ Move the buffered messages to a segment waiting for upload, called holding the condition """
+        if not self._buffer and not self._dropped:
+            return
+
+        body = ''.join(self._buffer)
+        if self._dropped:
+            body = "WARNING: %d messages dropped, the log buffer was full\n" % self._dropped + body
+
+        self._segments.append((name, datetime.datetime.now(), body))
+        self._buffer.clear()
+        self._buffer_bytes = 0
+        self._dropped = 0
+
+    def write(self, name):
+        """ Ship the messages logged so far as the segment name, the upload is done in the background """
+        if self.bucket is None:
             self.logerror("No bucket specified")
             return
 
-        now = datetime.datetime.now()
-        year, month, day = now.year, now.month, now.day
-        time = now.strftime("%H_%M_%S") 
+        with self._condition:
+            self._cut_segment(name)
+            self._start_thread()
+            self._condition.notify()
+
+    def _due(self, last_flush):
+        """ True when the background thread has something to do, called holding the condition """
+        if self._closed or self._segments:
+            return True
+        if self.bucket is None:
+            return False
+        return self._buffer_bytes >= self.flush_bytes or time.monotonic() - last_flush >= self.flush_interval
 
-        key = self.appname + "/" + str(year) + "/" + str(month) + "/" + str(day) + "/" + name + "_" + time + ".log"
+    def _run(self):
+        last_flush = time.monotonic()
 
-        self.s3.put_object(Bucket=self.bucket, Key=key, Body=self.log_stringio.getvalue())
-        
-        self.log_stringio.truncate(0)
+        while True:
+            with self._condition:
+                while not self._due(last_flush):
+                    # without bucket nothing is shipped until set_bucket, write or close
+                    self._condition.wait(None if self.bucket is None else
+                                         max(0.0, self.flush_interval - (time.monotonic() - last_flush)))
+
+                if self.bucket is not None:
+                    self._cut_segment('segment')
+                segments = list(self._segments) if self.bucket is not None else []
+                self._segments.clear()
+                # spooled by close if they are still uploading at its deadline
+                self._uploading.extend(segments)
+                closed = self._closed
+                last_flush = time.monotonic()
+
+            for segment in segments:
+                self._upload(*segment)
+                with self._condition:
+                    if segment in self._uploading:
+                        self._uploading.remove(segment)
+
+            if closed:
+                return
+
+    def _key(self, name, created):
+        """ Key of a segment in the bucket (without the bucket name) """
+        with self._condition:
+            self._sequence += 1
+            sequence = self._sequence
+        key = "%s/%d/%d/%d/%s_%s_%d_%d.log.gz" % (self.appname, created.year, created.month, created.day, name,
+                                                   created.strftime("%H_%M_%S"), os.getpid(), sequence)
+        prefix = self.bucket.partition('/')[2] if self.bucket is not None else ''
+        return prefix.rstrip('/') + '/' + key if prefix else key
+
+    def _upload(self, name, created, body):
+        key = self._key(name, created)
+
+        data = gzip.compress(body.encode('utf-8'))
+        for attempt in range(UPLOAD_ATTEMPTS):
+            try:
+                self.s3.put_object(Bucket=self.bucket.partition('/')[0], Key=key, Body=data, ContentType='text/plain', ContentEncoding='gzip')
+                return
+            except Exception as e:
+                # not logged, the message would come back to this buffer
+                print("S3Logger: upload of %s failed (attempt %d): %s" % (key, attempt + 1, e), file=sys.stderr)
+                if attempt + 1 < UPLOAD_ATTEMPTS:
+                    time.sleep(2 ** attempt)
+
+        self._spool(key, body)
+
+    def _spool(self, key, body):
+        """ Keep a segment that could not be shipped: a gzip file in spool_dir, or stderr """
+        try:
+            if self.spool_dir is not None:
+                os.makedirs(self.spool_dir, exist_ok=True)
+                path = os.path.join(self.spool_dir, key.replace('/', '_'))
+                with open(path, 'wb') as file:
+                    file.write(gzip.compress(body.encode('utf-8')))
+                print("S3Logger: segment %s spooled to %s" % (key, path), file=sys.stderr)
+                return
+        except Exception as e:
+            print("S3Logger: spool of %s failed: %s" % (key, e), file=sys.stderr)
+
+        sys.stderr.write("S3Logger: segment %s could not be shipped:\n%s" % (key, body))
+        sys.stderr.flush()
 
     def close(self):
-        self.logger.removeHandler(self.log_stringio)
-        self.log_stringio.close()   
\ No newline at end of file
+        """ Ship the buffered messages and stop the background thread """
+        with self._condition:
+            if self._closed:
+                return
+            if self.bucket is not None:
+                self._cut_segment('close')
+            self._closed = True
+            if self._segments:
+                self._start_thread()
+            self._condition.notify()
+            thread = self._thread
+
+        self.logger.removeHandler(self.handler)
+        if thread is not None:
+            thread.join(self.close_timeout)
+
+        if thread is not None and thread.is_alive():
+            # s3 is slow or unreachable, the exit does not wait for it
+            with self._condition:
+                pending = self._uploading + list(self._segments)
+                self._uploading = []
+                self._segments.clear()
+            print("S3Logger: %d segments not shipped in %.1f seconds" % (len(pending), self.close_timeout), file=sys.stderr)
+            # a segment still uploading may also reach the bucket, a duplicate is better than a lost segment
+            for name, created, body in pending:
+                self._spool(self._key(name, created), body)
@@ -18,13 +18,18 @@ def main(args):
                                        "stages.S3ParquetInputStage",
                                         
                                        ["stages.RobotsFilterStage",
+                                        "stages.KnownRobotsFilterStage",
                                         "stages.AssetsFilterStage",
+                                        "stages.DoubleClickFilterStage",
                                         "stages.MetricsFilterStage",
                                         "stages.AggByItemFilterStage",
                                         "stages.IdentifierFilterStage",
                                        ],
                                        
-                                        "stages.ElasticOutputStage")
+                                        "stages.ElasticOutputStage",
+                                       workers=args.get('workers', 1),
+                                       stream=args.get('stream', False),
+                                       engine=args.get('engine', 'pandas'))
         pipeline.run()
         
     except Exception as e:
@@ -52,6 +57,16 @@ def parse_args():
                     type=str, 
                     help="(R|L|N)", 
                     required=False)
+
+    parser.add_argument("-w", "--workers", default=1, type=int, help="worker processes for the sharded filter/aggregation stages", required=False)
+    parser.add_argument("--stream", default=False, action='store_true', help="process the data in buckets of visits with bounded memory")
+    parser.add_argument("--engine", default='pandas', choices=['pandas', 'duckdb'], help="engine for the filter/aggregation stages", required=False)
+    parser.add_argument("--profile", default=None, type=str, help="directory for per stage cProfile/tracemalloc dumps", required=False)
+    parser.add_argument("--force", default=False, action='store_true', help="process the site/period even if its inputs did not change since the last run (PROCESSING.RUN_CACHE_DIR)")
+    parser.add_argument("--checkpoint_after", default=None, type=str, help="comma separated stages whose output is checkpointed (overrides PROCESSING.CHECKPOINT_STAGES)", required=False)
+    parser.add_argument("--resume", default=False, action='store_true', help="restart from the last checkpoint of the site/period")
+    parser.add_argument("--keep_checkpoints", default=False, action='store_true', help="keep the checkpoints after the output succeeded")
+    parser.add_argument("--replay_from", default=None, type=str, help="checkpoint directory to run through the stages after it", required=False)
    
     args = parser.parse_args()
     return args
@@ -11,14 +11,28 @@ pymysql.install_as_MySQLdb()
 def main(args):
    
     
+    # a batch of identifiers from the command line and/or a file, one per line
+    identifiers = list(args.get('identifier') or [])
+    if args.get('identifiers_file') is not None:
+        with open(args['identifiers_file']) as file:
+            identifiers += [line.strip() for line in file if line.strip() != '']
+    if len(identifiers) == 0:
+        raise Exception("No identifiers to look up (-i or --identifiers_file)")
+    args['identifier'] = identifiers
+
     config_context = ConfigurationContext(args)
+
+    # the lookup reads only the row groups of the identifiers, --full_scan runs the whole period
+    input_stage = "stages.S3ParquetInputStage" if args.get('full_scan', False) else "stages.IdentifierLookupInputStage"
     
     try:
         pipeline = UsageStatsProcessorPipeline(config_context, 
-                                       "stages.S3ParquetInputStage",
+                                       input_stage,
                                         
                                        ["stages.RobotsFilterStage",
+                                        "stages.KnownRobotsFilterStage",
                                         "stages.AssetsFilterStage",
+                                        "stages.DoubleClickFilterStage",
                                         "stages.MetricsFilterStage",
                                         "stages.AggByItemFilterStage",
                                        ],
@@ -44,7 +58,9 @@ def parse_args():
     parser.add_argument( "-y", "--year", default=2023, type=int, help="yyyy", required=False )
     parser.add_argument("-m", "--month", default=None, type=int, help="m", required=False)
     parser.add_argument("-d", "--day", default=None, type=int, help="d", required=False)
-    parser.add_argument("-i", "--identifier", default=None, type=str, help="identifier", required=True)
+    parser.add_argument("-i", "--identifier", default=None, type=str, nargs='+', help="identifiers", required=False)
+    parser.add_argument("--identifiers_file", default=None, type=str, help="file with one identifier per line", required=False)
+    parser.add_argument("--full_scan", default=False, action='store_true', help="read and aggregate the whole period instead of the row groups of the identifiers")
 
     parser.add_argument("-t",
                     "--type", 
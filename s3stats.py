@@ -1,15 +1,45 @@
 from processorpipeline import UsageStatsProcessorPipeline
 from configcontext import ConfigurationContext
+from config import read_ini
+import volumestats
+import os
 import time
 import argparse
 import datetime
-import stages
 
-import pymysql
-pymysql.install_as_MySQLdb()
+
+def report(args):
+
+    # volumes from the parquet footers and the partition layout, no data page is read
+    config = read_ini(args['config_file_path'])
+    site = args.get('site')
+    sites = None if str(site) == 'all' else [int(site)]
+
+    rows = volumestats.volume_report(config['S3_STATS']['EVENTS_PATH'], config['S3_STATS']['VISITS_PATH'],
+                                     sites=sites, year=args.get('year'), month=args.get('month'), threads=args.get('threads', 16))
+
+    output_dir = args.get('output_dir', 'report')
+    os.makedirs(output_dir, exist_ok=True)
+    name = '%s_%s' % (site, args.get('year') if args.get('year') is not None else 'all')
+
+    if 'csv' in args.get('format', []):
+        volumestats.write_csv(rows, os.path.join(output_dir, 'volumes_%s.csv' % name))
+    if 'json' in args.get('format', []):
+        volumestats.write_json(rows, os.path.join(output_dir, 'volumes_%s.json' % name))
+    volumestats.plot_months(rows, os.path.join(output_dir, 'events_%s.png' % name), "Site %s - Events and visits by month - year %s" % (site, args.get('year')))
+
+    volumes = volumestats.site_volumes(rows)
+    print("Sites: %d Events: %d Visits: %d" % (len(volumes), sum(entry['events'] for entry in volumes.values()), sum(entry['visits'] for entry in volumes.values())))
+    return rows
+
 
 def main(args):
-   
+
+    if not args.get('full_scan', False):
+        return report(args)
+
+    import pymysql
+    pymysql.install_as_MySQLdb()
     
     config_context = ConfigurationContext(args)
     
@@ -35,7 +65,7 @@ def parse_args():
     
     #cambiar config.tst.ini por config.ini luego
     parser.add_argument( "-c", "--config_file_path", default='config.ini', help="config file", required=False )
-    parser.add_argument( "-s", "--site", default=48, help="site id", required=False)
+    parser.add_argument( "-s", "--site", default=48, help="site id or all", required=False)
    
     parser.add_argument( "-y", "--year", default=2023, type=int, help="yyyy", required=False )
     parser.add_argument("-m", "--month", default=None, type=int, help="m", required=False)
@@ -47,6 +77,11 @@ def parse_args():
                     type=str, 
                     help="(R|L|N)", 
                     required=False)
+
+    parser.add_argument("--format", default=['csv', 'json'], nargs='+', choices=['csv', 'json'], help="report files", required=False)
+    parser.add_argument("--output_dir", default='report', type=str, help="directory of the report files and chart", required=False)
+    parser.add_argument("--threads", default=16, type=int, help="concurrent footer reads on s3", required=False)
+    parser.add_argument("--full_scan", default=False, action='store_true', help="read every event of the period (S3StatsOutputStage) instead of the footers")
    
     args = parser.parse_args()
     return args
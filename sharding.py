@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+""" Sharded execution of the visit local pipeline stages over a process pool """
+
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from aggutils import agg_dict_to_table, agg_table_to_dict
+
+AGG_DICT = 'agg_dict'
+
+# payload kinds transferred between the parent and the shard workers
+KIND_FRAME = 'frame'
+KIND_AGG = 'agg'
+KIND_MAP = 'map'
+
+## state of every shard worker, set once by the pool initializer
+_worker_filters = None
+_worker_source = None
+_worker_agg_layout = None
+_worker_drop = ()
+
+
+def table_to_ipc(table: pa.Table) -> bytes:
+    """ Serialize an arrow table into an arrow IPC stream """
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def ipc_to_table(payload: bytes) -> pa.Table:
+    """ Read an arrow table back from an arrow IPC stream """
+    with pa.ipc.open_stream(pa.py_buffer(payload)) as reader:
+        return reader.read_all()
+
+
+def frame_to_ipc(df: pd.DataFrame) -> bytes:
+    return table_to_ipc(pa.Table.from_pandas(df, preserve_index=False))
+
+
+def ipc_to_frame(payload: bytes) -> pd.DataFrame:
+    return ipc_to_table(payload).to_pandas()
+
+
+def shard_frame(df: pd.DataFrame, key: str, shards: int):
+    """
+    Split a dataframe in shards by the hash of the key column.
+    All the rows with the same key end up in the same shard.
+    """
+    shard_ids = pd.util.hash_pandas_object(df[key], index=False).to_numpy() % shards
+
+    order = np.argsort(shard_ids, kind='stable')
+    bounds = np.searchsorted(shard_ids[order], np.arange(shards + 1))
+
+    return [df.take(order[bounds[i]:bounds[i + 1]]) for i in range(shards)]
+
+
+def _serialize_results(items, agg_layout):
+    """ Convert the (name, value) pairs of the shard output into arrow IPC payloads """
+    results = {}
+
+    for name, value in items:
+        if isinstance(value, pd.DataFrame):
+            results[name] = (KIND_FRAME, frame_to_ipc(value))
+        elif name == AGG_DICT:
+            results[name] = (KIND_AGG, table_to_ipc(agg_dict_to_table(value, *agg_layout)))
+        elif isinstance(value, dict):
+            # string values, or integers (row positions) kept as integers
+            integers = len(value) > 0 and all(isinstance(v, int) for v in value.values())
+            values = pa.array(list(value.values()), type=pa.int64()) if integers \
+                else pa.array([None if v is None else str(v) for v in value.values()], type=pa.string())
+            table = pa.table({'key': pa.array([str(k) for k in value.keys()], type=pa.string()), 'value': values})
+            results[name] = (KIND_MAP, table_to_ipc(table))
+
+    return results
+
+
+def _init_worker(filters, source, agg_layout, drop):
+    global _worker_filters, _worker_source, _worker_agg_layout, _worker_drop
+    _worker_filters = filters
+    _worker_source = source
+    _worker_agg_layout = agg_layout
+    _worker_drop = drop
+
+
+def _run_shard(payload):
+    # imported here to avoid a circular import with processorpipeline
+    from processorpipeline import UsageStatsData
+
+    data = UsageStatsData()
+    data.source = _worker_source
+
+    for name, frame in payload.items():
+        setattr(data, name, ipc_to_frame(frame))
+
+    for filter in _worker_filters:
+        data = filter.run(data)
+
+    # frames not needed after the sharded filters are not sent back
+    data.drop(_worker_drop)
+
+    return _serialize_results(data.items(), _worker_agg_layout)
+
+
+def _deserialize_results(result, agg_layout):
+    """ Partial data object of the arrow IPC payloads of a shard """
+    from processorpipeline import UsageStatsData
+
+    data = UsageStatsData()
+
+    for name, (kind, payload) in result.items():
+        if kind == KIND_FRAME:
+            setattr(data, name, ipc_to_frame(payload))
+        elif kind == KIND_AGG:
+            setattr(data, name, agg_table_to_dict(ipc_to_table(payload), *agg_layout))
+        elif kind == KIND_MAP:
+            table = ipc_to_table(payload).to_pydict()
+            setattr(data, name, dict(zip(table['key'], table['value'])))
+
+    return data
+
+
+def merge_shard_results(data, results, agg_layout):
+    """ Merge the partial results of every shard into data, as the partial data of a stream """
+    from processorpipeline import merge_data
+
+    merged = merge_data((_deserialize_results(result, agg_layout) for result in results), None)
+
+    for name, value in merged.items():
+        setattr(data, name, value)
+
+    return data
+
+
+def run_sharded(data, filters, workers, shard_key, agg_layout, drop=()):
+    """
+    Run the visit local filters over workers shards of the events and visits dataframes.
+    Every shard holds complete visits, so the partial results of the shards are merged
+    by concatenating the dataframes and summing the aggregates, the per identifier values
+    are the ones of the latest row. The fields in drop are released in the workers
+    instead of being transferred back.
+    """
+    from processorpipeline import UsageStatsData
+
+    frame_names = [name for name, value in data.items() if isinstance(value, pd.DataFrame)]
+
+    # the rows keep their position in the whole frame, the latest of the merged per row values is known
+    for name in frame_names:
+        if UsageStatsData.ROW_POSITION not in data.get(name).columns:
+            data.get(name)[UsageStatsData.ROW_POSITION] = np.arange(len(data.get(name)), dtype=np.int64)
+
+    shards = dict((name, shard_frame(data.get(name), shard_key, workers)) for name in frame_names)
+    payloads = [dict((name, frame_to_ipc(shards[name][i])) for name in frame_names) for i in range(workers)]
+    del shards
+
+    # fork keeps the already configured stages (and their db helpers) in the workers
+    context = multiprocessing.get_context('fork')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                             initializer=_init_worker, initargs=(filters, data.source, agg_layout, tuple(drop))) as executor:
+        results = list(executor.map(_run_shard, payloads))
+
+    for name in frame_names:
+        setattr(data, name, None)
+
+    return merge_shard_results(data, results, agg_layout)
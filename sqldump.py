@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Streaming reader of the rows of the INSERT ... VALUES (...),(...); statements of a mysqldump file.
+
+The dump is read in fixed size chunks and tokenized incrementally, so the memory used is one chunk
+plus the row being parsed whatever the size of the dump. Quoted values follow the MySQL rules:
+'' and \\' inside single quotes, backslash escapes (\\n, \\t, \\0, \\Z, ...) and NULL.
+"""
+
+import codecs
+import gzip
+import re
+import time
+
+CHUNK_BYTES = 4 * 1024 * 1024
+
+## longest INSERT ... VALUES header (with the column list) that can be cut by a chunk
+INSERT_TAIL_CHARS = 64 * 1024
+
+## a single row larger than this is considered a broken dump
+MAX_ROW_CHARS = 256 * 1024 * 1024
+
+## the runs of plain characters and the escapes of a quoted value alternate, so a row cut by a chunk
+## fails in linear time without possessive quantifiers (python 3.11+)
+QUOTED = r"'[^'\\]*(?:(?:\\.|'')[^'\\]*)*'"
+UNQUOTED = r"[^,()'\s]+"
+VALUE = r"(?:%s|%s)" % (QUOTED, UNQUOTED)
+
+INSERT_RE = re.compile(r"INSERT\s+(?:IGNORE\s+)?INTO\s+(`(?:[^`]|``)+`|\w+)(?:\s*\([^)]*\))?\s+VALUES\s*", re.IGNORECASE)
+## a row with the separator that follows it, one match per row
+ROW_RE = re.compile(r"\(\s*(%s(?:\s*,\s*%s)*)?\s*\)\s*([,;])\s*" % (VALUE, VALUE), re.DOTALL)
+VALUE_RE = re.compile(VALUE, re.DOTALL)
+
+ESCAPES = {'0': '\0', 'b': '\b', 'n': '\n', 'r': '\r', 't': '\t', 'Z': '\x1a'}
+ESCAPE_RE = re.compile(r"\\(.)|''", re.DOTALL)
+
+
+class SQLDumpError(Exception):
+    pass
+
+
+def decode_value(token):
+    """ Python value of a value token, NULL is None and numbers are kept as text """
+    if token[0] != "'":
+        return None if token.upper() == 'NULL' else token
+
+    value = token[1:-1]
+    if '\\' not in value and "''" not in value:
+        return value
+
+    # \% and \_ keep the backslash, like mysql does
+    def _unescape(match):
+        if match.group(0) == "''":
+            return "'"
+        char = match.group(1)
+        if char in '%_':
+            return '\\' + char
+        return ESCAPES.get(char, char)
+
+    return ESCAPE_RE.sub(_unescape, value)
+
+
+def open_dump(path):
+    """ Binary file object of a dump, gzip compressed dumps are decompressed on the fly """
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+class InsertRowReader:
+    """
+    Iterates (table, values) for every row inserted by the dump. Only the rows of table are
+    returned when it is given. bytes_read and rows are updated while iterating.
+    """
+
+    def __init__(self, file, table=None, chunk_bytes=CHUNK_BYTES):
+        self.file = file
+        self.table = table
+        self.chunk_bytes = chunk_bytes
+        self.bytes_read = 0
+        self.rows = 0
+
+        self._decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self._buffer = ''
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self):
+        """ Append the next chunk to the buffer, False at the end of the file """
+        if self._eof:
+            return False
+
+        chunk = self.file.read(self.chunk_bytes)
+        self.bytes_read += len(chunk)
+
+        # drop what is already parsed before growing the buffer
+        self._buffer = self._buffer[self._pos:] + self._decoder.decode(chunk, final=not chunk)
+        self._pos = 0
+
+        if not chunk:
+            self._eof = True
+        elif len(self._buffer) > MAX_ROW_CHARS:
+            raise SQLDumpError("Row larger than %d chars at byte %d" % (MAX_ROW_CHARS, self.bytes_read))
+
+        return True
+
+    def _match(self, regex):
+        """ Match regex at the current position, reading more of the file while the match may be incomplete """
+        while True:
+            match = regex.match(self._buffer, self._pos)
+            # a match ending at the end of the buffer could continue in the next chunk
+            if match is not None and (match.end() < len(self._buffer) or self._eof):
+                return match
+            if not self._fill():
+                return match
+
+    def _next_insert(self):
+        """ Move past the next INSERT ... VALUES, return the table name or None at the end of the file """
+        while True:
+            match = INSERT_RE.search(self._buffer, self._pos)
+            if match is not None and match.end() < len(self._buffer):
+                self._pos = match.end()
+                return match.group(1).strip('`').replace('``', '`')
+
+            # keep a tail that can hold the beginning of a statement cut by the chunk
+            self._pos = max(self._pos, len(self._buffer) - INSERT_TAIL_CHARS)
+            if not self._fill():
+                return None
+
+    def __iter__(self):
+        while True:
+            table = self._next_insert()
+            if table is None:
+                return
+
+            wanted = self.table is None or table == self.table
+
+            while True:
+                row = ROW_RE.match(self._buffer, self._pos)
+                # the row and its separator may be cut by the end of the chunk
+                if row is None or row.end() == len(self._buffer):
+                    row = self._match(ROW_RE)
+                if row is None:
+                    raise SQLDumpError("Invalid row in the insert into %s at byte ~%d: %r"
+                                       % (table, self.bytes_read, self._buffer[self._pos:self._pos + 80]))
+                self._pos = row.end()
+
+                if wanted:
+                    self.rows += 1
+                    # plain quoted values (the usual case) skip the unescaping
+                    yield table, [token[1:-1] if token[0] == "'" and '\\' not in token and "''" not in token[1:-1] else decode_value(token)
+                                  for token in VALUE_RE.findall(row.group(1) or '')]
+
+                if row.group(2) == ';':
+                    break
+
+
+class ThroughputReporter:
+    """ Prints the bytes/rows throughput of a reader every interval seconds """
+
+    def __init__(self, reader: InsertRowReader, interval=10.0):
+        self.reader = reader
+        self.interval = interval
+        self.start = time.perf_counter()
+        self._last = self.start
+
+    def tick(self):
+        now = time.perf_counter()
+        if now - self._last >= self.interval:
+            self._last = now
+            self.report()
+
+    def report(self, final=False):
+        elapsed = max(time.perf_counter() - self.start, 1e-9)
+        print("%s%.1f MB, %d rows in %.1fs (%.1f MB/s, %.0f rows/s)" % (
+            'Done: ' if final else '', self.reader.bytes_read / 1024 / 1024, self.reader.rows, elapsed,
+            self.reader.bytes_read / 1024 / 1024 / elapsed, self.reader.rows / elapsed))
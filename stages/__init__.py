@@ -1,9 +1,39 @@
-from .aggbyitem_fstage import AggByItemFilterStage
-from .assets_fstage import AssetsFilterStage
-from .elastic_ostage import ElasticOutputStage
-from .metrics_fstage import MetricsFilterStage
-from .robots_fstage import RobotsFilterStage
-from .s3parquet_istage import S3ParquetInputStage
-from .identifier_fstage import IdentifierFilterStage
-from .s3stats_fstage import S3StatsOutputStage
-from .byIdentifier_fstage import ByIdentifierOutputStage
+"""
+Pipeline stages. The stage classes are imported on first access (stages.RobotsFilterStage,
+from stages import RobotsFilterStage or get_class), so an entry point only pays for the imports
+of the stages its pipeline uses.
+"""
+
+import importlib
+
+## stage class -> module of this package
+STAGES = {
+    'AggByItemFilterStage': '.aggbyitem_fstage',
+    'AssetsFilterStage': '.assets_fstage',
+    'DoubleClickFilterStage': '.doubleclick_fstage',
+    'ElasticOutputStage': '.elastic_ostage',
+    'KnownRobotsFilterStage': '.knownrobots_fstage',
+    'MetricsFilterStage': '.metrics_fstage',
+    'RobotsFilterStage': '.robots_fstage',
+    'S3ParquetInputStage': '.s3parquet_istage',
+    'IdentifierFilterStage': '.identifier_fstage',
+    'S3StatsOutputStage': '.s3stats_fstage',
+    'ByIdentifierOutputStage': '.byIdentifier_fstage',
+    'IdentifierLookupInputStage': '.identifierlookup_istage',
+}
+
+__all__ = list(STAGES)
+
+
+def __getattr__(name):
+    if name not in STAGES:
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+    stage = getattr(importlib.import_module(STAGES[name], __name__), name)
+    # cached, the next accesses do not come here
+    globals()[name] = stage
+    return stage
+
+
+def __dir__():
+    return sorted(set(globals()) | set(STAGES))
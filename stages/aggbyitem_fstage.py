@@ -1,11 +1,15 @@
-from processorpipeline import AbstractUsageStatsPipelineStage, UsageStatsData
+from processorpipeline import AbstractUsageStatsPipelineStage, UsageStatsData, merge_data
 from configcontext import ConfigurationContext
-import copy
-import uuid
-import datetime
+from typing import Iterable, Iterator
+from aggutils import add_sketches
+import dictcodes
+import numpy as np
+import pandas as pd
 
 class AggByItemFilterStage(AbstractUsageStatsPipelineStage):
 
+    VISIT_LOCAL = True
+    CONSUMES = ('events_df',)
 
     def __init__(self, configContext: ConfigurationContext):
         super().__init__(configContext)
@@ -13,43 +17,60 @@ class AggByItemFilterStage(AbstractUsageStatsPipelineStage):
         # get the actions from the configuration
         self.actions = configContext.getActions()
 
-        # create an empty entry for the dictionary
-        self.empty_entry = {}
-        for action in self.actions:
-            self.empty_entry[action] = 0
-
         # get the labels from the configuration
         self.COUNTRY_LABEL = configContext.getLabel('COUNTRY')
         self.STATS_BY_COUNTRY_LABEL = configContext.getLabel('STATS_BY_COUNTRY')
         self.OAI_IDENTIFIER_LABEL = configContext.getLabel('OAI_IDENTIFIER')
+        self.ID_VISIT_LABEL = configContext.getLabel('ID_VISIT')
 
     def run(self, data: UsageStatsData) -> UsageStatsData:
 
+        events_df = data.events_df
+
+        # the rows are counted by the codes of the identifier and of the (identifier, country) pair,
+        # the strings are only decoded for the distinct identifiers and countries
+        identifiers, identifier_values = dictcodes.codes(events_df[self.OAI_IDENTIFIER_LABEL])
+        countries, country_values = dictcodes.codes(events_df[self.COUNTRY_LABEL])
+        identifiers, countries = identifiers.astype(np.int64), countries.astype(np.int64)
+
+        flags = np.column_stack([events_df[action].to_numpy() > 0 for action in self.actions]) if len(events_df) > 0 \
+            else np.zeros((0, len(self.actions)), dtype=bool)
+
+        # rows without identifier are not counted
+        counted = identifiers >= 0
+        identifiers, countries, flags = identifiers[counted], countries[counted], flags[counted]
+
+        pairs, pair_values = pd.factorize(identifiers * (len(country_values) + 1) + countries + 1)
+        totals = self._counts(identifiers, flags, len(identifier_values))
+        pair_totals = self._counts(pairs, flags, len(pair_values))
 
-        # create a temporary dictionary to store the data
+        # create a temporary dictionary to store the data, identifiers in order of appearance
         data.agg_dict = {}
-        
-        # iterate over the rows of the dataframe
-        for index, row in data.events_df.iterrows():
-            
-            # get the entry for the identifier or create a new one
-            identifier = row[ self.OAI_IDENTIFIER_LABEL ]
-            entry = data.agg_dict.get(identifier, copy.deepcopy(self.empty_entry) ) 
-            data.agg_dict[identifier] = entry
-
-            # if the entry does not have the stats by country, create a new one
-            if entry.get(self.STATS_BY_COUNTRY_LABEL) is None:
-                entry[self.STATS_BY_COUNTRY_LABEL] = {}
-
-            # get the country and the entry for the country or create a new one
-            country = row[ self.COUNTRY_LABEL ]
-            country_entry = entry[ self.STATS_BY_COUNTRY_LABEL ].get(country, copy.deepcopy(self.empty_entry))
-            entry[ self.STATS_BY_COUNTRY_LABEL ][country] = country_entry
-            
-            for action in self.actions:
-                if row[action] > 0:
-                    entry[action] += 1
-                    country_entry[action] += 1
-                           
+        for code in pd.unique(identifiers).tolist():
+            entry = dict(zip(self.actions, totals[code].tolist()))
+            entry[self.STATS_BY_COUNTRY_LABEL] = {}
+            data.agg_dict[identifier_values[code]] = entry
+
+        for position, pair in enumerate(pair_values.tolist()):
+            identifier, country = divmod(pair, len(country_values) + 1)
+            data.agg_dict[identifier_values[identifier]][self.STATS_BY_COUNTRY_LABEL][dictcodes.decode(country_values, country - 1)] = \
+                dict(zip(self.actions, pair_totals[position].tolist()))
+
+        # the distinct visits (unique visitors) of every identifier and country as hyperloglog sketches
+        add_sketches(data.agg_dict, data.events_df[self.OAI_IDENTIFIER_LABEL], data.events_df[self.COUNTRY_LABEL],
+                     data.events_df[self.ID_VISIT_LABEL], self.STATS_BY_COUNTRY_LABEL)
            
-        return data       
+        return data
+
+    def _counts(self, groups, flags, size):
+        ## rows with every action > 0 by group, one column per action
+        counts = np.zeros((size, len(self.actions)), dtype=np.int64)
+        for column in range(len(self.actions)):
+            counts[:, column] = np.bincount(groups, weights=flags[:, column], minlength=size)
+        return counts
+
+    def run_stream(self, stream: Iterable[UsageStatsData]) -> Iterator[UsageStatsData]:
+
+        # the aggregation is the merge point of the stream, the partial aggregates of the buckets
+        # are summed and the per visit frames are released as soon as every bucket is aggregated
+        yield merge_data((self.run(data) for data in stream), self.getCtx(), keep_frames=False)
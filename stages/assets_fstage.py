@@ -4,6 +4,10 @@ import re
 
 
 class AssetsFilterStage(AbstractUsageStatsPipelineStage):
+
+    VISIT_LOCAL = True
+    CONSUMES = ('events_df',)
+
     def __init__(self, configContext: ConfigurationContext):
         super().__init__(configContext)
         self.REGEX = configContext.getConfig('ASSETS_FILTER','REGEX')
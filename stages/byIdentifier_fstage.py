@@ -4,6 +4,9 @@ from configcontext import ConfigurationContext
 
 
 class ByIdentifierOutputStage(AbstractUsageStatsPipelineStage):
+
+    CONSUMES = ('agg_dict',)
+
     def __init__(self, configContext: ConfigurationContext):
         super().__init__(configContext)
         
@@ -13,20 +16,26 @@ class ByIdentifierOutputStage(AbstractUsageStatsPipelineStage):
         idsite = self.getCtx().getArg('site')
         year = self.getCtx().getArg('year')
         month = self.getCtx().getArg('month')
-        identifier = self.getCtx().getArg('identifier')
+        identifiers = self.getCtx().getArg('identifier')
+
+        # one identifier or a batch of them
+        if isinstance(identifiers, str):
+            identifiers = [identifiers]
+
+        for identifier in identifiers:
 
-        stats =  data.agg_dict.get(identifier) 
+            stats =  data.agg_dict.get(identifier) 
 
-        if stats is None:
-            print("No stats for identifier %s" % identifier)
-            return None
+            if stats is None:
+                print("No stats for identifier %s" % identifier)
+                continue
 
-        ## print views, downloads, conversins and outlinks from dictionary
-        print("Identifier: %s" % identifier)
-        print("Views: %d" % stats['views'])
-        print("Downloads: %d" % stats['downloads'])
-        print("Conversions: %d" % stats['conversions'])
-        print("Outlinks: %d" % stats['outlinks'])
+            ## print views, downloads, conversins and outlinks from dictionary
+            print("Identifier: %s" % identifier)
+            print("Views: %d" % stats['views'])
+            print("Downloads: %d" % stats['downloads'])
+            print("Conversions: %d" % stats['conversions'])
+            print("Outlinks: %d" % stats['outlinks'])
 
 
         return data
@@ -0,0 +1,67 @@
+from processorpipeline import AbstractUsageStatsPipelineStage, UsageStatsData
+from configcontext import ConfigurationContext
+import numpy as np
+import pandas as pd
+
+
+class DoubleClickFilterStage(AbstractUsageStatsPipelineStage):
+    """
+    COUNTER double-click filter: repeated actions of the same type on the same item by the same visit
+    within WINDOW_SECONDS of each other count once, only the last action of every such run is kept.
+    The events are sorted by (idvisit, identifier, action type, server time) over integer codes and an
+    event is dropped when the next event of its group follows within the window, all vectorized.
+    """
+
+    VISIT_LOCAL = True
+    CONSUMES = ('events_df',)
+
+    DEFAULT_WINDOW_SECONDS = 30
+
+    def __init__(self, configContext: ConfigurationContext):
+        super().__init__(configContext)
+
+        self.window_seconds = float(configContext.getConfig('DOUBLE_CLICK_FILTER', 'WINDOW_SECONDS')) if configContext.hasConfig('DOUBLE_CLICK_FILTER', 'WINDOW_SECONDS') else DoubleClickFilterStage.DEFAULT_WINDOW_SECONDS
+
+        # the action types filtered, every type when empty
+        action_types = configContext.getConfig('DOUBLE_CLICK_FILTER', 'ACTION_TYPES').strip() if configContext.hasConfig('DOUBLE_CLICK_FILTER', 'ACTION_TYPES') else ''
+        self.action_types = [int(action_type) for action_type in action_types.split(',') if action_type.strip() != '']
+
+        self.ID_VISIT_LABEL = configContext.getLabel('ID_VISIT')
+        self.OAI_IDENTIFIER_LABEL = configContext.getLabel('OAI_IDENTIFIER')
+        self.ACTION_TYPE_LABEL = configContext.getLabel('ACTION_TYPE')
+
+
+    def double_clicks(self, events_df):
+        """ Boolean mask of the events that are followed by the same action within the window """
+
+        if len(events_df) == 0:
+            return np.zeros(0, dtype=bool)
+
+        # one integer code per (visit, item, action type)
+        visits = pd.factorize(events_df[self.ID_VISIT_LABEL])[0].astype(np.int64)
+        identifiers, identifier_values = pd.factorize(events_df[self.OAI_IDENTIFIER_LABEL])
+        action_types, action_type_values = pd.factorize(events_df[self.ACTION_TYPE_LABEL])
+        groups = pd.factorize(visits * (len(identifier_values) + 1) + identifiers)[0].astype(np.int64) * (len(action_type_values) + 1) + action_types
+        times = events_df['server_time'].to_numpy().astype('datetime64[ns]').astype(np.int64)
+
+        # sorted by group and time, stable so the last of equal times is the one kept
+        order = np.argsort(times, kind='stable')
+        order = order[np.argsort(groups[order], kind='stable')]
+        groups, times = groups[order], times[order]
+
+        repeated = (groups[1:] == groups[:-1]) & (times[1:] - times[:-1] <= int(self.window_seconds * 1e9))
+
+        mask = np.zeros(len(events_df), dtype=bool)
+        mask[order[:-1][repeated]] = True
+
+        if len(self.action_types) > 0:
+            mask &= events_df[self.ACTION_TYPE_LABEL].isin(self.action_types).to_numpy()
+
+        return mask
+
+
+    def run(self, data: UsageStatsData) -> UsageStatsData:
+
+        data.events_df = data.events_df[~self.double_clicks(data.events_df)]
+
+        return data
@@ -1,12 +1,19 @@
 from processorpipeline import AbstractUsageStatsPipelineStage, UsageStatsData
 from configcontext import ConfigurationContext
-import awswrangler as wr
 import sys
 import datetime
-import xxhash
+import hll
 
 class ElasticOutputStage(AbstractUsageStatsPipelineStage):
 
+    CONSUMES = ('agg_dict', 'source', 'country_by_identifier_dict')
+
+    PERSISTS_RESULT = True
+
+    # estimated distinct visits and their base64 hyperloglog sketch, mergeable into month/year estimates (hll.py)
+    UNIQUE_VISITORS = 'unique_visitors'
+    UNIQUE_VISITORS_SKETCH = 'unique_visitors_sketch'
+
     MAPPING = {
         "properties" : {
 
@@ -28,6 +35,11 @@ class ElasticOutputStage(AbstractUsageStatsPipelineStage):
 
     def _build_stats(self, obj, stats):
         obj.update([(action, stats[action]) for action in self.actions])
+
+        sketch = stats.get(hll.SKETCH_KEY)
+        if sketch is not None:
+            obj[self.UNIQUE_VISITORS] = hll.estimate(sketch)
+            obj[self.UNIQUE_VISITORS_SKETCH] = hll.to_base64(sketch)
         return obj
 
 
@@ -57,12 +69,35 @@ class ElasticOutputStage(AbstractUsageStatsPipelineStage):
             self.MAPPING['properties'][action] = { "type" : "long" }
             self.MAPPING['properties'][self.STATS_BY_COUNTRY_LABEL]['properties'][action] = { "type" : "long" }
 
+        # the sketches are only kept in the source, to be merged
+        for properties in (self.MAPPING['properties'], self.MAPPING['properties'][self.STATS_BY_COUNTRY_LABEL]['properties']):
+            properties[self.UNIQUE_VISITORS] = { "type" : "long" }
+            properties[self.UNIQUE_VISITORS_SKETCH] = { "type" : "binary" }
+
         self.helper = configContext.getDBHelper()
 
 
-    def run(self, data: UsageStatsData) -> UsageStatsData:
+    def added_mapping(self):
+        """ Mapping of the fields added after the first indexes were created, put into the existing indexes """
+        properties = self.MAPPING['properties']
+        by_country = properties[self.STATS_BY_COUNTRY_LABEL]['properties']
+        fields = (self.UNIQUE_VISITORS, self.UNIQUE_VISITORS_SKETCH)
+
+        return {
+            "properties" : dict(
+                [(field, properties[field]) for field in fields] +
+                [(self.STATS_BY_COUNTRY_LABEL, { "type": "nested", "properties": dict((field, by_country[field]) for field in fields) })]
+            )
+        }
 
-        helper = self.getCtx().getDBHelper()
+
+    def fingerprint(self):
+        # the level is written in every document
+        return {'level': self.level}
+
+
+    def build_documents(self, data: UsageStatsData):
+        import xxhash
 
         year  = self.getCtx().getArg('year')
         month = self.getCtx().getArg('month')
@@ -72,17 +107,12 @@ class ElasticOutputStage(AbstractUsageStatsPipelineStage):
             day = 1
 
         idsite = self.getCtx().getArg('site')
-        
-        # create the index name
-        index_name = helper.get_index_name(self.index_prefix, idsite)
-
-        source = data.source    
 
          # transform dict_df into a list of documents, converting the dictionary into a list of documents and          
-        data.documents = [
+        return [
             self._build_stats( 
             {
-              'id': xxhash.xxh64( '%s-%s-%s-%s-%s' % (idsite, identifier, year, month, day)  ).hexdigest(),
+              'id': xxhash.xxh64( ('%s-%s-%s-%s-%s' % (idsite, identifier, year, month, day)).encode('utf-8') ).hexdigest(),
   
               'identifier': identifier, 
 
@@ -103,6 +133,20 @@ class ElasticOutputStage(AbstractUsageStatsPipelineStage):
             for identifier, info in data.agg_dict.items()
         ]
 
+
+    def run(self, data: UsageStatsData) -> UsageStatsData:
+        # awswrangler/opensearch are only imported by the runs that index
+        import awswrangler as wr
+
+        helper = self.getCtx().getDBHelper()
+
+        idsite = self.getCtx().getArg('site')
+        
+        # create the index name
+        index_name = helper.get_index_name(self.index_prefix, idsite)
+
+        data.documents = self.build_documents(data)
+
         ## documentes to be indexed in the opensearch
         print ('Indexing %d documents' % len(data.documents))
 
@@ -118,15 +162,18 @@ class ElasticOutputStage(AbstractUsageStatsPipelineStage):
 
 
 
-        try:
-            ## check if the index exist
-            # if not create it
-            
-        
-
-
+        ## check if the index exist
+        # if not create it, else add the new fields to its mapping (the documents with sketches would map them as text)
+        if opensearch.indices.exists(index=index_name):
+            print ('Index %s already exists' % (index_name))
 
+            try:
+                opensearch.indices.put_mapping(index=index_name, body=self.added_mapping())
+            except Exception as e:
+                print("Error updating the mapping of index %s: %s" % (index_name, e))
+                sys.exit(1)
 
+        else:
             index = wr.opensearch.create_index(
                 client=opensearch,
                 mappings=self.MAPPING,
@@ -138,10 +185,6 @@ class ElasticOutputStage(AbstractUsageStatsPipelineStage):
                 },
                 index=index_name,  )
             print ('Index %s created' % (index_name))
-            
-            ## print response
-        except:
-            print ('Index %s already exists' % (index_name))
 
 
         response = wr.opensearch.index_documents(
@@ -153,5 +196,11 @@ class ElasticOutputStage(AbstractUsageStatsPipelineStage):
         )
 
         print ('Indexing response: %s' % response)
+
+        # the bulk failures are returned, not raised (a transport error also ends the indexing with fewer successes)
+        # a partially indexed period must fail, so the run is not recorded as done and its checkpoints are kept
+        failed = len(data.documents) - response.get('success', 0)
+        if response.get('errors') or failed > 0:
+            raise Exception("%d of %d documents could not be indexed in %s" % (max(failed, len(response.get('errors') or [])), len(data.documents), index_name))
                 
         return data
\ No newline at end of file
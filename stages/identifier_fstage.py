@@ -1,11 +1,18 @@
 from processorpipeline import AbstractUsageStatsPipelineStage, UsageStatsData
 from configcontext import ConfigurationContext
+from identifiermap import IdentifierMapIndex, IdentifierMemo
+from aggutils import merge_agg_dicts
+import pandas as pd
+import hashlib
+import os
 import uuid
 import re
 from lareferenciastatsdb import normalize_oai_identifier
 
 class IdentifierFilterStage(AbstractUsageStatsPipelineStage):
 
+    CONSUMES = ('agg_dict', 'source')
+
     IDENTIFIER_MAP_NORMALIZE = 0
     IDENTIFIER_MAP_REGEX_REPLACE = 1
     IDENTIFIER_MAP_FROM_FILE = 2
@@ -14,6 +21,11 @@ class IdentifierFilterStage(AbstractUsageStatsPipelineStage):
         super().__init__(configContext)
         #self.dbhelper = configContext.getDBHelper()
 
+        # directory of the compiled identifier map indexes, a temp directory by default
+        self.map_cache_dir = None
+        if configContext.hasConfig('PROCESSING', 'IDENTIFIER_MAP_CACHE_DIR'):
+            self.map_cache_dir = configContext.getConfig('PROCESSING', 'IDENTIFIER_MAP_CACHE_DIR').strip() or None
+
         
     def run(self, data: UsageStatsData) -> UsageStatsData:
 
@@ -34,18 +46,14 @@ class IdentifierFilterStage(AbstractUsageStatsPipelineStage):
             # print loading message
             print("Loading identifier map from file %s" % identifier_map_filename)
 
+            # the csv is compiled once into a memory-mapped index, rebuilt only when the file changes
             try: 
-                dict_to_search = {}        
-                with open(identifier_map_filename, 'r') as file:
-                    for line in file:
-                        #print(line)
-                        key, value = line.split(',')
-                        dict_to_search[key.strip()] = value.strip()
+                map_index = IdentifierMapIndex.load(identifier_map_filename, self.map_cache_dir)
             except:
                 raise ValueError("Error reading identifier map file %s" % identifier_map_filename)
             
             # print the number of identifiers in the map
-            print("Identifiers in map:", len(dict_to_search.keys()))
+            print("Identifiers in map:", len(map_index))
             
         # if the identifier map type is regex replace, compile the regex
         elif identifier_map_type == IdentifierFilterStage.IDENTIFIER_MAP_REGEX_REPLACE:
@@ -56,29 +64,51 @@ class IdentifierFilterStage(AbstractUsageStatsPipelineStage):
 
         print("Identifiers:", len(data.agg_dict.keys()))
 
-        hits = 0
-        # for every identifier in the data
-        for old_identifier in list(data.agg_dict.keys()):
+        old_identifiers = list(data.agg_dict.keys())
+        new_identifiers = [None] * len(old_identifiers)
 
-            # if the identifier map type is map from file, get the new identifier from the dictionary
-            if identifier_map_type == IdentifierFilterStage.IDENTIFIER_MAP_FROM_FILE:
-                if old_identifier in dict_to_search:
-                    new_identifier = dict_to_search[old_identifier]
+        hits = 0
+        # all the identifiers are looked up in the map at once, the hits keep the mapped identifier
+        if identifier_map_type == IdentifierFilterStage.IDENTIFIER_MAP_FROM_FILE:
+            for position, mapped_identifier in enumerate(map_index.lookup(old_identifiers)):
+                if mapped_identifier is not None:
+                    new_identifiers[position] = mapped_identifier
                     hits += 1
 
-            # normalize the identifier
-            new_identifier = normalize_oai_identifier(old_identifier)
-            
-            # if the identifier map type is regex replace, apply the regex
+        # the rest is normalized (or rewritten by the regex) once per source, the results are memoized on disk
+        pending = [position for position, new_identifier in enumerate(new_identifiers) if new_identifier is None]
+        memo = IdentifierMemo(self.map_cache_dir, self.getCtx().getArg('site'), IdentifierFilterStage._rules_signature(data.source))
+
+        for position, new_identifier in zip(pending, memo.lookup([old_identifiers[position] for position in pending])):
+            new_identifiers[position] = new_identifier
+
+        pending = [position for position in pending if new_identifiers[position] is None]
+        if len(pending) > 0:
+            identifiers = pd.Series([old_identifiers[position] for position in pending], dtype=object)
+
+            # if the identifier map type is regex replace, apply the regex, normalize otherwise
             if identifier_map_type == IdentifierFilterStage.IDENTIFIER_MAP_REGEX_REPLACE:
-                new_identifier = regex.sub(identifier_map_replace, old_identifier)
+                rewritten = identifiers.str.replace(regex, identifier_map_replace, regex=True).tolist()
+            else:
+                rewritten = identifiers.map(normalize_oai_identifier).tolist()
+
+            for position, new_identifier in zip(pending, rewritten):
+                new_identifiers[position] = new_identifier
 
-            #print(old_identifier, " --> " ,new_identifier)
+            memo.add(identifiers.tolist(), rewritten)
+            memo.save()
 
-            # if the identifier has changed, update the dictionary
-            if new_identifier != old_identifier:
-                data.agg_dict[new_identifier] = data.agg_dict.pop(old_identifier)
-                ##file.write(old_identifier + " --> " + str(new_identifier) + "\n")
+        print("Identifiers memoized:", len(old_identifiers) - len(pending) - hits, "new:", len(pending))
+
+        # rebuild the dictionary, identifiers that end up equal are merged summing their stats
+        agg_dict = {}
+        for old_identifier, new_identifier in zip(old_identifiers, new_identifiers):
+            entry = data.agg_dict[old_identifier]
+            if new_identifier in agg_dict:
+                merge_agg_dicts(agg_dict[new_identifier], entry)
+            else:
+                agg_dict[new_identifier] = entry
+        data.agg_dict = agg_dict
 
         if identifier_map_type == IdentifierFilterStage.IDENTIFIER_MAP_FROM_FILE:
             print("Hits in map:", hits)
@@ -86,6 +116,31 @@ class IdentifierFilterStage(AbstractUsageStatsPipelineStage):
         print("Normalized identifiers:", len(data.agg_dict.keys()))
 
 
-        return data       
+        return data
+
+    def fingerprint(self):
+
+        source = self.getCtx().getDBHelper().get_source_by_site_id(int(self.getCtx().getArg('site')))
+        filename = getattr(source, 'identifier_map_filename', None)
+
+        settings = {'map_type': getattr(source, 'identifier_map_type', None),
+                    'map_filename': filename,
+                    'prefix': getattr(source, 'identifier_prefix', None),
+                    'rules': IdentifierFilterStage._rules_signature(source)}
+
+        # a new map file content is seen through its size/mtime, hashing it on every run costs too much
+        if filename and os.path.exists(filename):
+            stat = os.stat(filename)
+            settings['map_file'] = [stat.st_size, stat.st_mtime_ns]
 
+        return settings
 
+    def _rules_signature(source):
+        ## identifies the rewrite rules of a source, the memo of other rules is not reused
+        if source.identifier_map_type == IdentifierFilterStage.IDENTIFIER_MAP_REGEX_REPLACE:
+            rules = 'regex:%s:%s' % (source.identifier_map_regex, source.identifier_map_replace)
+        else:
+            # the normalization function is part of lareferenciastatsdb, a new version starts a new memo
+            code = normalize_oai_identifier.__code__
+            rules = 'normalize:%s:%s' % (code.co_code.hex(), repr(code.co_consts))
+        return hashlib.sha1(rules.encode('utf-8')).hexdigest()
@@ -0,0 +1,59 @@
+from processorpipeline import UsageStatsData
+from configcontext import ConfigurationContext
+from stages.s3parquet_istage import S3ParquetInputStage
+import storage
+import logging
+import time
+
+logger = logging.getLogger()
+
+
+class IdentifierLookupInputStage(S3ParquetInputStage):
+    """
+    Input stage of the lookups of a few identifiers (the identifier argument, a string or a list).
+    The identifier predicate is pushed into the parquet scan: only the row groups of the events whose
+    statistics can hold the identifiers are read, and then only the visits of those events. Every filter
+    and aggregation works per visit and identifier, so the stats of the identifiers are the same as
+    the ones of the whole period.
+    """
+
+    def __init__(self, configContext: ConfigurationContext):
+        super().__init__(configContext)
+
+        identifiers = configContext.getArg('identifier')
+        self.identifiers = [identifiers] if isinstance(identifiers, str) else list(identifiers)
+
+
+    def fingerprint(self):
+        return dict(super().fingerprint(), identifiers=sorted(self.identifiers))
+
+
+    def run(self, data: UsageStatsData) -> UsageStatsData:
+
+        source = self._load_source(data)
+
+        ctx = self.getCtx()
+        partitions = S3ParquetInputStage._partition_prefix(ctx.getArg('site'), ctx.getArg('year'), ctx.getArg('month'), ctx.getArg('day'))
+
+        start = time.perf_counter()
+        events_stats, visits_stats = {}, {}
+
+        # the events of the identifiers, by the statistics of the identifier column
+        events_df = storage.read_parquet_where(self.events_path, S3ParquetInputStage._identifier_custom_var(source.type), self.identifiers,
+                                               columns=S3ParquetInputStage._events_columns(source.type), partitions=partitions, stats=events_stats)
+        data.events_df = self._prepare_events(events_df, source)
+
+        # and their visits, by the statistics of idvisit
+        visits_df = None
+        if len(data.events_df) > 0:
+            visits_df = storage.read_parquet_where(self.visits_path, self.ID_VISIT_LABEL, data.events_df[self.ID_VISIT_LABEL].unique().tolist(),
+                                                   columns=self._visits_columns(), partitions=partitions, stats=visits_stats)
+        data.visits_df = self._prepare_visits(visits_df)
+
+        self._encode(data.events_df, data.visits_df)
+
+        logger.info("Lookup of %d identifiers: %d events (%d/%d row groups), %d visits (%d/%d row groups) in %.2fs" % (
+            len(self.identifiers), len(data.events_df), events_stats.get('row_groups_read', 0), events_stats.get('row_groups', 0),
+            len(data.visits_df), visits_stats.get('row_groups_read', 0), visits_stats.get('row_groups', 0), time.perf_counter() - start))
+
+        return data
@@ -0,0 +1,87 @@
+from processorpipeline import AbstractUsageStatsPipelineStage, UsageStatsData
+from configcontext import ConfigurationContext
+from botmatcher import IPRangeMatcher, UserAgentMatcher, read_list
+import os
+
+
+class KnownRobotsFilterStage(AbstractUsageStatsPipelineStage):
+    """
+    Filters the visits of known robots by user agent and ip, also the ones whose pacing looks human.
+    The patterns (case insensitive substrings) and the ranges come from the list files of the
+    KNOWN_ROBOTS_FILTER section. The stage is disabled without list files and then the input stage
+    does not read its columns.
+    """
+
+    VISIT_LOCAL = True
+    CONSUMES = ('events_df', 'visits_df')
+
+    DEFAULT_USER_AGENT_COLUMN = 'user_agent'
+    DEFAULT_IP_COLUMN = 'location_ip'
+
+    def __init__(self, configContext: ConfigurationContext):
+        super().__init__(configContext)
+
+        def _option(option, default=''):
+            value = configContext.getConfig('KNOWN_ROBOTS_FILTER', option).strip() if configContext.hasConfig('KNOWN_ROBOTS_FILTER', option) else ''
+            return value if value != '' else default
+
+        self.user_agents_file = _option('USER_AGENTS_FILE')
+        self.ip_ranges_file = _option('IP_RANGES_FILE')
+        self.user_agent_column = _option('USER_AGENT_COLUMN', KnownRobotsFilterStage.DEFAULT_USER_AGENT_COLUMN)
+        self.ip_column = _option('IP_COLUMN', KnownRobotsFilterStage.DEFAULT_IP_COLUMN)
+
+        # the lists are compiled once, the decisions of the matchers are kept for every bucket/run of the process
+        self.user_agents = UserAgentMatcher(read_list(self.user_agents_file)) if self.user_agents_file else None
+        self.ip_ranges = IPRangeMatcher(read_list(self.ip_ranges_file)) if self.ip_ranges_file else None
+
+        self.enabled = self.user_agents is not None or self.ip_ranges is not None
+
+        self.IDVISIT = configContext.getLabel('ID_VISIT')
+
+
+    def visits_columns(self):
+        return [column for column, matcher in self._matchers()]
+
+
+    def _matchers(self):
+        matchers = []
+        if self.user_agents is not None:
+            matchers.append((self.user_agent_column, self.user_agents))
+        if self.ip_ranges is not None:
+            matchers.append((self.ip_column, self.ip_ranges))
+        return matchers
+
+
+    def fingerprint(self):
+        # new list contents are seen through their size/mtime
+        files = {}
+        for path in (self.user_agents_file, self.ip_ranges_file):
+            if path and os.path.exists(path):
+                stat = os.stat(path)
+                files[path] = [stat.st_size, stat.st_mtime_ns]
+        return {'files': files}
+
+
+    def robots(self, visits_df):
+        """ Boolean array, True for the visits of a known robot user agent or ip """
+        mask = None
+        for column, matcher in self._matchers():
+            matches = matcher.match_values(visits_df[column].to_numpy())
+            mask = matches if mask is None else mask | matches
+        return mask
+
+
+    def run(self, data: UsageStatsData) -> UsageStatsData:
+
+        if not self.enabled:
+            return data
+
+        # the user agent and ip columns are not needed after the classification
+        robots = self.robots(data.visits_df)
+        data.visits_df = data.visits_df.drop(columns=self.visits_columns())[~robots]
+
+        # filter the events dataframe with the visits dataframe, not copied when no visit is a robot
+        if robots.any():
+            data.events_df = data.events_df[data.events_df[self.IDVISIT].isin(data.visits_df[self.IDVISIT])]
+
+        return data
@@ -1,8 +1,20 @@
 from processorpipeline import AbstractUsageStatsPipelineStage, UsageStatsData
 from configcontext import ConfigurationContext
+import dictcodes
+import numpy as np
+import pandas as pd
 
 
 class MetricsFilterStage(AbstractUsageStatsPipelineStage):
+    """
+    One row per (visit, identifier) with a 0/1 uint8 column per action. The action types of the
+    events are folded into one bit per action, or-ed by group over the identifier codes, and only
+    the visit columns the aggregation reads are joined.
+    """
+
+    VISIT_LOCAL = True
+    CONSUMES = ('events_df', 'visits_df')
+
     def __init__(self, configContext: ConfigurationContext):
         super().__init__(configContext)
 
@@ -16,33 +28,72 @@ class MetricsFilterStage(AbstractUsageStatsPipelineStage):
         self.ID_VISIT_LABEL = configContext.getLabel('ID_VISIT')
         self.COUNTRY_LABEL = configContext.getLabel('COUNTRY')
 
-    
+        ## visit columns joined to the rows, the ones AggByItemFilterStage reads
+        self.VISIT_COLUMNS = [self.COUNTRY_LABEL]
+
+
+    def _country_by_identifier(self, events_df, identifiers, identifier_values):
+        ## the country of the last event of every identifier with a non empty country, and the row position of that event
+        countries, country_values = dictcodes.codes(events_df[self.COUNTRY_LABEL])
+        non_empty = np.array([country != '' for country in country_values] + [False], dtype=bool)
+        rows = np.flatnonzero((identifiers >= 0) & non_empty[countries])
+
+        # the rows of shards and buckets carry their position in the whole period, the rows of the
+        # shards merged back are not in that order
+        if UsageStatsData.ROW_POSITION in events_df.columns:
+            positions = events_df[UsageStatsData.ROW_POSITION].to_numpy()
+            if not pd.Index(positions[rows]).is_monotonic_increasing:
+                rows = rows[np.argsort(positions[rows], kind='stable')]
+        else:
+            positions = np.arange(len(events_df))
+
+        # the first occurrence in the reversed rows is the last one
+        last_identifiers, last = np.unique(identifiers[rows][::-1], return_index=True)
+        last_rows = rows[::-1][last]
+
+        identifiers = [identifier_values[identifier] for identifier in last_identifiers.tolist()]
+        return dict(zip(identifiers, (country_values[country] for country in countries[last_rows].tolist()))), \
+            dict(zip(identifiers, positions[last_rows].tolist()))
+
+
     def run(self, data: UsageStatsData) -> UsageStatsData:
 
-        actions = []    
+        events_df = data.events_df
+        identifiers, identifier_values = dictcodes.codes(events_df[self.OAI_IDENTIFIER_LABEL])
 
-        # initialize the views, outlinks and downloads columns
-        for action, action_id in zip(self.actions, self.actions_id):
-            if ( action_id > 0 ):
-                data.events_df[action] = 0
-                data.events_df.loc[data.events_df[ self.ACTION_TYPE_LABEL ] == action_id, action] = 1
-                actions.append(action) 
+        data.country_by_identifier_dict, data.country_by_identifier_positions = self._country_by_identifier(events_df, identifiers, identifier_values)
 
-        ## create dataframe with the columns oai_identifier and country, where country in not null or empty string
-        country_df = data.events_df[ (data.events_df[self.COUNTRY_LABEL].notnull()) & (data.events_df[self.COUNTRY_LABEL] != '') ]
-        ## create a dict based on the country_df dataframe, where the key is the oai_identifier and the value is the country
-        data.country_by_identifier_dict = country_df.set_index(self.OAI_IDENTIFIER_LABEL)[self.COUNTRY_LABEL].to_dict()
+        # one bit per action of the event type, the events without identifier are not grouped
+        actions = [action for action, action_id in zip(self.actions, self.actions_id) if action_id > 0]
+        action_types = events_df[self.ACTION_TYPE_LABEL].to_numpy()
+        bits = np.zeros(len(events_df), dtype=np.uint8)
+        for bit, action_id in enumerate(action_id for action_id in self.actions_id if action_id > 0):
+            bits[action_types == action_id] |= 1 << bit
 
+        grouped = identifiers >= 0
+        visits, visit_values = pd.factorize(events_df[self.ID_VISIT_LABEL].to_numpy()[grouped], sort=True)
+        size = max(len(identifier_values), 1)
 
-        # group by idvisit and oai_identifier and sum the views, outlinks and downloads columns
-        data.events_df = data.events_df.groupby([self.ID_VISIT_LABEL, self.OAI_IDENTIFIER_LABEL]).agg( dict((action,'max') for action in actions )).reset_index()
+        # the groups sorted by visit and identifier, the bits of their events or-ed
+        keys, groups = np.unique(visits.astype(np.int64) * size + identifiers[grouped], return_inverse=True)
+        masks = np.zeros(len(keys), dtype=np.uint8)
+        for bit in range(len(actions)):
+            masks[groups[(bits[grouped] >> bit) & 1 == 1]] |= 1 << bit
 
-        # merge the events and visits dataframes on the idvisit column
-        data.events_df = data.events_df.merge(data.visits_df, on='idvisit')
-        
-        # create a new column called conversions that is 1 if the views and downloads columns are 1, 0 otherwise
-        data.events_df['conversions'] = ( (data.events_df['views'] == 1) & ( ( (data.events_df['downloads'] == 1) | (data.events_df['outlinks'] == 1)))).astype(int)
-        
-        return data       
+        identifier_codes = keys % size
+        if isinstance(events_df[self.OAI_IDENTIFIER_LABEL].dtype, pd.CategoricalDtype):
+            identifier_column = pd.Categorical.from_codes(identifier_codes, dtype=events_df[self.OAI_IDENTIFIER_LABEL].dtype)
+        else:
+            identifier_column = identifier_values[identifier_codes]
 
+        data.events_df = pd.DataFrame({self.ID_VISIT_LABEL: np.asarray(visit_values)[keys // size], self.OAI_IDENTIFIER_LABEL: identifier_column})
+        for bit, action in enumerate(actions):
+            data.events_df[action] = (masks >> bit) & 1
+
+        # join the country of the visit, only the visits that are still in visits_df
+        data.events_df = data.events_df.merge(data.visits_df[[self.ID_VISIT_LABEL] + self.VISIT_COLUMNS], on=self.ID_VISIT_LABEL)
+
+        # create a new column called conversions that is 1 if the views and downloads columns are 1, 0 otherwise
+        data.events_df['conversions'] = ( (data.events_df['views'] == 1) & ( ( (data.events_df['downloads'] == 1) | (data.events_df['outlinks'] == 1)))).astype(np.uint8)
 
+        return data
@@ -3,6 +3,10 @@ from configcontext import ConfigurationContext
 
 
 class RobotsFilterStage(AbstractUsageStatsPipelineStage):
+
+    VISIT_LOCAL = True
+    CONSUMES = ('events_df', 'visits_df')
+
     def __init__(self, configContext: ConfigurationContext):
         super().__init__(configContext)
         
@@ -1,11 +1,30 @@
 from processorpipeline import AbstractUsageStatsPipelineStage, UsageStatsData
 from configcontext import ConfigurationContext
+from sharding import shard_frame
+import dictcodes
+from typing import Iterable, Iterator
+from pyarrow import feather
+import numpy as np
 import pandas as pd
-import awswrangler as wr
+import storage
+import glob
+import os
+import shutil
+import tempfile
 from lareferenciastatsdb import SOURCE_TYPE_NATIONAL, SOURCE_TYPE_REGIONAL, SOURCE_TYPE_REPOSITORY
 
 
 class S3ParquetInputStage(AbstractUsageStatsPipelineStage):
+
+    # set the custom var for the record info
+    RECORD_INFO_CUSTOM_VAR = 'custom_var_v2'
+
+    # set the columns to read from the visits file
+    VISITS_COLUMNS = ['idvisit', 'visit_last_action_time', 'visit_first_action_time', 'visit_total_actions', 'location_country']
+
+    # defaults for the streaming mode
+    DEFAULT_STREAM_BUCKETS = 16
+    DEFAULT_STREAM_CHUNK_ROWS = 1000000
     
     def __init__(self, configContext: ConfigurationContext):
         super().__init__(configContext)
@@ -17,11 +36,29 @@ class S3ParquetInputStage(AbstractUsageStatsPipelineStage):
         # get the labels from the configuration
         self.COUNTRY_LABEL = configContext.getLabel('COUNTRY')
         self.OAI_IDENTIFIER_LABEL = configContext.getLabel('OAI_IDENTIFIER')
+        self.ID_VISIT_LABEL = configContext.getLabel('ID_VISIT')
+
+        # number of idvisit buckets and rows per read chunk used by run_stream
+        self.stream_buckets = int(configContext.getConfig('PROCESSING', 'STREAM_BUCKETS')) if configContext.hasConfig('PROCESSING', 'STREAM_BUCKETS') else S3ParquetInputStage.DEFAULT_STREAM_BUCKETS
+        self.stream_chunk_rows = int(configContext.getConfig('PROCESSING', 'STREAM_CHUNK_ROWS')) if configContext.hasConfig('PROCESSING', 'STREAM_CHUNK_ROWS') else S3ParquetInputStage.DEFAULT_STREAM_CHUNK_ROWS
 
         self.usage_stats_db_uri = configContext.getConfig('USAGE_STATS_DB','SQLALCHEMY_DATABASE_URI')
 
         self.db_helper = configContext.getDBHelper()
 
+        # visit columns read for the filters of the pipeline (project_visits_columns)
+        self.extra_visits_columns = []
+
+
+
+    def project_visits_columns(self, columns):
+        for column in columns:
+            if column not in self._visits_columns():
+                self.extra_visits_columns.append(column)
+
+
+    def _visits_columns(self):
+        return S3ParquetInputStage.VISITS_COLUMNS + self.extra_visits_columns
 
 
     def _partition_filter(idsite, year, month, day):
@@ -42,27 +79,44 @@ class S3ParquetInputStage(AbstractUsageStatsPipelineStage):
         
         
     
-    def _read_parquet_file(bucket_path, columns, partition_filter):
-            
+    def _read_parquet_file(bucket_path, columns, partition_filter, chunked=False, errors=None):
+
+        # the paths that could not be read are added to errors, a dataset without files is not an error
         try: 
-            df = wr.s3.read_parquet(
-            path='s3://' + bucket_path,
-            dataset=True,
+            # bucket_path is a s3:// or file:// uri, a bare path is read from s3
+            df = storage.read_parquet(
+            bucket_path,
+            columns=columns,
             partition_filter = partition_filter,
-            columns=columns
+            chunked=chunked
             )
             return df
         
-        except:
-            print("Error reading parquet file %s" % bucket_path)
+        except Exception as e:
+            print("Error reading parquet file %s: %s" % (bucket_path, e))
+            if errors is not None and not storage.is_missing(e):
+                errors.append(bucket_path)
+
+
+    def _read_parquet_chunks(bucket_path, columns, partition_filter, chunk_rows, errors=None):
+
+        # yields dataframes of at most chunk_rows rows, nothing if the dataset can not be read
+        chunks = S3ParquetInputStage._read_parquet_file(bucket_path, columns, partition_filter, chunked=chunk_rows, errors=errors)
+
+        if chunks is None:
+            return
+
+        try:
+            for chunk in chunks:
+                yield chunk
+        except Exception as e:
+            print("Error reading parquet file %s: %s" % (bucket_path, e))
+            if errors is not None:
+                errors.append(bucket_path)
             
     
-    
-    def run(self, data: UsageStatsData) -> UsageStatsData:
+    def _load_source(self, data: UsageStatsData):
 
-        year = self.getCtx().getArg('year')
-        month = self.getCtx().getArg('month')
-        day = self.getCtx().getArg('day')
         idsite = self.getCtx().getArg('site')
 
         source = self.db_helper.get_source_by_site_id(int(idsite))
@@ -73,59 +127,207 @@ class S3ParquetInputStage(AbstractUsageStatsPipelineStage):
         ## add the source to the data object
         data.source = source
 
-        type = source.type
+        return source
+
+
+    def _partition_prefix(idsite, year, month, day):
+        # hive partitions of the run, in the order matomo2parquet writes them
+        partitions = [('idsite', idsite), ('year', year)]
+        if month is not None:
+            partitions.append(('month', month))
+            if day is not None:
+                partitions.append(('day', day))
+        return partitions
+
+
+    def fingerprint(self):
+
+        ctx = self.getCtx()
+        source = self.db_helper.get_source_by_site_id(int(ctx.getArg('site')))
+        partitions = S3ParquetInputStage._partition_prefix(ctx.getArg('site'), ctx.getArg('year'), ctx.getArg('month'), ctx.getArg('day'))
 
-        partition_filter = S3ParquetInputStage._partition_filter(idsite, year, month, day)
+        # the files of the partitions of the run, a rewritten partition changes its size/etag
+        return {'source': {'type': getattr(source, 'type', None), 'country_iso': getattr(source, 'country_iso', None)},
+                'events': storage.list_files(self.events_path, partitions),
+                'visits': storage.list_files(self.visits_path, partitions)}
 
+
+    def _partition_filter_from_args(self):
+        
+        year = self.getCtx().getArg('year')
+        month = self.getCtx().getArg('month')
+        day = self.getCtx().getArg('day')
+        idsite = self.getCtx().getArg('site')
+
+        return S3ParquetInputStage._partition_filter(idsite, year, month, day)
+
+
+    def _identifier_custom_var(type):
         # set the custom_var column name based on the type
-        identifier_custom_var = 'custom_var_v1' if type == SOURCE_TYPE_REPOSITORY else 'custom_var_v6'
+        return 'custom_var_v1' if type == SOURCE_TYPE_REPOSITORY else 'custom_var_v6'
+
 
-        # set the custom var for the record info
-        record_info_custom_var = 'custom_var_v2'
+    def _events_columns(type):
 
-        # set the columns to read based on the type
-        events_columns = ['idlink_va', 'idvisit','server_time', identifier_custom_var, 'action_type', 'action_url', 'action_url_prefix']
+        # set the columns to read based on the type, only the ones the filters read
+        events_columns = ['idvisit','server_time', S3ParquetInputStage._identifier_custom_var(type), 'action_type', 'action_url']
         
         ## add the record info column if the source is regional
         if type == SOURCE_TYPE_REGIONAL:
-            events_columns.append(record_info_custom_var)
-        
-        # read the events file       
-        data.events_df = S3ParquetInputStage._read_parquet_file( self.events_path, events_columns, partition_filter )
+            events_columns.append(S3ParquetInputStage.RECORD_INFO_CUSTOM_VAR)
+
+        return events_columns
+
+
+    def _prepare_events(self, events_df, source):
+
+        type = source.type
+        record_info_custom_var = S3ParquetInputStage.RECORD_INFO_CUSTOM_VAR
         
         # if the events file is empty, create an empty dataframe
-        if data.events_df is None:
-            data.events_df = pd.DataFrame(columns= events_columns)
+        if events_df is None:
+            events_df = pd.DataFrame(columns= S3ParquetInputStage._events_columns(type))
             # set server_time to datetime
-            data.events_df['server_time'] = pd.to_datetime(data.events_df['server_time'])
+            events_df['server_time'] = pd.to_datetime(events_df['server_time'])
         
         # rename the custom_var_v1 column to oai_identifier
-        data.events_df = data.events_df.rename(columns={ identifier_custom_var: self.OAI_IDENTIFIER_LABEL })
+        events_df = events_df.rename(columns={ S3ParquetInputStage._identifier_custom_var(type): self.OAI_IDENTIFIER_LABEL })
 
         if type == SOURCE_TYPE_REGIONAL:
-            ## parse the first two letters of the record info if the patter is XX_XXXXX if the field is not empty
-            data.events_df[record_info_custom_var] = data.events_df[record_info_custom_var].apply(lambda x: x[:2] if x is not None and not pd.isna(x) and len(x) > 2 else None)
+            ## parse the first two letters of the record info if the patter is XX_XXXXX if the field is not empty, once per distinct value
+            codes, values = pd.factorize(events_df[record_info_custom_var])
+            countries = pd.Series([x[:2] if len(x) > 2 else None for x in values], dtype=object)
+            events_df[record_info_custom_var] = countries.reindex(codes).to_numpy() if len(values) > 0 else None
             ## rename the record info column to country
-            data.events_df = data.events_df.rename(columns={record_info_custom_var: self.COUNTRY_LABEL})
+            events_df = events_df.rename(columns={record_info_custom_var: self.COUNTRY_LABEL})
         else:
-            data.events_df[self.COUNTRY_LABEL] = source.country_iso
+            events_df[self.COUNTRY_LABEL] = source.country_iso
 
+        return events_df
 
-        # set the columns to read from the visits file
-        visits_columns = ['idvisit', 'visit_last_action_time', 'visit_first_action_time', 'visit_total_actions', 'location_country']
 
-        # read the visits file
-        data.visits_df = S3ParquetInputStage._read_parquet_file ( self.visits_path, visits_columns, partition_filter )
+    def _prepare_visits(self, visits_df):
         
         # if the visits file is empty, create an empty dataframe
-        if data.visits_df is None:
-            data.visits_df = pd.DataFrame(columns=visits_columns)
+        if visits_df is None:
+            visits_df = pd.DataFrame(columns=self._visits_columns())
+            # set the action times to datetime
+            for column in ('visit_first_action_time', 'visit_last_action_time'):
+                visits_df[column] = pd.to_datetime(visits_df[column])
         
         # rename the location_country column to country
-        data.visits_df = data.visits_df.rename(columns={'location_country': self.COUNTRY_LABEL})
+        return visits_df.rename(columns={'location_country': self.COUNTRY_LABEL})
+
+
+    def _encode(self, events_df, visits_df):
+        # the identifiers and the countries travel as codes of dictionaries shared by the events and the visits
+        dictcodes.encode([events_df], self.OAI_IDENTIFIER_LABEL)
+        dictcodes.encode([events_df, visits_df], self.COUNTRY_LABEL)
+    
+    
+    def run(self, data: UsageStatsData) -> UsageStatsData:
+
+        source = self._load_source(data)
+
+        partition_filter = self._partition_filter_from_args()
+        errors = []
+
+        # read the events file       
+        data.events_df = self._prepare_events( S3ParquetInputStage._read_parquet_file( self.events_path, S3ParquetInputStage._events_columns(source.type), partition_filter, errors=errors ), source )
+
+        # read the visits file
+        data.visits_df = self._prepare_visits( S3ParquetInputStage._read_parquet_file ( self.visits_path, self._visits_columns(), partition_filter, errors=errors ) )
+
+        self._encode(data.events_df, data.visits_df)
+
+        # the data of a failed read is incomplete, the run is not recorded as done
+        if errors:
+            data.input_errors = errors
         
         return data
-  
 
 
-     
\ No newline at end of file
+    def _spill(self, chunks, name, spill_dir):
+
+        # partition every chunk by the hash of idvisit and write the pieces to the bucket directories,
+        # the rows keep their position in the whole dataset
+        position = 0
+        for chunk_num, chunk in enumerate(chunks):
+            chunk[UsageStatsData.ROW_POSITION] = np.arange(position, position + len(chunk), dtype=np.int64)
+            position += len(chunk)
+            for bucket, piece in enumerate(shard_frame(chunk, self.ID_VISIT_LABEL, self.stream_buckets)):
+                if len(piece) > 0:
+                    feather.write_feather(piece, os.path.join(spill_dir, '%s_%05d_%06d.arrow' % (name, bucket, chunk_num)), compression='uncompressed')
+
+
+    def _read_bucket(spill_dir, name, bucket):
+
+        paths = sorted(glob.glob(os.path.join(spill_dir, '%s_%05d_*.arrow' % (name, bucket))))
+        
+        if len(paths) == 0:
+            return None
+        
+        df = pd.concat([feather.read_feather(path) for path in paths], ignore_index=True)
+        
+        for path in paths:
+            os.remove(path)
+        
+        return df
+
+
+    def _bucket_data(self, source, events_df, visits_df, errors):
+
+        bucket_data = UsageStatsData()
+        bucket_data.source = source
+        if errors:
+            bucket_data.input_errors = errors
+        bucket_data.events_df = events_df if events_df is not None else self._prepare_events(None, source)
+        bucket_data.visits_df = visits_df if visits_df is not None else self._prepare_visits(None)
+        self._encode(bucket_data.events_df, bucket_data.visits_df)
+        return bucket_data
+
+
+    def run_stream(self, stream: Iterable[UsageStatsData]) -> Iterator[UsageStatsData]:
+        for data in stream:
+            yield from self._stream_buckets(data)
+
+
+    def _stream_buckets(self, data: UsageStatsData) -> Iterator[UsageStatsData]:
+        """
+        Read the events and visits in chunks of rows and yield them grouped in buckets of complete visits.
+        The chunks are partitioned by the hash of idvisit into local arrow files, so only one bucket
+        is held in memory at a time.
+        """
+
+        source = self._load_source(data)
+
+        partition_filter = self._partition_filter_from_args()
+
+        spill_dir = tempfile.mkdtemp(prefix='usage_stats_stream_')
+        errors = []
+
+        try:
+            events_chunks = S3ParquetInputStage._read_parquet_chunks(self.events_path, S3ParquetInputStage._events_columns(source.type), partition_filter, self.stream_chunk_rows, errors)
+            self._spill((self._prepare_events(chunk, source) for chunk in events_chunks), 'events', spill_dir)
+
+            visits_chunks = S3ParquetInputStage._read_parquet_chunks(self.visits_path, self._visits_columns(), partition_filter, self.stream_chunk_rows, errors)
+            self._spill((self._prepare_visits(chunk) for chunk in visits_chunks), 'visits', spill_dir)
+
+            empty = True
+            for bucket in range(self.stream_buckets):
+                events_df = S3ParquetInputStage._read_bucket(spill_dir, 'events', bucket)
+                visits_df = S3ParquetInputStage._read_bucket(spill_dir, 'visits', bucket)
+
+                # skip the buckets without data
+                if events_df is None and visits_df is None:
+                    continue
+
+                empty = False
+                yield self._bucket_data(source, events_df, visits_df, errors)
+
+            # a period without data is one empty bucket, as in run
+            if empty:
+                yield self._bucket_data(source, None, None, errors)
+
+        finally:
+            shutil.rmtree(spill_dir, ignore_errors=True)
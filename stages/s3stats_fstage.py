@@ -4,6 +4,9 @@ from configcontext import ConfigurationContext
 
 
 class S3StatsOutputStage(AbstractUsageStatsPipelineStage):
+
+    CONSUMES = ('events_df',)
+
     def __init__(self, configContext: ConfigurationContext):
         super().__init__(configContext)
         
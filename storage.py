@@ -0,0 +1,382 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Parquet dataset storage over s3:// and file:// URIs.
+
+VISITS_PATH/EVENTS_PATH keep working as bare bucket paths (read as s3://). A file:// URI
+selects the local backend, a hive partitioned dataset laid out like the one awswrangler
+writes on s3, useful for offline runs, benchmarks and as a staging tier on on-prem workers.
+"""
+
+import bisect
+import contextlib
+import io
+import os
+import shutil
+import uuid
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+SCHEME_S3 = 's3'
+SCHEME_FILE = 'file'
+
+## write modes, same names as awswrangler
+MODE_APPEND = 'append'
+MODE_OVERWRITE = 'overwrite'
+MODE_OVERWRITE_PARTITIONS = 'overwrite_partitions'
+
+## rows per row group of the sorted layout, small groups give selective min/max statistics
+SORTED_ROW_GROUP_ROWS = 16384
+
+
+def split_uri(path):
+    """ Return (scheme, location), a path without scheme is an s3 bucket path """
+    if path.startswith('s3://'):
+        return SCHEME_S3, path[len('s3://'):]
+    if path.startswith('file://'):
+        return SCHEME_FILE, path[len('file://'):]
+    return SCHEME_S3, path
+
+
+def to_uri(path):
+    scheme, location = split_uri(path)
+    return '%s://%s' % (scheme, location)
+
+
+def _partition_files(root, partition_filter):
+    """ Parquet files of the hive partitions under root accepted by partition_filter """
+    files = []
+
+    for directory, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        relative = os.path.relpath(directory, root)
+
+        partitions = {}
+        if relative != '.':
+            for part in relative.split(os.sep):
+                if '=' in part:
+                    key, value = part.split('=', 1)
+                    partitions[key] = value
+
+        # like awswrangler the filter gets every partition value as a string
+        if partition_filter is not None and len(partitions) > 0 and not dirnames and not partition_filter(partitions):
+            continue
+
+        files.extend(os.path.join(directory, name) for name in sorted(filenames) if name.endswith('.parquet'))
+
+    return files
+
+
+def _prefix_objects(path, partitions):
+    """ (scheme, [(location, relative key, size, tag)]) of the files under the hive partition prefix """
+    scheme, location = split_uri(path)
+    prefix = '/'.join('%s=%s' % (column, value) for column, value in partitions)
+
+    if scheme == SCHEME_S3:
+        import boto3
+        bucket, _, key_prefix = location.partition('/')
+        key_prefix = '/'.join(part for part in (key_prefix.strip('/'), prefix) if part) + '/'
+
+        objects = []
+        for page in boto3.client('s3').get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=key_prefix):
+            objects.extend(('%s/%s' % (bucket, item['Key']), item['Key'][len(key_prefix):], item['Size'], item['ETag'])
+                           for item in page.get('Contents', []))
+        return scheme, sorted(objects)
+
+    root = os.path.join(location, prefix)
+    objects = []
+    for directory, dirnames, filenames in os.walk(root):
+        for name in filenames:
+            file_path = os.path.join(directory, name)
+            stat = os.stat(file_path)
+            objects.append((file_path, os.path.relpath(file_path, root), stat.st_size, str(stat.st_mtime_ns)))
+    return scheme, sorted(objects)
+
+
+def list_files(path, partitions):
+    """
+    [key, size, tag] of the files of a dataset under the hive partition prefix given by the
+    (column, value) pairs, sorted by key. The tag is the ETag on s3 and the mtime locally, so
+    a rewritten file changes its entry.
+    """
+    _, objects = _prefix_objects(path, partitions)
+    return sorted([key, size, tag] for _, key, size, tag in objects)
+
+
+class _S3File(io.RawIOBase):
+    """ Read only file over an s3 object with ranged GETs, only the footer and the row groups read are fetched """
+
+    def __init__(self, client, location, size):
+        self._client = client
+        self._bucket, _, self._key = location.partition('/')
+        self._size = size
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self._position = offset
+        elif whence == io.SEEK_CUR:
+            self._position += offset
+        else:
+            self._position = self._size + offset
+        return self._position
+
+    def readinto(self, buffer):
+        end = min(self._position + len(buffer), self._size)
+        if end <= self._position:
+            return 0
+        body = self._client.get_object(Bucket=self._bucket, Key=self._key,
+                                       Range='bytes=%d-%d' % (self._position, end - 1))['Body'].read()
+        buffer[:len(body)] = body
+        self._position += len(body)
+        return len(body)
+
+
+def _s3_client(scheme):
+    if scheme != SCHEME_S3:
+        return None
+    import boto3
+    return boto3.client('s3')
+
+
+def _open_object(client, location, size):
+    return pq.ParquetFile(_S3File(client, location, size) if client is not None else location)
+
+
+def _open_objects(scheme, objects):
+    """ Parquet files of the listed objects """
+    client = _s3_client(scheme)
+
+    for location, key, size, _ in objects:
+        if not key.endswith('.parquet'):
+            continue
+        yield _open_object(client, location, size)
+
+
+def read_footers(path, partitions=(), threads=16):
+    """
+    [(partition values, size, metadata)] of the parquet files under the hive partition prefix, the
+    partition values are the (column, value) pairs of the prefix and of the path of the file. Only
+    the footers are read, on s3 with ranged GETs from threads concurrent requests.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    scheme, objects = _prefix_objects(path, partitions)
+    objects = [entry for entry in objects if entry[1].endswith('.parquet')]
+    client = _s3_client(scheme)
+
+    def _footer(entry):
+        location, key, size, _ = entry
+        values = [(column, str(value)) for column, value in partitions]
+        values += [tuple(part.split('=', 1)) for part in key.split('/')[:-1] if '=' in part]
+        return values, size, _open_object(client, location, size).metadata
+
+    if client is None or threads <= 1:
+        return [_footer(entry) for entry in objects]
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        return list(executor.map(_footer, objects))
+
+
+def _column_index(metadata, column):
+    for index in range(metadata.num_columns):
+        if metadata.schema.column(index).path == column:
+            return index
+    return None
+
+
+def _may_contain(statistics, values):
+    # without min/max the row group has to be read
+    if statistics is None or not statistics.has_min_max:
+        return True
+    position = bisect.bisect_left(values, statistics.min)
+    return position < len(values) and values[position] <= statistics.max
+
+
+def read_parquet_where(path, column, values, columns=None, partitions=(), stats=None):
+    """
+    Rows of the dataset under the hive partition prefix whose column is one of values. Only the
+    row groups whose min/max statistics can hold one of the values are read (ranged reads on s3),
+    selective when the files are sorted by the column, see sort_partitions. Returns None when
+    there is no file. stats, if given, gets the number of row groups and of row groups read.
+    """
+    import pyarrow.compute as pc
+
+    scheme, objects = _prefix_objects(path, partitions)
+    stats = stats if stats is not None else {}
+    stats.update(row_groups=0, row_groups_read=0)
+
+    tables = []
+    for parquet_file in _open_objects(scheme, objects):
+        metadata = parquet_file.metadata
+        stats['row_groups'] += metadata.num_row_groups
+
+        index = _column_index(metadata, column)
+        if index is None:
+            continue
+
+        # the values as the type of the column, the statistics come in that type
+        field = parquet_file.schema_arrow.field(column)
+        typed = pa.array([value for value in values if value is not None]).cast(field.type)
+        wanted = sorted(set(typed.to_pylist()))
+        if len(wanted) == 0:
+            continue
+
+        groups = [group for group in range(metadata.num_row_groups)
+                  if _may_contain(metadata.row_group(group).column(index).statistics, wanted)]
+        if len(groups) == 0:
+            continue
+        stats['row_groups_read'] += len(groups)
+
+        read_columns = None
+        if columns is not None:
+            read_columns = [name for name in columns if name in parquet_file.schema_arrow.names]
+            if column not in read_columns:
+                read_columns.append(column)
+
+        table = parquet_file.read_row_groups(groups, columns=read_columns)
+        table = table.filter(pc.is_in(table[column], value_set=typed))
+        if columns is not None and column not in columns:
+            table = table.drop_columns([column])
+        tables.append(table)
+
+    if len(tables) == 0:
+        return None
+
+    return pa.concat_tables(tables, promote_options='default').to_pandas()
+
+
+def sort_partitions(path, partitions, sort_by, row_group_rows=SORTED_ROW_GROUP_ROWS):
+    """
+    Rewrite every leaf directory of the files under the hive partition prefix as a single file
+    sorted by the sort_by column, in row groups of row_group_rows, so the min/max statistics of
+    the row groups are disjoint ranges of it. The new file is written before the old ones are removed.
+    """
+    scheme, objects = _prefix_objects(path, partitions)
+
+    directories = {}
+    for entry in objects:
+        if entry[1].endswith('.parquet'):
+            directories.setdefault(os.path.dirname(entry[0]), []).append(entry)
+
+    for directory, entries in directories.items():
+        # a sorted directory is left alone
+        if len(entries) == 1 and os.path.basename(entries[0][0]).startswith('sorted-'):
+            continue
+
+        table = pa.concat_tables([parquet_file.read() for parquet_file in _open_objects(scheme, entries)], promote_options='default')
+        if sort_by in table.column_names:
+            table = table.sort_by(sort_by)
+
+        target = '%s/sorted-%s.parquet' % (directory, uuid.uuid4().hex)
+        if scheme == SCHEME_S3:
+            import boto3
+            client = boto3.client('s3')
+            sink = pa.BufferOutputStream()
+            pq.write_table(table, sink, row_group_size=row_group_rows)
+            bucket, _, key = target.partition('/')
+            client.put_object(Bucket=bucket, Key=key, Body=sink.getvalue().to_pybytes())
+            for location, _, _, _ in entries:
+                bucket, _, key = location.partition('/')
+                client.delete_object(Bucket=bucket, Key=key)
+        else:
+            pq.write_table(table, target, row_group_size=row_group_rows)
+            for location, _, _, _ in entries:
+                os.remove(location)
+
+
+def _local_dataset(location, partition_filter):
+    files = _partition_files(location, partition_filter)
+    if len(files) == 0:
+        raise FileNotFoundError("No parquet files under %s" % location)
+    return ds.dataset(files, format='parquet', partitioning='hive', partition_base_dir=location)
+
+
+def _local_chunks(dataset, columns, chunk_rows):
+    for batch in dataset.to_batches(columns=columns, batch_size=chunk_rows):
+        if batch.num_rows > 0:
+            yield batch.to_pandas()
+
+
+def is_missing(error):
+    """ True if a read failed only because the dataset has no files under the path/partitions """
+    # awswrangler raises NoFilesFound, not imported for the local datasets
+    return isinstance(error, FileNotFoundError) or type(error).__name__ == 'NoFilesFound'
+
+
+def read_parquet(path, columns=None, partition_filter=None, chunked=False):
+    """
+    Read a hive partitioned parquet dataset. With chunked=<rows> an iterator of dataframes of
+    at most that many rows is returned, as awswrangler does.
+    """
+    scheme, location = split_uri(path)
+
+    if scheme == SCHEME_S3:
+        import awswrangler as wr
+        return wr.s3.read_parquet(path='s3://' + location, dataset=True, partition_filter=partition_filter,
+                                  columns=columns, chunked=chunked)
+
+    dataset = _local_dataset(location, partition_filter)
+
+    if chunked:
+        return _local_chunks(dataset, columns, chunked)
+
+    return dataset.to_table(columns=columns).to_pandas()
+
+
+def write_parquet(df, path, partition_cols, mode=MODE_APPEND):
+    """ Write a dataframe into a hive partitioned parquet dataset """
+    scheme, location = split_uri(path)
+
+    if scheme == SCHEME_S3:
+        import awswrangler as wr
+        return wr.s3.to_parquet(df=df, path='s3://' + location, dataset=True, mode=mode, partition_cols=partition_cols)
+
+    if mode == MODE_OVERWRITE and os.path.isdir(location):
+        shutil.rmtree(location)
+
+    os.makedirs(location, exist_ok=True)
+
+    # a unique basename per call, so appended chunks never replace each other
+    pq.write_to_dataset(pa.Table.from_pandas(df, preserve_index=False), root_path=location,
+                        partition_cols=partition_cols, basename_template=uuid.uuid4().hex + '-{i}.parquet',
+                        existing_data_behavior='delete_matching' if mode == MODE_OVERWRITE_PARTITIONS else 'overwrite_or_ignore')
+
+
+@contextlib.contextmanager
+def fake_s3(buckets=(), region='us-east-1'):
+    """
+    In-process S3 stand-in (moto) for offline integration runs and benchmarks. Every s3://
+    read and write made inside the context goes to the fake, buckets are created on entry.
+    """
+    try:
+        from moto import mock_aws
+    except ImportError:
+        raise ImportError("The fake S3 needs moto, install it with: pip install moto")
+
+    import boto3
+
+    environment = dict(os.environ)
+    os.environ.update({'AWS_ACCESS_KEY_ID': 'testing', 'AWS_SECRET_ACCESS_KEY': 'testing',
+                       'AWS_SESSION_TOKEN': 'testing', 'AWS_DEFAULT_REGION': region})
+    try:
+        with mock_aws():
+            client = boto3.client('s3', region_name=region)
+            for bucket in buckets:
+                client.create_bucket(Bucket=bucket)
+            yield client
+    finally:
+        os.environ.clear()
+        os.environ.update(environment)
@@ -0,0 +1,97 @@
+import re
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "benchmarks"))
+
+from configcontext import ConfigurationContext
+from processorpipeline import AbstractUsageStatsPipelineStage, UsageStatsData
+
+MODEL_CONFIG = Path(__file__).resolve().parents[1] / "config.model.ini"
+
+## synthetic workload read by the workload input stages, set by the workload fixture
+_workload = {}
+
+
+class _WorkloadSource:
+
+    def __init__(self, configContext):
+        super().__init__(configContext)
+        self.visits_path = _workload["visits_path"]
+        self.events_path = _workload["events_path"]
+
+    def _load_source(self, data: UsageStatsData):
+        data.source = _workload["source"]
+        return data.source
+
+
+class NullOutputStage(AbstractUsageStatsPipelineStage):
+
+    CONSUMES = ()
+
+    def run(self, data):
+        return data
+
+
+# the input stages need lareferenciastatsdb, the workload fixture skips the tests without it
+try:
+    from stages import IdentifierLookupInputStage, S3ParquetInputStage
+except ImportError:
+    pass
+else:
+    class WorkloadInputStage(_WorkloadSource, S3ParquetInputStage):
+        pass
+
+    class WorkloadLookupInputStage(_WorkloadSource, IdentifierLookupInputStage):
+        pass
+
+
+@pytest.fixture
+def config_context(tmp_path):
+    """ Factory of contexts over a copy of config.model.ini, with the given options set and command line args """
+
+    def _config_context(options=None, **args):
+        config = MODEL_CONFIG.read_text()
+        for option, value in (options or {}).items():
+            config = re.sub(r"^%s =.*$" % option, lambda match: "%s = %s" % (option, value), config, count=1, flags=re.M)
+        (tmp_path / "config.ini").write_text(config)
+        return ConfigurationContext(dict(config_file_path=str(tmp_path / "config.ini"), **args))
+
+    return _config_context
+
+
+@pytest.fixture
+def opensearch(monkeypatch):
+    """ Replaces the opensearch calls of awswrangler, records the index/mapping calls and answers the bulk with response """
+    wr = pytest.importorskip("awswrangler")
+    # the index name comes from the database helper
+    pytest.importorskip("lareferenciastatsdb")
+
+    fake = SimpleNamespace(exists=False, sent=[], response=None)
+    indices = SimpleNamespace(exists=lambda index: fake.exists,
+                              put_mapping=lambda index, body: fake.sent.append(("put_mapping", index, body)))
+    monkeypatch.setattr(wr.opensearch, "connect", lambda host: SimpleNamespace(indices=indices))
+    monkeypatch.setattr(wr.opensearch, "create_index", lambda client, mappings, settings, index: fake.sent.append(("create_index", index, mappings)))
+    monkeypatch.setattr(wr.opensearch, "index_documents",
+                        lambda client, index, documents, id_keys, bulk_size: fake.response or {"success": len(documents), "errors": []})
+    return fake
+
+
+@pytest.fixture
+def workload(tmp_path):
+    """ Writes a synthetic workload (benchmarks/synthetic.py) as the dataset of the workload input stages """
+    pytest.importorskip("lareferenciastatsdb")
+    from synthetic import synthetic_source, write_workload
+
+    def _workload_of(spec):
+        visits_path, events_path = write_workload(spec, str(tmp_path / "data"))
+        _workload.update({"source": synthetic_source(spec), "visits_path": visits_path, "events_path": events_path})
+        return SimpleNamespace(spec=spec, visits_path=visits_path, events_path=events_path,
+                               args=dict(site=spec.site, year=spec.year, month=spec.month, day=None, type=spec.source_type),
+                               input_stage=__name__ + ".WorkloadInputStage", lookup_input_stage=__name__ + ".WorkloadLookupInputStage",
+                               output_stage=__name__ + ".NullOutputStage")
+
+    return _workload_of
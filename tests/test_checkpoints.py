@@ -0,0 +1,66 @@
+import pandas as pd
+
+from processorpipeline import AbstractUsageStatsPipelineStage, UsageStatsData, UsageStatsProcessorPipeline
+
+## stages run by the pipelines of the tests
+_runs = []
+
+
+class FrameInputStage(AbstractUsageStatsPipelineStage):
+
+    def run(self, data: UsageStatsData) -> UsageStatsData:
+        _runs.append("input")
+        data.events_df = pd.DataFrame({"identifier": ["a", "b", "a"], "views": [1, 1, 1]})
+        data.source = {"type": "R"}
+        return data
+
+
+class CountFilterStage(AbstractUsageStatsPipelineStage):
+
+    def run(self, data: UsageStatsData) -> UsageStatsData:
+        _runs.append("count")
+        counts = data.events_df.groupby("identifier")["views"].sum()
+        data.agg_dict = dict((identifier, {"views": int(views), "downloads": 0, "outlinks": 0, "conversions": 0,
+                                           "stats_by_country": {}}) for identifier, views in counts.items())
+        return data
+
+
+class FlakyOutputStage(AbstractUsageStatsPipelineStage):
+
+    fail = True
+
+    def run(self, data: UsageStatsData) -> UsageStatsData:
+        if FlakyOutputStage.fail:
+            raise Exception("indexing failed")
+        _runs.append("output")
+        data.documents = sorted((identifier, entry["views"]) for identifier, entry in data.agg_dict.items())
+        return data
+
+
+def _run(config_context, tmp_path, **args):
+    ctx = config_context({"CHECKPOINT_DIR": tmp_path / "checkpoints"}, site=1, year=2024, month=6, day=None, **args)
+    return UsageStatsProcessorPipeline(ctx, "test_checkpoints.FrameInputStage", ["test_checkpoints.CountFilterStage"],
+                                       "test_checkpoints.FlakyOutputStage").run()
+
+
+def test_a_failed_output_resumes_from_the_last_checkpoint_and_replays(config_context, tmp_path):
+    _runs.clear()
+    FlakyOutputStage.fail = True
+    assert _run(config_context, tmp_path, checkpoint_after="FrameInputStage,CountFilterStage", keep_checkpoints=True) is None
+    assert _runs == ["input", "count"]
+
+    FlakyOutputStage.fail = False
+    data = _run(config_context, tmp_path, resume=True, keep_checkpoints=True)
+    assert _runs == ["input", "count", "output"]
+    assert data.documents == [("a", 2), ("b", 1)]
+    assert data.source == {"type": "R"}
+
+    # a captured input through the later stages
+    captured = next((tmp_path / "checkpoints").glob("site_1_2024_6_None/*/00_FrameInputStage"))
+    data = _run(config_context, tmp_path, replay_from=str(captured))
+    assert _runs == ["input", "count", "output", "count", "output"]
+    assert data.documents == [("a", 2), ("b", 1)]
+
+    # the checkpoints are removed once the output succeeded
+    _run(config_context, tmp_path, resume=True)
+    assert list((tmp_path / "checkpoints").glob("site_1_2024_6_None/*/*")) == []
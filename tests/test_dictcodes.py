@@ -0,0 +1,64 @@
+import numpy as np
+import pandas as pd
+
+import dictcodes
+from processorpipeline import UsageStatsData
+from stages import AggByItemFilterStage
+
+
+def test_encode_shares_one_dictionary_between_frames():
+    events_df = pd.DataFrame({"country": ["AR", None, "BR", ""]})
+    visits_df = pd.DataFrame({"country": ["CL", "AR"]})
+
+    dictcodes.encode([events_df, visits_df, None], "country")
+
+    assert events_df["country"].dtype == visits_df["country"].dtype
+    assert list(events_df["country"].cat.categories) == ["AR", "BR", "", "CL"]
+    codes, values = dictcodes.codes(events_df["country"])
+    assert [dictcodes.decode(values, code) for code in codes] == ["AR", None, "BR", ""]
+
+
+def _reference(stage, events_df):
+    # the row by row aggregation over the strings
+    agg_dict = {}
+    for _, row in events_df.iterrows():
+        entry = agg_dict.setdefault(row[stage.OAI_IDENTIFIER_LABEL], dict(dict((action, 0) for action in stage.actions), **{stage.STATS_BY_COUNTRY_LABEL: {}}))
+        country = row[stage.COUNTRY_LABEL]
+        country_entry = entry[stage.STATS_BY_COUNTRY_LABEL].setdefault(None if pd.isna(country) else country, dict((action, 0) for action in stage.actions))
+        for action in stage.actions:
+            if row[action] > 0:
+                entry[action] += 1
+                country_entry[action] += 1
+    return agg_dict
+
+
+def test_aggregation_over_codes_matches_the_rows(config_context):
+    stage = AggByItemFilterStage(config_context())
+    rng = np.random.default_rng(2)
+
+    events_df = pd.DataFrame({
+        stage.ID_VISIT_LABEL: rng.integers(1, 50, 500),
+        stage.OAI_IDENTIFIER_LABEL: rng.choice(["oai:a:%d" % i for i in range(20)], 500),
+        stage.COUNTRY_LABEL: rng.choice(np.array(["AR", "BR", None], dtype=object), 500),
+    })
+    for action in stage.actions:
+        events_df[action] = rng.integers(0, 2, 500)
+    expected = _reference(stage, events_df)
+
+    for encoded in (False, True):
+        frame = events_df.copy()
+        if encoded:
+            dictcodes.encode([frame], stage.OAI_IDENTIFIER_LABEL)
+            dictcodes.encode([frame], stage.COUNTRY_LABEL)
+        data = UsageStatsData()
+        data.events_df = frame
+
+        agg_dict = stage.run(data).agg_dict
+
+        # the visitor sketches are checked by test_hll
+        for entry in agg_dict.values():
+            entry.pop("visitors_sketch")
+            for country_entry in entry[stage.STATS_BY_COUNTRY_LABEL].values():
+                country_entry.pop("visitors_sketch")
+        assert agg_dict == expected
+        assert list(agg_dict) == list(expected)
@@ -0,0 +1,56 @@
+import numpy as np
+import pandas as pd
+
+from processorpipeline import UsageStatsData
+from stages import DoubleClickFilterStage
+
+
+def _stage(config_context, window=30, action_types=""):
+    return DoubleClickFilterStage(config_context({"WINDOW_SECONDS": window, "ACTION_TYPES": action_types}))
+
+
+def _reference(stage, events_df):
+    # every event compared with the later events of the same visit, item and action, in row order for equal times
+    rows = list(events_df[[stage.ID_VISIT_LABEL, stage.OAI_IDENTIFIER_LABEL, stage.ACTION_TYPE_LABEL, "server_time"]].itertuples(index=False))
+    kept = []
+    for position, (visit, identifier, action_type, time) in enumerate(rows):
+        group = [(other_time, other) for other, (other_visit, other_identifier, other_action, other_time) in enumerate(rows)
+                 if (other_visit, other_identifier, other_action) == (visit, identifier, action_type)]
+        group.sort()
+        following = group.index((time, position)) + 1
+        repeated = following < len(group) and (group[following][0] - time).total_seconds() <= stage.window_seconds
+        if stage.action_types and action_type not in stage.action_types:
+            repeated = False
+        kept.append(not repeated)
+    return events_df[kept]
+
+
+def _events(stage, size, seed):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        stage.ID_VISIT_LABEL: rng.integers(1, 6, size),
+        stage.OAI_IDENTIFIER_LABEL: rng.choice(["oai:a:1", "oai:a:2", None], size),
+        stage.ACTION_TYPE_LABEL: rng.choice([1, 3], size),
+        "server_time": pd.Timestamp("2024-01-01") + pd.to_timedelta(rng.integers(0, 300, size), unit="s"),
+    })
+
+
+def test_double_clicks_match_the_pairwise_reference(config_context):
+    for window, action_types in [(30, ""), (0, ""), (90, "3")]:
+        stage = _stage(config_context, window, action_types)
+        for seed in range(3):
+            events_df = _events(stage, 300, seed)
+
+            data = UsageStatsData()
+            data.events_df = events_df
+            result = stage.run(data).events_df
+
+            pd.testing.assert_frame_equal(result, _reference(stage, events_df))
+
+
+def test_the_last_click_of_a_run_is_kept(config_context):
+    stage = _stage(config_context)
+    times = pd.to_datetime(["2024-01-01 10:00:00", "2024-01-01 10:00:20", "2024-01-01 10:00:45", "2024-01-01 10:02:00"])
+    events_df = pd.DataFrame({stage.ID_VISIT_LABEL: 1, stage.OAI_IDENTIFIER_LABEL: "oai:a:1", stage.ACTION_TYPE_LABEL: 1, "server_time": times})
+
+    assert stage.double_clicks(events_df).tolist() == [True, True, False, False]
@@ -0,0 +1,41 @@
+import pytest
+
+pytest.importorskip("duckdb")
+pytest.importorskip("lareferenciastatsdb")
+
+from lareferenciastatsdb import SOURCE_TYPE_REGIONAL, SOURCE_TYPE_REPOSITORY
+
+from duckdbengine import pandas_query_to_sql
+from processorpipeline import UsageStatsProcessorPipeline
+from synthetic import WorkloadSpec
+
+FILTERS = ["stages.RobotsFilterStage", "stages.KnownRobotsFilterStage", "stages.AssetsFilterStage", "stages.DoubleClickFilterStage", "stages.MetricsFilterStage", "stages.AggByItemFilterStage"]
+
+
+def test_pandas_query_to_sql():
+    assert pandas_query_to_sql("visit_total_actions <= 10 or (avg_action_time > 2 and country == 'AR')") == \
+        "\"visit_total_actions\" <= 10 OR ( \"avg_action_time\" > 2 AND \"country\" = 'AR' )"
+
+    with pytest.raises(Exception):
+        pandas_query_to_sql("idvisit in @visits")
+
+
+@pytest.mark.parametrize("source_type", [SOURCE_TYPE_REPOSITORY, SOURCE_TYPE_REGIONAL])
+def test_duckdb_engine_matches_the_pandas_stages(tmp_path, config_context, workload, source_type):
+    dataset = workload(WorkloadSpec(events=20000, seed=3, identifiers=300, source_type=source_type))
+
+    # the crawlers of the workload are known by user agent and by ip, half of the ranges each
+    (tmp_path / "agents.txt").write_text("# crawlers\nbingbot\npython-requests\n")
+    (tmp_path / "ranges.txt").write_text("66.249.64.0/20\n")
+    ctx = config_context({"USER_AGENTS_FILE": tmp_path / "agents.txt", "IP_RANGES_FILE": tmp_path / "ranges.txt"}, **dataset.args)
+
+    def _run(engine):
+        pipeline = UsageStatsProcessorPipeline(ctx, dataset.input_stage, FILTERS, dataset.output_stage, engine=engine)
+        return pipeline.run()
+
+    expected = _run("pandas")
+    actual = _run("duckdb")
+
+    assert len(expected.agg_dict) > 0
+    assert actual.agg_dict == expected.agg_dict
+    assert actual.country_by_identifier_dict == expected.country_by_identifier_dict
@@ -0,0 +1,74 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import hll
+from aggutils import merge_agg_dicts
+from processorpipeline import UsageStatsData
+from stages import AggByItemFilterStage, ElasticOutputStage
+
+
+def test_estimates_are_within_the_error_bound_of_the_exact_counts():
+    rng = np.random.default_rng(7)
+    for distinct in (1, 5, 50, 500, 5000, 50000, 500000):
+        values = rng.choice(10 ** 12, distinct, replace=False)
+        # repeated values do not count
+        sketch = hll.sketch(np.concatenate([values, values[:distinct // 3]]))
+        estimate = hll.estimate(sketch)
+        # 4 standard errors, small counts are almost exact
+        assert abs(estimate - distinct) <= max(1, 4 * 1.04 / np.sqrt(hll.REGISTERS) * distinct)
+        assert len(sketch) <= hll.REGISTERS + 1
+
+    assert hll.merge(hll.sketch(values[:1000]), None, hll.sketch(values[500:])) == hll.sketch(values)
+
+
+def test_daily_sketches_merge_into_the_month(config_context):
+    ctx = config_context(site=1, year=2024, month=5, day=None, type="R")
+
+    rng = np.random.default_rng(3)
+    rows = 60000
+    events = pd.DataFrame({"idvisit": rng.integers(0, 20000, rows), "oai_identifier": rng.choice(["oai:a", "oai:b", "oai:c"], rows),
+                           "country": rng.choice(["AR", "BR", None], rows), "day": rng.integers(1, 4, rows),
+                           "views": rng.integers(0, 2, rows), "downloads": rng.integers(0, 2, rows), "outlinks": 0, "conversions": 0})
+    events = events.drop_duplicates(["idvisit", "oai_identifier"])
+
+    def _aggregate(frame):
+        data = UsageStatsData()
+        data.events_df = frame.drop(columns=["day"]).reset_index(drop=True)
+        return AggByItemFilterStage(ctx).run(data).agg_dict
+
+    month = _aggregate(events)
+    merged = {}
+    for day in (1, 2, 3):
+        merge_agg_dicts(merged, _aggregate(events[events["day"] == day]))
+
+    assert merged == month
+    for identifier, entry in month.items():
+        exact = events.loc[events["oai_identifier"] == identifier, "idvisit"].nunique()
+        assert abs(hll.estimate(entry[hll.SKETCH_KEY]) - exact) <= 0.05 * exact
+
+    data = UsageStatsData()
+    data.agg_dict, data.country_by_identifier_dict = month, {}
+    document = dict((document["identifier"], document) for document in ElasticOutputStage(ctx).build_documents(data))["oai:a"]
+    assert document["unique_visitors"] == hll.estimate(hll.from_base64(document["unique_visitors_sketch"]))
+    assert len(document["stats_by_country"]) == 3 and all("unique_visitors" in stats for stats in document["stats_by_country"])
+
+
+@pytest.mark.parametrize("exists", [False, True])
+def test_the_unique_visitors_fields_are_mapped_in_new_and_existing_indexes(config_context, opensearch, exists):
+    opensearch.exists = exists
+
+    ctx = config_context(site=1, year=2024, month=5, day=None, type="R")
+    data = UsageStatsData()
+    data.agg_dict, data.country_by_identifier_dict = {}, {}
+    ElasticOutputStage(ctx).run(data)
+
+    (call, index, mapping), = opensearch.sent
+    assert call == ("put_mapping" if exists else "create_index")
+    for properties in (mapping["properties"], mapping["properties"]["stats_by_country"]["properties"]):
+        assert properties["unique_visitors"] == {"type": "long"}
+        assert properties["unique_visitors_sketch"] == {"type": "binary"}
+    assert mapping["properties"]["stats_by_country"]["type"] == "nested"
+    # only the new fields are put into the existing indexes
+    if exists:
+        assert sorted(mapping["properties"]) == ["stats_by_country", "unique_visitors", "unique_visitors_sketch"]
@@ -0,0 +1,56 @@
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("lareferenciastatsdb")
+
+from processorpipeline import UsageStatsData
+from stages import IdentifierFilterStage
+from stages import identifier_fstage
+
+
+def _stage(config_context, tmp_path):
+    return IdentifierFilterStage(config_context({"IDENTIFIER_MAP_CACHE_DIR": tmp_path / "cache"}, site=7))
+
+
+def _data(agg_dict, **source):
+    data = UsageStatsData()
+    data.agg_dict = agg_dict
+    data.source = SimpleNamespace(identifier_map_type=source.get("type", IdentifierFilterStage.IDENTIFIER_MAP_NORMALIZE),
+                                  identifier_map_regex=source.get("regex"), identifier_map_replace=source.get("replace"),
+                                  identifier_map_filename=source.get("filename"), identifier_prefix=None)
+    return data
+
+
+def _entry(views, country_views):
+    return {"views": views, "stats_by_country": {"AR": {"views": country_views}}}
+
+
+def test_identifiers_rewritten_to_the_same_value_are_merged(config_context, tmp_path):
+    data = _data({"oai:a:1": _entry(2, 2), "oai:b:1": _entry(3, 1), "oai:a:2": _entry(1, 1)},
+                 type=IdentifierFilterStage.IDENTIFIER_MAP_REGEX_REPLACE, regex="^oai:[ab]:", replace="oai:x:")
+
+    data = _stage(config_context, tmp_path).run(data)
+
+    assert data.agg_dict == {"oai:x:1": _entry(5, 3), "oai:x:2": _entry(1, 1)}
+
+
+def test_map_hits_keep_the_mapped_identifier_and_misses_are_memoized(config_context, tmp_path, monkeypatch):
+    map_path = tmp_path / "map.csv"
+    map_path.write_text("oai:a:1,oai:mapped:1\n")
+
+    calls = []
+    normalize = identifier_fstage.normalize_oai_identifier
+    monkeypatch.setattr(identifier_fstage, "normalize_oai_identifier", lambda x: calls.append(x) or normalize(x))
+
+    stage = _stage(config_context, tmp_path)
+    source = dict(type=IdentifierFilterStage.IDENTIFIER_MAP_FROM_FILE, filename=str(map_path))
+
+    first = stage.run(_data({"oai:a:1": _entry(1, 1), "oai:a:2": _entry(1, 1)}, **source))
+    assert "oai:mapped:1" in first.agg_dict
+    assert calls == ["oai:a:2"]
+
+    # the second run finds the normalized identifier in the memo
+    second = stage.run(_data({"oai:a:1": _entry(1, 1), "oai:a:2": _entry(1, 1)}, **source))
+    assert calls == ["oai:a:2"]
+    assert second.agg_dict.keys() == first.agg_dict.keys()
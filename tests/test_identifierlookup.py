@@ -0,0 +1,31 @@
+import pytest
+
+pytest.importorskip("lareferenciastatsdb")
+
+from lareferenciastatsdb import SOURCE_TYPE_REGIONAL, SOURCE_TYPE_REPOSITORY
+
+import storage
+from processorpipeline import UsageStatsProcessorPipeline
+from stages import S3ParquetInputStage
+from synthetic import WorkloadSpec
+
+FILTERS = ["stages.RobotsFilterStage", "stages.AssetsFilterStage", "stages.MetricsFilterStage", "stages.AggByItemFilterStage"]
+
+
+@pytest.mark.parametrize("source_type", [SOURCE_TYPE_REPOSITORY, SOURCE_TYPE_REGIONAL])
+def test_lookup_matches_the_stats_of_the_whole_period(config_context, workload, source_type):
+    dataset = workload(WorkloadSpec(events=20000, seed=5, identifiers=300, source_type=source_type))
+
+    partitions = S3ParquetInputStage._partition_prefix(dataset.spec.site, dataset.spec.year, dataset.spec.month, None)
+    storage.sort_partitions(dataset.events_path, partitions, S3ParquetInputStage._identifier_custom_var(source_type), row_group_rows=500)
+
+    def _run(input_stage, identifiers):
+        ctx = config_context(identifier=identifiers, **dataset.args)
+        return UsageStatsProcessorPipeline(ctx, input_stage, FILTERS, dataset.output_stage).run()
+
+    expected = _run(dataset.input_stage, [])
+    identifiers = sorted(expected.agg_dict)[:3] + ["oai:not-there"]
+    actual = _run(dataset.lookup_input_stage, identifiers)
+
+    assert len(actual.agg_dict) == 3
+    assert actual.agg_dict == dict((identifier, expected.agg_dict[identifier]) for identifier in identifiers[:3])
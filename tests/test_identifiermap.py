@@ -0,0 +1,37 @@
+import os
+
+from identifiermap import IdentifierMapIndex
+
+
+def _write_map(path, lines):
+    path.write_text("".join("%s,%s\n" % line for line in lines))
+
+
+def test_lookup_resolves_all_identifiers_at_once(tmp_path):
+    map_path = tmp_path / "map.csv"
+    _write_map(map_path, [("oai:a:1", "oai:b:1"), ("oai:a:2", "oai:b:2"), ("oai:a:1", "oai:b:10")])
+
+    index = IdentifierMapIndex.load(str(map_path), str(tmp_path / "cache"))
+
+    assert len(index) == 2
+    # the last line of a key wins, like the dict the stage used to build
+    assert index.lookup(["oai:a:2", "oai:missing", "oai:a:1"]) == ["oai:b:2", None, "oai:b:10"]
+    assert index.lookup([]) == []
+
+
+def test_index_is_rebuilt_only_when_the_content_changes(tmp_path):
+    map_path = tmp_path / "map.csv"
+    cache_dir = str(tmp_path / "cache")
+    _write_map(map_path, [("oai:a:1", "oai:b:1")])
+
+    index_path = IdentifierMapIndex.load(str(map_path), cache_dir).index_path
+    built = os.stat(index_path).st_mtime_ns
+
+    # same content with a new mtime keeps the index
+    os.utime(map_path, ns=(built + 10 ** 9, built + 10 ** 9))
+    assert IdentifierMapIndex.load(str(map_path), cache_dir).lookup(["oai:a:1"]) == ["oai:b:1"]
+    assert os.stat(index_path).st_mtime_ns == built
+
+    _write_map(map_path, [("oai:a:1", "oai:c:1"), ("oai:a:3", "oai:c:3")])
+    index = IdentifierMapIndex.load(str(map_path), cache_dir)
+    assert index.lookup(["oai:a:1", "oai:a:3"]) == ["oai:c:1", "oai:c:3"]
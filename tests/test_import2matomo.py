@@ -0,0 +1,104 @@
+import asyncio
+import gzip
+import socket
+import threading
+
+import pytest
+
+aiohttp = pytest.importorskip("aiohttp")
+from aiohttp import web
+
+from import2matomo import replay_events_async, replay_events_sharded, shard_events
+
+
+async def _serve(handler):
+    app = web.Application()
+    app.router.add_post("/matomo.php", handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    await web.SockSite(runner, sock).start()
+    return runner, "http://127.0.0.1:%d/matomo.php" % sock.getsockname()[1]
+
+
+def _write_events(path, count):
+    lines = ["?idsite=1&rec=1&url=http%%3A%%2F%%2Frepo%%2Fitem%%2F%d" % i for i in range(count)]
+    with gzip.open(path, "wt") as file:
+        file.write("\n".join(lines) + "\n")
+    return lines
+
+
+def test_interrupted_replay_resumes_without_resending(tmp_path):
+    events = _write_events(tmp_path / "events.log.gz", 60)
+    checkpoint = str(tmp_path / "events.checkpoint")
+    received = []
+    broken = {"line": events[23]}
+
+    async def handler(request):
+        lines = (await request.json())["requests"]
+        if broken["line"] in lines:
+            return web.Response(status=500)
+        received.extend(lines)
+        return web.json_response({"status": "success", "tracked": len(lines), "invalid": 0})
+
+    async def replay():
+        runner, url = await _serve(handler)
+        try:
+            first = await replay_events_async(str(tmp_path / "events.log.gz"), url, batch_size=5, concurrency=4,
+                                              max_retries=0, checkpoint_path=checkpoint)
+            broken["line"] = None
+            second = await replay_events_async(str(tmp_path / "events.log.gz"), url, batch_size=7, concurrency=4,
+                                               compress=True, checkpoint_path=checkpoint)
+        finally:
+            await runner.cleanup()
+        return first, second
+
+    first, second = asyncio.run(replay())
+
+    assert not first["complete"] and first["lines"] < 60
+    assert second["complete"] and second["tracked"] == 60
+    assert sorted(received) == sorted(events)
+
+
+def test_shards_split_plain_files_on_line_boundaries(tmp_path):
+    plain = tmp_path / "events.log"
+    plain.write_text("".join("?idsite=1&n=%d\n" % i for i in range(1000)))
+    _write_events(tmp_path / "events.log.gz", 10)
+
+    shards = shard_events([str(plain), str(tmp_path / "events.log.gz")], 4)
+
+    ranges = [(start, end) for path, start, end in shards if path == str(plain)]
+    assert len(ranges) > 1 and ranges[0][0] == 0 and ranges[-1][1] == plain.stat().st_size
+    content = plain.read_bytes()
+    assert all(content[start - 1:start] == b"\n" for start, end in ranges[1:])
+    assert [(start, end) for path, start, end in shards if path.endswith(".gz")] == [(0, None)]
+
+
+def test_sharded_replay_sends_every_line_once_within_the_rate(tmp_path):
+    plain = tmp_path / "events.log"
+    events = ["?idsite=1&n=%d" % i for i in range(300)]
+    plain.write_text("\n".join(events) + "\n")
+    events += _write_events(tmp_path / "events.log.gz", 100)
+    received = []
+
+    async def handler(request):
+        lines = (await request.json())["requests"]
+        received.extend(lines)
+        return web.json_response({"status": "success", "tracked": len(lines), "invalid": 0})
+
+    loop = asyncio.new_event_loop()
+    runner, url = loop.run_until_complete(_serve(handler))
+    server = threading.Thread(target=loop.run_forever, daemon=True)
+    server.start()
+    try:
+        totals = replay_events_sharded([str(plain), str(tmp_path / "events.log.gz")], url, workers=2, rate=1000,
+                                       checkpoint_dir=str(tmp_path / "checkpoints"), batch_size=20, concurrency=2)
+    finally:
+        loop.call_soon_threadsafe(loop.stop)
+        server.join()
+
+    assert totals["complete"] and totals["tracked"] == 400
+    assert sorted(received) == sorted(events)
+    # the last batch can not start before 380 lines at 1000 lines/s
+    assert totals["seconds"] >= 0.38
@@ -0,0 +1,49 @@
+import ipaddress
+import random
+import pandas as pd
+
+from botmatcher import IPRangeMatcher, UserAgentMatcher
+from processorpipeline import UsageStatsData
+from stages import KnownRobotsFilterStage
+
+
+def test_matchers_agree_with_the_brute_force():
+    rng = random.Random(5)
+
+    patterns = ["bot", "crawl", "abcab", "bca", "aab", "python-requests", "c/"]
+    matcher = UserAgentMatcher(patterns)
+    for _ in range(5000):
+        agent = "".join(rng.choice("abcBOTc/ ") for _ in range(rng.randint(0, 16)))
+        assert matcher.matches(agent) == any(pattern in agent.lower() for pattern in patterns), agent
+
+    ranges = ["10.0.0.0/8", "10.255.0.0-11.0.0.10", "192.168.1.5", "2001:db8::/32", "172.16.0.0/12"]
+    networks = [ipaddress.ip_network(text) for text in ranges if "-" not in text]
+    matcher = IPRangeMatcher(ranges)
+    for _ in range(5000):
+        address = ipaddress.ip_address(rng.choice([rng.getrandbits(32), (10 << 24) + rng.getrandbits(25), (0x20010db8 << 96) + rng.getrandbits(97)]))
+        expected = any(address in network for network in networks) or \
+            (address.version == 4 and ipaddress.ip_address("10.255.0.0") <= address <= ipaddress.ip_address("11.0.0.10"))
+        assert matcher.matches(address.packed) == expected
+        assert matcher.matches(str(address)) == expected
+
+
+def test_stage_drops_the_visits_of_known_robots_and_their_events(config_context, tmp_path):
+    (tmp_path / "agents.txt").write_text("# crawlers\nGooglebot\n")
+    (tmp_path / "ranges.txt").write_text("66.249.64.0/19\n")
+    stage = KnownRobotsFilterStage(config_context({"USER_AGENTS_FILE": tmp_path / "agents.txt", "IP_RANGES_FILE": tmp_path / "ranges.txt"}))
+
+    assert stage.visits_columns() == ["user_agent", "location_ip"]
+
+    data = UsageStatsData()
+    data.visits_df = pd.DataFrame({
+        "idvisit": [1, 2, 3, 4, 5],
+        "user_agent": ["Mozilla/5.0 (compatible; googlebot/2.1)", "Mozilla/5.0 Firefox", None, "Mozilla/5.0 Firefox", "Mozilla/5.0 Firefox"],
+        "location_ip": [ipaddress.ip_address(ip).packed if ip else None for ip in ["1.1.1.1", "66.249.70.1", "8.8.8.8", None, "8.8.4.4"]],
+    })
+    data.events_df = pd.DataFrame({"idvisit": [1, 2, 3, 3, 4, 5]})
+
+    data = stage.run(data)
+
+    assert data.visits_df["idvisit"].tolist() == [3, 4, 5]
+    assert list(data.visits_df.columns) == ["idvisit"]
+    assert data.events_df["idvisit"].tolist() == [3, 3, 4, 5]
@@ -0,0 +1,52 @@
+from types import SimpleNamespace
+
+from metadatacache import MetadataCache
+
+
+class CountingHelper:
+
+    def __init__(self):
+        self.calls = []
+
+    def get_source_by_site_id(self, site_id):
+        self.calls.append(("source", site_id))
+        return SimpleNamespace(type="R", country_iso="AR", identifier_prefix="oai:%d:" % site_id)
+
+    def get_index_name(self, prefix, site_id):
+        self.calls.append(("index_name", site_id))
+        return "%s-%d" % (prefix, site_id)
+
+    def get_all_site_ids(self):
+        self.calls.append(("site_ids",))
+        return [3, 1, 2]
+
+
+def test_lookups_are_memoized_until_the_ttl_expires(monkeypatch):
+    helper = CountingHelper()
+    cache = MetadataCache(helper=helper, ttl=60)
+    now = [1000.0]
+    monkeypatch.setattr("metadatacache.time.time", lambda: now[0])
+
+    assert cache.get_source_by_site_id(1).identifier_prefix == "oai:1:"
+    assert cache.get_source_by_site_id("1").country_iso == "AR"
+    assert cache.get_index_name("usage", 1) == cache.get_index_name("usage", 1) == "usage-1"
+    assert helper.calls == [("source", 1), ("index_name", 1)]
+
+    now[0] += 61
+    cache.get_source_by_site_id(1)
+    assert helper.calls[-1] == ("source", 1) and len(helper.calls) == 3
+
+
+def test_prefetched_snapshot_is_shared_with_other_processes(tmp_path):
+    snapshot = str(tmp_path / "metadata.pickle")
+    runner = MetadataCache(helper=CountingHelper(), snapshot_path=snapshot)
+    runner.prefetch(index_prefix="usage")
+    runner.save_snapshot()
+
+    worker_helper = CountingHelper()
+    worker = MetadataCache(helper=worker_helper, snapshot_path=snapshot)
+
+    assert worker.get_source_by_site_id(2).identifier_prefix == "oai:2:"
+    assert worker.get_index_name("usage", 3) == "usage-3"
+    assert sorted(worker.get_all_site_ids()) == [1, 2, 3]
+    assert worker_helper.calls == []
@@ -0,0 +1,54 @@
+import numpy as np
+import pandas as pd
+
+import dictcodes
+from processorpipeline import UsageStatsData
+from stages import MetricsFilterStage
+
+
+def _reference(stage, events_df, visits_df):
+    # one int column per action, max by (visit, identifier) and the whole visit merged
+    events_df = events_df.copy()
+    for action, action_id in zip(stage.actions, stage.actions_id):
+        if action_id > 0:
+            events_df[action] = (events_df[stage.ACTION_TYPE_LABEL] == action_id).astype(int)
+    country_df = events_df[events_df[stage.COUNTRY_LABEL].notnull() & (events_df[stage.COUNTRY_LABEL] != "")]
+    countries = country_df.set_index(stage.OAI_IDENTIFIER_LABEL)[stage.COUNTRY_LABEL].to_dict()
+
+    grouped = events_df.groupby([stage.ID_VISIT_LABEL, stage.OAI_IDENTIFIER_LABEL]).agg(dict((action, "max") for action in ("views", "outlinks", "downloads"))).reset_index()
+    grouped = grouped.merge(visits_df, on=stage.ID_VISIT_LABEL)
+    grouped["conversions"] = ((grouped["views"] == 1) & ((grouped["downloads"] == 1) | (grouped["outlinks"] == 1))).astype(int)
+    return grouped, countries
+
+
+def test_bitmask_metrics_match_the_grouped_merge(config_context):
+    stage = MetricsFilterStage(config_context())
+    rng = np.random.default_rng(4)
+
+    events_df = pd.DataFrame({
+        stage.ID_VISIT_LABEL: rng.integers(1, 40, 800),
+        stage.OAI_IDENTIFIER_LABEL: rng.choice(np.array(["oai:a:%d" % i for i in range(15)] + [None], dtype=object), 800),
+        stage.ACTION_TYPE_LABEL: rng.choice([1, 2, 3, 4], 800),
+        stage.COUNTRY_LABEL: rng.choice(np.array(["AR", "BR", "", None], dtype=object), 800),
+    })
+    # the visits 35..39 were filtered out
+    visits_df = pd.DataFrame({stage.ID_VISIT_LABEL: np.arange(1, 35), stage.COUNTRY_LABEL: rng.choice(["CL", "MX"], 34),
+                              "visit_total_actions": rng.integers(1, 10, 34)})
+    expected, expected_countries = _reference(stage, events_df.dropna(subset=[stage.OAI_IDENTIFIER_LABEL]), visits_df)
+
+    for encoded in (False, True):
+        data = UsageStatsData()
+        data.events_df, data.visits_df = events_df.copy(), visits_df.copy()
+        if encoded:
+            dictcodes.encode([data.events_df], stage.OAI_IDENTIFIER_LABEL)
+            dictcodes.encode([data.events_df, data.visits_df], stage.COUNTRY_LABEL)
+
+        data = stage.run(data)
+
+        assert data.country_by_identifier_dict == expected_countries
+        result = data.events_df.astype({stage.OAI_IDENTIFIER_LABEL: object, stage.COUNTRY_LABEL: object})
+        result = result.sort_values([stage.ID_VISIT_LABEL, stage.OAI_IDENTIFIER_LABEL]).reset_index(drop=True)
+        assert list(result.columns) == [stage.ID_VISIT_LABEL, stage.OAI_IDENTIFIER_LABEL, "views", "outlinks", "downloads", stage.COUNTRY_LABEL, "conversions"]
+        assert result["views"].dtype == np.uint8
+        columns = list(result.columns)
+        pd.testing.assert_frame_equal(result.astype(object), expected[columns].astype(object))
@@ -0,0 +1,51 @@
+import json
+
+import pandas as pd
+
+from pipelinemetrics import StageMetricsRecorder
+
+
+class _Data:
+
+    def __init__(self, **frames):
+        self._frames = frames
+
+    def items(self):
+        return list(self._frames.items())
+
+
+def test_stage_record_is_written_as_json_line(tmp_path):
+    jsonl_path = tmp_path / "metrics.jsonl"
+    recorder = StageMetricsRecorder({"site": 7}, jsonl_path=str(jsonl_path))
+
+    sample = recorder.start("RobotsFilterStage", _Data(events_df=pd.DataFrame({"a": range(10)})))
+    recorder.stop(sample, _Data(events_df=pd.DataFrame({"a": range(4)}), agg_dict={}))
+
+    record = json.loads(jsonl_path.read_text().splitlines()[0])
+    assert record["site"] == 7
+    assert record["stage"] == "RobotsFilterStage"
+    assert record["rows_in"] == {"events_df": 10}
+    assert record["rows_out"] == {"events_df": 4}
+    assert record["wall_seconds"] >= 0
+    assert record["peak_rss_bytes"] > 0
+
+
+def test_prometheus_textfile_has_one_sample_per_stage(tmp_path):
+    recorder = StageMetricsRecorder({"site": 7, "year": 2024}, jsonl_path=str(tmp_path / "m.jsonl"),
+                                    prometheus_path=str(tmp_path / "stats_{site}.prom"))
+
+    for stage in ("RobotsFilterStage", "MetricsFilterStage"):
+        recorder.stop(recorder.start(stage, None), _Data(events_df=pd.DataFrame({"a": [1]})))
+    recorder.write_prometheus()
+
+    lines = (tmp_path / "stats_7.prom").read_text().splitlines()
+    wall = [line for line in lines if line.startswith("usage_stats_stage_wall_seconds{")]
+    assert len(wall) == 2
+    assert 'site="7",year="2024",stage="MetricsFilterStage"' in wall[1]
+    assert 'usage_stats_stage_rows_out{site="7",year="2024",stage="RobotsFilterStage",frame="events_df"} 1' in lines
+
+
+def test_the_pipeline_import_does_not_load_the_deferred_modules():
+    from import_time import TARGETS, eager_imports, measure
+
+    assert eager_imports("processorpipeline", measure(TARGETS["processorpipeline"])[2]) == []
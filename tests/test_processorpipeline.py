@@ -0,0 +1,75 @@
+import pandas as pd
+import pytest
+
+from processorpipeline import AbstractUsageStatsPipelineStage, UsageStatsData, UsageStatsProcessorPipeline
+
+## (stage, frames held by the data) of the stages run by the parent process
+_seen = []
+
+
+def _frames(data):
+    return sorted(name for name in UsageStatsData.FRAMES if data.get(name) is not None)
+
+
+class FrameInputStage(AbstractUsageStatsPipelineStage):
+
+    def run(self, data: UsageStatsData) -> UsageStatsData:
+        data.visits_df = pd.DataFrame({"idvisit": range(20), "robot": [visit % 4 == 0 for visit in range(20)]})
+        data.events_df = pd.DataFrame({"idvisit": [visit % 20 for visit in range(60)], "views": 1})
+        return data
+
+
+class VisitsFilterStage(AbstractUsageStatsPipelineStage):
+
+    VISIT_LOCAL = True
+    CONSUMES = ('events_df', 'visits_df')
+
+    def run(self, data: UsageStatsData) -> UsageStatsData:
+        data.visits_df = data.visits_df[~data.visits_df["robot"]]
+        data.events_df = data.events_df[data.events_df["idvisit"].isin(data.visits_df["idvisit"])]
+        return data
+
+
+class CountFilterStage(AbstractUsageStatsPipelineStage):
+
+    CONSUMES = ('events_df',)
+
+    def run(self, data: UsageStatsData) -> UsageStatsData:
+        _seen.append(("count", _frames(data)))
+        data.documents = [int(data.events_df["views"].sum())]
+        return data
+
+
+class DocumentsOutputStage(AbstractUsageStatsPipelineStage):
+
+    CONSUMES = ('documents',)
+
+    def run(self, data: UsageStatsData) -> UsageStatsData:
+        _seen.append(("output", _frames(data)))
+        return data
+
+
+def test_data_objects_do_not_share_state():
+    first, second = UsageStatsData(), UsageStatsData()
+    first.events_df = pd.DataFrame({"idvisit": [1]})
+    first.counter = 1
+
+    assert second.events_df is None and second.counter is None
+
+    first.drop(["events_df", "counter"])
+    assert first.events_df is None and first.counter is None
+    assert [name for name, _ in first.items()] == []
+
+
+@pytest.mark.parametrize("workers,stream", [(1, False), (2, False), (1, True)])
+def test_frames_are_released_after_their_last_consumer(config_context, workers, stream):
+    _seen.clear()
+
+    pipeline = UsageStatsProcessorPipeline(config_context(), __name__ + ".FrameInputStage",
+                                           [__name__ + ".VisitsFilterStage", __name__ + ".CountFilterStage"],
+                                           __name__ + ".DocumentsOutputStage", workers=workers, stream=stream)
+    data = pipeline.run()
+
+    # visits_df is only read by the visits filter, events_df until the count
+    assert _seen == [("count", ["events_df"]), ("output", [])]
+    assert data.documents == [45]
@@ -0,0 +1,24 @@
+import os
+
+from profiling import StageProfiler, profile_label, profile_section
+
+
+def test_profiling_is_disabled_without_profile_argument():
+    assert StageProfiler.from_args({"site": 1, "profile": None}) is None
+
+    with profile_section(None, "stage"):
+        pass
+
+
+def test_profile_dumps_are_labeled_by_site_and_period(tmp_path):
+    args = {"profile": str(tmp_path), "site": 48, "year": 2024, "month": 3, "day": None}
+    profiler = StageProfiler.from_args(args)
+
+    with profile_section(profiler, "RobotsFilterStage"):
+        sum(range(1000))
+
+    output_dir = tmp_path / profile_label(args)
+    assert profile_label(args) == "site_48_2024_3_all"
+    assert sorted(os.listdir(output_dir)) == ["01_RobotsFilterStage.prof",
+                                              "01_RobotsFilterStage.tracemalloc.txt",
+                                              "01_RobotsFilterStage.txt"]
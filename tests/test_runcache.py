@@ -0,0 +1,112 @@
+import pandas as pd
+import pytest
+
+import storage
+from processorpipeline import AbstractUsageStatsPipelineStage, UsageStatsData, UsageStatsProcessorPipeline
+
+## runs of the output stage
+_outputs = []
+
+
+class PartitionInputStage(AbstractUsageStatsPipelineStage):
+
+    def fingerprint(self):
+        return {"events": storage.list_files(self.getCtx().getArg("dataset"), [("idsite", self.getCtx().getArg("site"))])}
+
+    def run(self, data: UsageStatsData) -> UsageStatsData:
+        data.agg_dict = {}
+        if self.getCtx().getArg("unreadable"):
+            data.input_errors = [self.getCtx().getArg("dataset")]
+        return data
+
+
+class TwoIdentifiersInputStage(PartitionInputStage):
+
+    def run(self, data: UsageStatsData) -> UsageStatsData:
+        data.agg_dict = dict((identifier, dict([(action, 1) for action in self.getCtx().getActions()], stats_by_country={}))
+                             for identifier in ("oai:a", "oai:b"))
+        data.country_by_identifier_dict = {}
+        return data
+
+
+class RecordingOutputStage(AbstractUsageStatsPipelineStage):
+
+    PERSISTS_RESULT = True
+
+    def run(self, data: UsageStatsData) -> UsageStatsData:
+        _outputs.append(self.getCtx().getArg("site"))
+        return data
+
+
+def _run(config_context, tmp_path, site, unreadable=False, **args):
+    ctx = config_context({"RUN_CACHE_DIR": tmp_path / "runs"}, site=site, year=2024, month=6, day=None,
+                         dataset="file://%s" % (tmp_path / "events"), unreadable=unreadable, **args)
+    return UsageStatsProcessorPipeline(ctx, "test_runcache.PartitionInputStage", [], "test_runcache.RecordingOutputStage").run()
+
+
+def test_unchanged_periods_are_skipped_and_changed_ones_recomputed(config_context, tmp_path):
+    dataset = "file://%s" % (tmp_path / "events")
+    for site in (1, 2):
+        storage.write_parquet(pd.DataFrame({"idsite": [site], "value": [1]}), dataset, ["idsite"])
+    _outputs.clear()
+
+    _run(config_context, tmp_path, 1)
+    _run(config_context, tmp_path, 2)
+    assert _run(config_context, tmp_path, 1) is None and _run(config_context, tmp_path, 2) is None
+    assert _outputs == [1, 2]
+
+    # new data in the partition of site 2 only
+    storage.write_parquet(pd.DataFrame({"idsite": [2], "value": [2]}), dataset, ["idsite"])
+    _run(config_context, tmp_path, 1)
+    _run(config_context, tmp_path, 2)
+    assert _outputs == [1, 2, 2]
+
+    _run(config_context, tmp_path, 1, force=True)
+    assert _outputs == [1, 2, 2, 1]
+
+
+def test_runs_with_unreadable_inputs_are_not_recorded(config_context, tmp_path):
+    storage.write_parquet(pd.DataFrame({"idsite": [1], "value": [1]}), "file://%s" % (tmp_path / "events"), ["idsite"])
+    _outputs.clear()
+
+    _run(config_context, tmp_path, 1, unreadable=True)
+    _run(config_context, tmp_path, 1)
+    assert _run(config_context, tmp_path, 1) is None
+    assert _outputs == [1, 1]
+
+
+def test_read_errors_are_reported_and_missing_partitions_are_not(tmp_path):
+    pytest.importorskip("lareferenciastatsdb")
+    from stages import S3ParquetInputStage
+
+    dataset = "file://%s" % (tmp_path / "events")
+    storage.write_parquet(pd.DataFrame({"idsite": [1], "value": [1]}), dataset, ["idsite"])
+    errors = []
+
+    missing = S3ParquetInputStage._read_parquet_file(dataset, ["value"], lambda partition: partition["idsite"] == "2", errors=errors)
+    assert missing is None and errors == []
+
+    # a truncated file of the partition
+    for path in (tmp_path / "events").rglob("*.parquet"):
+        path.write_bytes(path.read_bytes()[:20])
+    assert S3ParquetInputStage._read_parquet_file(dataset, ["value"], lambda partition: partition["idsite"] == "1", errors=errors) is None
+    assert errors == [dataset]
+
+
+@pytest.mark.parametrize("response", [{"success": 1, "errors": [{"index": {"_id": "b", "status": 429}}]}, {"success": 1, "errors": []}])
+def test_runs_with_documents_not_indexed_are_not_recorded(config_context, tmp_path, opensearch, response):
+    storage.write_parquet(pd.DataFrame({"idsite": [1], "value": [1]}), "file://%s" % (tmp_path / "events"), ["idsite"])
+    ctx = config_context({"RUN_CACHE_DIR": tmp_path / "runs"}, site=1, year=2024, month=6, day=None, type="R",
+                         dataset="file://%s" % (tmp_path / "events"))
+
+    def _run():
+        return UsageStatsProcessorPipeline(ctx, "test_runcache.TwoIdentifiersInputStage", [], "stages.ElasticOutputStage").run()
+
+    # one of the two documents is rejected by the bulk, or the bulk stops after the first one
+    opensearch.response = response
+    assert _run() is None
+    assert not (tmp_path / "runs").exists() or not any((tmp_path / "runs").rglob("*"))
+
+    opensearch.response = None
+    assert len(_run().documents) == 2
+    assert _run() is None
@@ -0,0 +1,100 @@
+import gzip
+import logging
+import threading
+import time
+
+import pytest
+
+import s3logger as s3logger_module
+from s3logger import S3Logger
+
+
+class RecordingClient:
+
+    def __init__(self, delay=0.0, error=None):
+        self.delay = delay
+        self.error = error
+        self.objects = {}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        time.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+        self.objects[(Bucket, Key)] = gzip.decompress(Body).decode("utf-8")
+
+
+def test_logging_does_not_wait_for_the_upload_and_close_ships_everything():
+    client = RecordingClient(delay=0.5)
+    s3logger = S3Logger("app", bucket="logs/v2", client=client, flush_bytes=200)
+
+    started = time.perf_counter()
+    for i in range(50):
+        s3logger.loginfo("message %d" % i)
+    s3logger.write("site_1")
+    s3logger.loginfo("after write")
+    assert time.perf_counter() - started < 0.4
+
+    s3logger.close()
+
+    assert all(bucket == "logs" and key.startswith("v2/app/") for bucket, key in client.objects)
+    shipped = "".join(client.objects.values()).splitlines()
+    assert sorted(shipped) == sorted(["message %d" % i for i in range(50)] + ["after write"])
+    assert any("site_1_" in key for bucket, key in client.objects)
+
+
+def test_buffer_is_bounded_and_reports_dropped_messages():
+    client = RecordingClient()
+    s3logger = S3Logger("app", client=client, max_buffer_bytes=1000)
+
+    for i in range(1000):
+        s3logger.loginfo("message %04d" % i)
+    assert s3logger._buffer_bytes <= 1000
+    s3logger.set_bucket("logs")
+    s3logger.close()
+
+    shipped = "".join(client.objects.values())
+    assert "messages dropped" in shipped and "message 0999" in shipped and "message 0000" not in shipped
+    assert s3logger.handler not in logging.getLogger().handlers
+    assert not any(thread.name == "s3logger" and thread.is_alive() for thread in threading.enumerate())
+
+
+def _spooled(spool_dir):
+    return "".join(gzip.decompress(path.read_bytes()).decode("utf-8") for path in spool_dir.iterdir())
+
+
+def test_close_does_not_wait_for_an_unreachable_s3_and_spools_the_segments(tmp_path):
+    client = RecordingClient(delay=5.0)
+    s3logger = S3Logger("app", bucket="logs", client=client, close_timeout=0.3, spool_dir=tmp_path / "spool")
+
+    s3logger.loginfo("uploading")
+    s3logger.write("site_1")
+    time.sleep(0.1)
+    s3logger.loginfo("waiting")
+
+    started = time.perf_counter()
+    s3logger.close()
+    assert time.perf_counter() - started < 1.0
+
+    # the segment being uploaded and the one waiting behind it
+    assert sorted(_spooled(tmp_path / "spool").splitlines()) == ["uploading", "waiting"]
+    assert client.objects == {}
+
+
+def test_segments_failing_every_attempt_are_spooled(tmp_path, monkeypatch):
+    monkeypatch.setattr(s3logger_module, "UPLOAD_ATTEMPTS", 1)
+    s3logger = S3Logger("app", bucket="logs", client=RecordingClient(error=OSError("unreachable")), spool_dir=tmp_path / "spool")
+
+    s3logger.loginfo("message")
+    s3logger.close()
+
+    assert _spooled(tmp_path / "spool") == "message\n"
+
+
+def test_the_s3_client_has_short_timeouts():
+    pytest.importorskip("boto3")
+    s3logger = S3Logger("app")
+    config = s3logger.s3.meta.config
+    s3logger.close()
+
+    assert (config.connect_timeout, config.read_timeout) == (s3logger_module.S3_CONNECT_TIMEOUT, s3logger_module.S3_READ_TIMEOUT)
+    assert config.retries["total_max_attempts"] == s3logger_module.S3_MAX_RETRIES + 1
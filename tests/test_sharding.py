@@ -0,0 +1,73 @@
+import pandas as pd
+import pytest
+
+from aggutils import agg_dict_to_table, agg_table_to_dict, merge_agg_dicts
+from processorpipeline import UsageStatsProcessorPipeline
+from sharding import frame_to_ipc, ipc_to_frame, shard_frame
+from synthetic import WorkloadSpec
+
+ACTIONS = ["views", "downloads"]
+STATS = "stats_by_country"
+
+FILTERS = ["stages.RobotsFilterStage", "stages.AssetsFilterStage", "stages.DoubleClickFilterStage", "stages.MetricsFilterStage", "stages.AggByItemFilterStage"]
+
+
+def _entry(views, downloads, countries):
+    entry = {"views": views, "downloads": downloads, STATS: {}}
+    for country, (c_views, c_downloads) in countries.items():
+        entry[STATS][country] = {"views": c_views, "downloads": c_downloads}
+    return entry
+
+
+def test_shard_frame_keeps_every_visit_in_one_shard():
+    df = pd.DataFrame({"idvisit": [1, 2, 3, 1, 2, 3, 4, 5], "value": range(8)})
+
+    shards = shard_frame(df, "idvisit", 3)
+
+    assert sum(len(shard) for shard in shards) == len(df)
+    owners = {}
+    for index, shard in enumerate(shards):
+        for idvisit in shard["idvisit"]:
+            assert owners.setdefault(idvisit, index) == index
+
+
+def test_frame_ipc_roundtrip():
+    df = pd.DataFrame({"idvisit": [1, 2], "server_time": pd.to_datetime(["2024-01-01", "2024-01-02"])})
+
+    result = ipc_to_frame(frame_to_ipc(df))
+
+    pd.testing.assert_frame_equal(result, df)
+
+
+def test_merge_agg_dicts_sums_totals_and_countries():
+    target = {"a": _entry(1, 0, {"AR": (1, 0)})}
+    other = {"a": _entry(2, 1, {"AR": (1, 0), "BR": (1, 1)}), "b": _entry(1, 1, {"CL": (1, 1)})}
+
+    merged = merge_agg_dicts(target, other)
+
+    assert merged["a"] == _entry(3, 1, {"AR": (2, 0), "BR": (1, 1)})
+    assert merged["b"] == _entry(1, 1, {"CL": (1, 1)})
+
+
+def test_agg_table_roundtrip():
+    agg_dict = {"a": _entry(3, 1, {"AR": (2, 0), None: (1, 1)}), "b": _entry(1, 0, {"BR": (1, 0)})}
+
+    table = agg_dict_to_table(agg_dict, ACTIONS, STATS)
+
+    assert agg_table_to_dict(table, ACTIONS, STATS) == agg_dict
+
+
+@pytest.mark.parametrize("workers,stream", [(2, False), (4, False), (1, True)])
+def test_sharded_and_stream_runs_match_the_single_process_run(config_context, workload, workers, stream):
+    dataset = workload(WorkloadSpec(events=20000, seed=11, identifiers=274, source_type="R"))
+    ctx = config_context({"STREAM_BUCKETS": 5, "STREAM_CHUNK_ROWS": 3000}, **dataset.args)
+
+    def _run(workers, stream):
+        return UsageStatsProcessorPipeline(ctx, dataset.input_stage, FILTERS, dataset.output_stage, workers=workers, stream=stream).run()
+
+    expected = _run(1, False)
+    actual = _run(workers, stream)
+
+    assert len(expected.country_by_identifier_dict) > 0
+    assert actual.agg_dict == expected.agg_dict
+    assert actual.country_by_identifier_dict == expected.country_by_identifier_dict
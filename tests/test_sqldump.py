@@ -0,0 +1,38 @@
+import io
+
+import pytest
+
+from sqldump import InsertRowReader, SQLDumpError
+
+DUMP = """-- MySQL dump
+CREATE TABLE `drupatablal` (`id` int, `identifier` varchar(255), `record` varchar(255));
+/*!40000 ALTER TABLE `drupatablal` DISABLE KEYS */;
+INSERT INTO `drupatablal` VALUES (1,'a:ñ1','rec, with comma'),(2,'it''s','line\\nbreak'),
+(3,'back\\\\slash',NULL),(4,'paren ( )','quote \\' inside');
+INSERT INTO `other` VALUES (9,'x','y');
+INSERT INTO `drupatablal` (`id`, `identifier`, `record`) VALUES (5,'','');
+"""
+
+EXPECTED = [
+    ["1", "a:ñ1", "rec, with comma"],
+    ["2", "it's", "line\nbreak"],
+    ["3", "back\\slash", None],
+    ["4", "paren ( )", "quote ' inside"],
+    ["5", "", ""],
+]
+
+
+@pytest.mark.parametrize("chunk_bytes", [3, 7, 64, 1 << 20])
+def test_rows_are_tokenized_across_chunk_boundaries(chunk_bytes):
+    reader = InsertRowReader(io.BytesIO(DUMP.encode("utf-8")), table="drupatablal", chunk_bytes=chunk_bytes)
+
+    assert [values for table, values in reader] == EXPECTED
+    assert reader.rows == 5
+    assert reader.bytes_read == len(DUMP.encode("utf-8"))
+
+
+def test_invalid_rows_are_reported():
+    reader = InsertRowReader(io.BytesIO(b"INSERT INTO `t` VALUES (1,'open;"), chunk_bytes=4)
+
+    with pytest.raises(SQLDumpError):
+        list(reader)
@@ -0,0 +1,28 @@
+import json
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+ROOT_DIR = Path(__file__).resolve().parents[1]
+
+
+def _loaded_modules(statement):
+    """ stages.* and heavy modules imported by statement in a fresh interpreter """
+    code = statement + "\nimport json, sys\nprint(json.dumps(sorted(m for m in sys.modules if m.startswith('stages.') or m in ('awswrangler', 'xxhash'))))"
+    output = subprocess.run([sys.executable, "-c", code], cwd=ROOT_DIR, capture_output=True, text=True, check=True).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def test_import_stages_does_not_import_the_stage_modules():
+    assert _loaded_modules("import stages") == []
+
+
+def test_get_class_imports_only_the_requested_stage():
+    pytest.importorskip("lareferenciastatsdb")
+
+    loaded = _loaded_modules("from processorpipeline import get_class\n"
+                             "assert get_class('stages.RobotsFilterStage').__name__ == 'RobotsFilterStage'")
+
+    assert loaded == ["stages.robots_fstage"]
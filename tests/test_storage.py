@@ -0,0 +1,90 @@
+import pandas as pd
+import pytest
+
+import storage
+
+
+def _frame(site, month, rows):
+    return pd.DataFrame({"idvisit": range(rows), "idsite": site, "year": 2024, "month": month})
+
+
+def test_split_uri_defaults_to_s3():
+    assert storage.split_uri("bucket/v2/visits") == ("s3", "bucket/v2/visits")
+    assert storage.split_uri("s3://bucket/v2/visits") == ("s3", "bucket/v2/visits")
+    assert storage.split_uri("file:///data/visits") == ("file", "/data/visits")
+
+
+def test_local_dataset_appends_and_filters_partitions(tmp_path):
+    uri = "file://%s/visits" % tmp_path
+    partition_cols = ["idsite", "year", "month"]
+
+    storage.write_parquet(_frame(1, 1, 10), uri, partition_cols)
+    storage.write_parquet(_frame(1, 1, 5), uri, partition_cols)
+    storage.write_parquet(_frame(2, 1, 7), uri, partition_cols)
+
+    # partition values reach the filter as strings, like with awswrangler
+    df = storage.read_parquet(uri, columns=["idvisit"], partition_filter=lambda x: x["idsite"] == "1" and x["month"] == "1")
+    assert len(df) == 15
+    assert list(df.columns) == ["idvisit"]
+
+    chunks = list(storage.read_parquet(uri, columns=["idvisit"], partition_filter=lambda x: x["idsite"] == "1", chunked=4))
+    assert sum(len(chunk) for chunk in chunks) == 15
+    assert max(len(chunk) for chunk in chunks) <= 4
+
+    storage.write_parquet(_frame(1, 1, 3), uri, partition_cols, mode=storage.MODE_OVERWRITE_PARTITIONS)
+    assert len(storage.read_parquet(uri, partition_filter=lambda x: x["idsite"] == "1")) == 3
+    assert len(storage.read_parquet(uri, partition_filter=lambda x: x["idsite"] == "2")) == 7
+
+
+def test_fake_s3_round_trip():
+    pytest.importorskip("moto")
+    pytest.importorskip("awswrangler")
+
+    with storage.fake_s3(["usage-stats"]):
+        storage.write_parquet(_frame(1, 2, 12), "usage-stats/v2/visits", ["idsite", "year", "month"])
+        df = storage.read_parquet("s3://usage-stats/v2/visits", columns=["idvisit"], partition_filter=lambda x: x["month"] == "2")
+
+    assert len(df) == 12
+
+
+def test_list_files_of_a_partition_prefix():
+    pytest.importorskip("moto")
+    pytest.importorskip("awswrangler")
+
+    with storage.fake_s3(["usage-stats"]):
+        storage.write_parquet(_frame(1, 2, 12), "usage-stats/v2/visits", ["idsite", "year", "month"])
+        storage.write_parquet(_frame(1, 3, 5), "usage-stats/v2/visits", ["idsite", "year", "month"])
+        files = storage.list_files("usage-stats/v2/visits", [("idsite", 1), ("year", 2024), ("month", 2)])
+
+    assert len(files) == 1
+    key, size, etag = files[0]
+    assert key.endswith(".parquet") and "/" not in key and size > 0 and etag
+
+
+@pytest.mark.parametrize("backend", ["file", "s3"])
+def test_read_parquet_where_reads_only_the_row_groups_of_the_values(tmp_path, backend):
+    events = pd.DataFrame({"identifier": ["oai:%05d" % (i * 7919 % 5000) for i in range(5000)], "idvisit": range(5000),
+                           "idsite": 1, "year": 2024, "month": 2})
+    partitions = [("idsite", 1), ("year", 2024), ("month", 2)]
+    wanted = ["oai:00042", "oai:04999", "oai:missing"]
+
+    def _lookup(uri):
+        storage.write_parquet(events.iloc[:2500], uri, ["idsite", "year", "month"])
+        storage.write_parquet(events.iloc[2500:], uri, ["idsite", "year", "month"])
+        storage.sort_partitions(uri, partitions, "identifier", row_group_rows=100)
+
+        stats = {}
+        df = storage.read_parquet_where(uri, "identifier", wanted, columns=["idvisit"], partitions=partitions, stats=stats)
+        return df, stats, storage.list_files(uri, partitions)
+
+    if backend == "s3":
+        pytest.importorskip("moto")
+        pytest.importorskip("awswrangler")
+        with storage.fake_s3(["usage-stats"]):
+            df, stats, files = _lookup("usage-stats/v2/events")
+    else:
+        df, stats, files = _lookup("file://%s/events" % tmp_path)
+
+    assert sorted(df["idvisit"]) == sorted(events.loc[events["identifier"].isin(wanted), "idvisit"])
+    assert list(df.columns) == ["idvisit"]
+    assert len(files) == 1 and stats["row_groups"] == 50 and stats["row_groups_read"] <= 3
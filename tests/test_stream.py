@@ -0,0 +1,56 @@
+import tempfile
+
+import pandas as pd
+
+from processorpipeline import UsageStatsData, UsageStatsProcessorPipeline, get_class
+from synthetic import WorkloadSpec
+
+FILTERS = ["stages.RobotsFilterStage", "stages.AssetsFilterStage", "stages.DoubleClickFilterStage", "stages.MetricsFilterStage", "stages.AggByItemFilterStage"]
+
+
+def _decoded(df):
+    # the buckets are encoded with dictionaries of their own
+    return df.astype(dict((column, object) for column in df.columns if isinstance(df[column].dtype, pd.CategoricalDtype)))
+
+
+def test_buckets_hold_complete_visits_and_every_row_once(config_context, workload, tmp_path, monkeypatch):
+    dataset = workload(WorkloadSpec(events=5000, seed=2, identifiers=200, source_type="R"))
+    stage = get_class(dataset.input_stage)(config_context({"STREAM_BUCKETS": 4, "STREAM_CHUNK_ROWS": 700}, **dataset.args))
+
+    (tmp_path / "spill").mkdir()
+    monkeypatch.setattr(tempfile, "tempdir", str(tmp_path / "spill"))
+
+    buckets = list(stage.run_stream([UsageStatsData()]))
+    whole = stage.run(UsageStatsData())
+
+    assert len(buckets) == 4
+    owners = {}
+    for index, bucket in enumerate(buckets):
+        assert set(bucket.events_df["idvisit"]) <= set(bucket.visits_df["idvisit"])
+        for idvisit in bucket.visits_df["idvisit"]:
+            assert owners.setdefault(idvisit, index) == index
+
+    # the spilled rows in the order of the whole frame, the spill files are removed
+    for name in UsageStatsData.FRAMES:
+        rows = pd.concat([_decoded(bucket.get(name)) for bucket in buckets], ignore_index=True)
+        rows = rows.sort_values(UsageStatsData.ROW_POSITION).drop(columns=[UsageStatsData.ROW_POSITION]).reset_index(drop=True)
+        pd.testing.assert_frame_equal(rows, _decoded(whole.get(name)))
+    assert list((tmp_path / "spill").iterdir()) == []
+
+
+def test_empty_buckets_and_periods(config_context, workload):
+    dataset = workload(WorkloadSpec(events=300, seed=4, identifiers=20, source_type="R"))
+
+    def _run(stream, **args):
+        ctx = config_context({"STREAM_BUCKETS": 64}, **dict(dataset.args, **args))
+        return UsageStatsProcessorPipeline(ctx, dataset.input_stage, FILTERS, dataset.output_stage, stream=stream).run()
+
+    # fewer visits than buckets
+    stage = get_class(dataset.input_stage)(config_context({"STREAM_BUCKETS": 64}, **dataset.args))
+    buckets = list(stage.run_stream([UsageStatsData()]))
+    assert 0 < len(buckets) < 64
+    assert all(len(bucket.visits_df) > 0 for bucket in buckets)
+    assert _run(True).agg_dict == _run(False).agg_dict
+
+    # a period without data
+    assert _run(True, month=dataset.spec.month + 1).agg_dict == _run(False, month=dataset.spec.month + 1).agg_dict == {}
@@ -0,0 +1,39 @@
+import sys
+from pathlib import Path
+
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "benchmarks"))
+
+from synthetic import WorkloadSpec, generate, write_workload
+
+
+def test_generate_is_deterministic_and_exact():
+    spec = WorkloadSpec(events=5000, seed=7)
+    visits_a, events_a = generate(spec)
+    visits_b, events_b = generate(WorkloadSpec(events=5000, seed=7))
+
+    assert len(events_a) == 5000
+    assert visits_a["visit_total_actions"].sum() == 5000
+    pd.testing.assert_frame_equal(visits_a, visits_b)
+    pd.testing.assert_frame_equal(events_a, events_b)
+
+
+def test_generate_follows_the_spec_ratios():
+    spec = WorkloadSpec(events=20000, identifiers=50, asset_ratio=0.2, countries={"AR": 0.5, "BR": 0.5})
+    visits, events = generate(spec)
+
+    assert events["custom_var_v1"].nunique() <= 50
+    assert set(visits["location_country"]) == {"AR", "BR"}
+    assert 0.15 < events["action_url"].str.contains("thumb").mean() < 0.25
+    assert events["idvisit"].isin(visits["idvisit"]).all()
+
+
+def test_write_workload_is_partitioned_like_matomo2parquet(tmp_path):
+    spec = WorkloadSpec(events=1000, site=3, year=2024, month=5)
+    visits_path, events_path = write_workload(spec, str(tmp_path))
+
+    assert events_path == "file://%s/events" % tmp_path
+    assert (tmp_path / "events" / "idsite=3" / "year=2024" / "month=5").is_dir()
+    assert len(pd.read_parquet(tmp_path / "events")) == 1000
+    assert len(pd.read_parquet(tmp_path / "visits")) > 0
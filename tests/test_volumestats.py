@@ -0,0 +1,33 @@
+import pandas as pd
+
+import storage
+import volumestats
+
+
+def _events(site, day, rows):
+    return pd.DataFrame({"idvisit": range(rows), "idsite": site, "year": 2024, "month": 3, "day": day})
+
+
+def test_volume_report_from_the_footers(tmp_path):
+    events, visits = "file://%s/events" % tmp_path, "file://%s/visits" % tmp_path
+    partition_cols = ["idsite", "year", "month"]
+
+    # a chunk per day, and a chunk of two days whose rows can not be assigned to a day
+    storage.write_parquet(_events(1, 1, 10), events, partition_cols)
+    storage.write_parquet(_events(1, 2, 7), events, partition_cols)
+    storage.write_parquet(pd.concat([_events(1, 3, 2), _events(1, 4, 3)]), events, partition_cols)
+    storage.write_parquet(_events(2, 5, 4), events, partition_cols)
+    storage.write_parquet(pd.DataFrame({"idvisit": range(6), "idsite": 1, "year": 2024, "month": 3, "day": 1}), visits, partition_cols)
+
+    rows = volumestats.volume_report(events, visits, year=2024)
+    counts = dict(((row["idsite"], row["day"]), (row["events"], row["visits"])) for row in rows)
+    assert counts == {(1, None): (5, 6), (1, 1): (10, 0), (1, 2): (7, 0), (2, 5): (4, 0)}
+    assert volumestats.volume_report(events, visits, sites=[2], year=2024) == [row for row in rows if row["idsite"] == 2]
+    assert volumestats.volume_report(events, visits, year=2023) == []
+
+    volumestats.write_csv(rows, str(tmp_path / "volumes.csv"))
+    assert volumestats.read_report(str(tmp_path / "volumes.csv")) == rows
+
+    assert volumestats.site_volumes(rows) == {1: {"events": 22, "visits": 6}, 2: {"events": 4, "visits": 0}}
+    assert volumestats.period_events(rows, 1, 2024, 3, 2) == 12
+    assert volumestats.period_events(rows, 2, 2024, 3, 2) == 0
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Event and visit volumes per site/year/month/day from the parquet footers and the partition layout,
+no data page is read.
+
+Every file contributes the row counts of its row groups to the period of its hive partitions. The
+day of the events comes from the day partition or, in monthly partitions, from the min/max statistics
+of the day column when a row group holds a single day; otherwise the rows are counted in the month
+with an empty day. The report feeds s3stats.py (csv, json and chart) and the scheduling of runner.py.
+"""
+
+import csv
+import json
+import os
+
+import storage
+
+PERIOD_COLUMNS = ('idsite', 'year', 'month', 'day')
+COUNT_COLUMNS = ('events', 'visits', 'events_bytes', 'visits_bytes')
+
+## column of the events with the day of the event, also in monthly partitions
+DAY_COLUMN = 'day'
+
+
+def _number(value):
+    return int(value) if value is not None else None
+
+
+def _day_index(metadata):
+    for index in range(metadata.num_columns):
+        if metadata.schema.column(index).path == DAY_COLUMN:
+            return index
+    return None
+
+
+def _row_group_day(row_group, index):
+    # the day of a row group whose rows are all of the same day
+    if index is None:
+        return None
+    statistics = row_group.column(index).statistics
+    if statistics is None or not statistics.has_min_max or statistics.min != statistics.max:
+        return None
+    return int(statistics.min)
+
+
+def _add(report, period, name, rows, size):
+    entry = report.setdefault(period, dict((column, 0) for column in COUNT_COLUMNS))
+    entry[name] += rows
+    entry[name + '_bytes'] += size
+
+
+def _count(report, path, name, partitions, periods, day_statistics, threads):
+    for values, size, metadata in storage.read_footers(path, partitions, threads=threads):
+        values = dict(values)
+        period = tuple(_number(values.get(column)) for column in PERIOD_COLUMNS)
+        if not periods(period):
+            continue
+
+        if period[3] is not None or not day_statistics:
+            _add(report, period, name, metadata.num_rows, size)
+            continue
+
+        # the bytes of the file go to the days in proportion to their rows
+        index = _day_index(metadata)
+        for group in range(metadata.num_row_groups):
+            row_group = metadata.row_group(group)
+            share = size * row_group.num_rows // max(metadata.num_rows, 1)
+            _add(report, period[:3] + (_row_group_day(row_group, index),), name, row_group.num_rows, share)
+
+
+def volume_report(events_path, visits_path, sites=None, year=None, month=None, threads=16):
+    """
+    Rows {idsite, year, month, day, events, visits, events_bytes, visits_bytes} sorted by period, of
+    the given sites (every site in the layout by default) and year/month. The day is None for the
+    rows of a month that can not be assigned to a day.
+    """
+    def periods(period):
+        return (year is None or period[1] == int(year)) and (month is None or period[2] == int(month))
+
+    # one listing prefix per site, the whole dataset for every site
+    prefixes = [[]] if sites is None else [[('idsite', site)] + ([('year', year)] if year is not None else []) for site in sites]
+
+    report = {}
+    for partitions in prefixes:
+        _count(report, events_path, 'events', partitions, periods, True, threads)
+        _count(report, visits_path, 'visits', partitions, periods, False, threads)
+
+    # the None days sort before the days of the month
+    rows = []
+    for period in sorted(report, key=lambda period: tuple(-1 if value is None else value for value in period)):
+        rows.append(dict(zip(PERIOD_COLUMNS, period), **report[period]))
+    return rows
+
+
+def site_volumes(rows):
+    """ Events and visits by site of the rows of a report """
+    volumes = {}
+    for row in rows:
+        entry = volumes.setdefault(int(row['idsite']), {'events': 0, 'visits': 0})
+        entry['events'] += int(row['events'] or 0)
+        entry['visits'] += int(row['visits'] or 0)
+    return volumes
+
+
+def period_events(rows, site, year, month=None, day=None):
+    """
+    Events of a site in the year, month or day of the rows of a report. The events of the month
+    without a day are counted for every day of it, a period is only empty when surely empty.
+    """
+    events = 0
+    for row in rows:
+        if int(row['idsite']) != int(site) or int(row['year']) != int(year):
+            continue
+        if month is not None and int(row['month']) != int(month):
+            continue
+        if day is not None and row['day'] is not None and int(row['day']) != int(day):
+            continue
+        events += int(row['events'] or 0)
+    return events
+
+
+def write_csv(rows, path):
+    with open(path, 'w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=PERIOD_COLUMNS + COUNT_COLUMNS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def write_json(rows, path):
+    with open(path, 'w') as file:
+        json.dump(rows, file, indent=1)
+
+
+def read_report(path):
+    """ Rows of a report written by write_csv or write_json """
+    if path.endswith('.json'):
+        with open(path) as file:
+            return json.load(file)
+
+    with open(path, newline='') as file:
+        return [dict((name, _number(value) if value != '' else None) for name, value in row.items()) for row in csv.DictReader(file)]
+
+
+def plot_months(rows, path, title):
+    """ Bar chart of the events and visits by month, False when matplotlib is not installed """
+    try:
+        import matplotlib
+    except ImportError:
+        print("matplotlib is not installed, the chart is not plotted")
+        return False
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    months = {}
+    for row in rows:
+        entry = months.setdefault('%04d-%02d' % (row['year'], row['month']), [0, 0])
+        entry[0] += row['events']
+        entry[1] += row['visits']
+
+    labels = sorted(months)
+    positions = range(len(labels))
+    figure, axis = plt.subplots(figsize=(max(6, len(labels) * 0.6), 5))
+    axis.bar([position - 0.2 for position in positions], [months[label][0] for label in labels], width=0.4, label='events')
+    axis.bar([position + 0.2 for position in positions], [months[label][1] for label in labels], width=0.4, label='visits')
+    axis.set_xticks(list(positions))
+    axis.set_xticklabels(labels, rotation=45)
+    axis.set_title(title)
+    axis.legend()
+    figure.tight_layout()
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    figure.savefig(path)
+    return True